@@ -196,6 +196,13 @@ def create_config(
         help="Number of cores to use pr. sample. ",
         rich_help_panel="General parameters",
     ),
+    auto_parallel: bool = typer.Option(
+        False,
+        "--auto-parallel",
+        "-a",
+        help="Automatically choose parallel-samples and cores-per-sample.",
+        rich_help_panel="General parameters",
+    ),
     config_file: Path = typer.Option(
         cli_utils.config_file_default,
         "--config-file",
@@ -271,6 +278,7 @@ def create_config(
         output_dir=output_dir,
         parallel_samples=parallel_samples,
         cores_per_sample=cores_per_sample,
+        auto_parallel=auto_parallel,
         config_file=config_file,
         sample_prefix=sample_prefix,
         sample_suffix=sample_suffix,
@@ -311,6 +319,22 @@ def compute(
         "-f",
         help="Forced computation (even though the files already exists).",
     ),
+    trace: bool = typer.Option(
+        False,
+        "--trace",
+        help="Save a Chrome/Perfetto trace of the run to `output_dir/trace.json`.",
+    ),
+    profile: bool = typer.Option(
+        False,
+        "--profile",
+        help="Profile the run (cProfile), saving a report per stage next to the log.",
+    ),
+    queue: Optional[Path] = typer.Option(
+        None,
+        "--queue",
+        help="Add the samples to a job queue in this (shared) directory instead, "
+        "to be run by `metaDMG worker`.",
+    ),
 ):
     """Compute the LCA and Ancient Damage given the configuration file."""
 
@@ -328,13 +352,99 @@ def compute(
         log_port=log_port,
         log_path=log_path,
         force=force,
+        trace=trace,
+        profile=profile,
     )
 
+    if queue is not None:
+        from logger_tt import logger
+
+        from metaDMG.fit.job_queue import enqueue
+
+        N_jobs = enqueue(configs, queue)
+        logger.info(
+            f"Added {N_jobs} sample(s) to the queue {queue}. "
+            f"Run them with: metaDMG worker {queue}"
+        )
+        return
+
     return_code = run_workflow(configs)
     if return_code != 0:
         raise typer.Exit(return_code)
 
 
+@cli_app.command("worker")
+def worker(
+    queue: Path = typer.Argument(
+        ...,
+        exists=True,
+        file_okay=False,
+        help="Path to the queue directory (see `metaDMG compute --queue`).",
+    ),
+):
+    """Run the samples of a job queue until all of them are done or failed.
+    Any number of workers, on any node, can share the same queue."""
+
+    from metaDMG import utils
+
+    utils.check_metaDMG_fit()
+
+    from metaDMG.fit import get_logger_port_and_path, setup_logger
+    from metaDMG.fit.job_queue import run_worker
+
+    log_port, log_path = get_logger_port_and_path()
+    setup_logger(log_port=log_port, log_path=log_path)
+
+    N_errors = run_worker(queue, log_port=log_port, log_path=log_path)
+    if N_errors != 0:
+        raise typer.Exit(N_errors)
+
+
+@cli_app.command("serve")
+def serve(
+    config_file: Optional[Path] = typer.Argument(
+        None,
+        file_okay=True,
+        help="Path to the config-file with the settings for new alignment files.",
+    ),
+    spool: Path = typer.Option(
+        ...,
+        "--spool",
+        file_okay=False,
+        help="Directory to watch for new alignment files and config files.",
+    ),
+    once: bool = typer.Option(
+        False,
+        "--once",
+        help="Stop when all the files in the spool directory are done.",
+    ),
+):
+    """Keep running, computing the new samples in the spool directory as they arrive."""
+
+    from metaDMG import utils
+
+    utils.check_metaDMG_fit()
+
+    from metaDMG.fit import get_logger_port_and_path, setup_logger
+    from metaDMG.fit.serve import serve
+
+    log_port, log_path = get_logger_port_and_path()
+    setup_logger(log_port=log_port, log_path=log_path)
+
+    configs = utils.make_configs(
+        config_file=config_file,
+        log_port=log_port,
+        log_path=log_path,
+    )
+
+    try:
+        N_errors = serve(configs, spool, once=once)
+    except KeyboardInterrupt:
+        raise typer.Exit(0)
+    if N_errors != 0:
+        raise typer.Exit(N_errors)
+
+
 #%%
 
 
@@ -560,7 +670,7 @@ def plot(
     viz_results = VizResults(results_dir)
 
     if tax_ids:
-        tax_ids_list = utils.split_string(tax_ids)
+        tax_ids_list = viz_results.parse_tax_ids(utils.split_string(tax_ids))
         query += f" & tax_id in {tax_ids_list}"
 
     if samples:
@@ -599,7 +709,7 @@ def mismatch_to_mapDamage(
     filename: Path = typer.Argument(
         ...,
         file_okay=True,
-        help="Path to the mismatch-file to convert.",
+        help="Path to the mismatch-file to convert (.parquet or .npz).",
     ),
     csv_out: Path = typer.Option(
         "misincorporation.txt",
@@ -455,6 +455,7 @@ def get_config_dict(
     output_dir: Path = output_dir_default,
     parallel_samples: int = 1,
     cores_per_sample: int = 1,
+    auto_parallel: bool = False,
     config_file: Path = config_file_default,
     sample_prefix: str = "",
     sample_suffix: str = "",
@@ -463,6 +464,10 @@ def get_config_dict(
     __version__: str = "",
 ) -> dict:
 
+    if auto_parallel:
+        parallel_samples = "auto"
+        cores_per_sample = "auto"
+
     config = paths_to_strings(
         {
             "samples": extract_samples(
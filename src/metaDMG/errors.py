@@ -33,3 +33,9 @@ class BadDataError(Error):
     """Raised when the {sample}.mismatches.txt does not contain any useful damage data"""
 
     pass
+
+
+class QueueError(Error):
+    """Raised when the job queue directory is invalid or still in use"""
+
+    pass
@@ -0,0 +1,328 @@
+#%%
+from statistics import median
+from typing import Optional
+
+import psutil
+from logger_tt import logger
+
+from metaDMG.fit import serial
+from metaDMG.utils import Config, Configs
+
+
+#%%
+
+# Rough throughputs used to estimate the wall time of a sample (bytes per second).
+# Only the relative sizes matter when comparing different splits of the cores.
+BAM_BYTES_PER_SECOND = 20e6  # C++ stage (LCA / getdamage and print_ugly)
+MISMATCH_BYTES_PER_SECOND = 2e6  # parsing of the (gzipped) mismatch file
+FIT_BYTES_PER_SECOND_MAP = 0.2e6  # MAP fits per core (gzipped mismatch bytes)
+FIT_BYTES_PER_SECOND_BAYESIAN = FIT_BYTES_PER_SECOND_MAP / 100
+
+# Fraction of the BAM size that ends up in the (gzipped) mismatch file, used when the
+# mismatch file does not exist yet.
+MISMATCH_TO_BAM_RATIO = 0.01
+
+# Peak memory relative to the gzipped mismatch file size (long dataframe + fits)
+MEMORY_TO_MISMATCH_RATIO = 30
+MEMORY_MINIMUM = 1e9
+
+# How often (in seconds) to check the memory when a sample is waiting for memory
+MEMORY_CHECK_INTERVAL = 5
+
+# When the largest sample is this many times larger than the median sample,
+# the largest samples get more cores than the rest.
+HETEROGENEITY_RATIO = 4
+
+
+#%%
+
+
+def get_available_cores() -> int:
+    try:
+        return len(psutil.Process().cpu_affinity())
+    except AttributeError:
+        # cpu_affinity is not available on macOS
+        return psutil.cpu_count(logical=False) or psutil.cpu_count(logical=True)
+
+
+def get_available_memory() -> int:
+    return psutil.virtual_memory().available
+
+
+def get_idle_worker_memory() -> int:
+    """The resident memory (RSS) of an idle worker process, estimated by the memory of
+    this process, which has imported the same modules (and which the workers are
+    forked from)."""
+    return psutil.Process().memory_info().rss
+
+
+def get_memory_of_children(idle_worker_memory: float = 0) -> int:
+    """The resident memory (RSS) of all the child processes, e.g. the workers and
+    metaDMG-cpp. The `idle_worker_memory` of each (Python) worker is not counted,
+    such that idle workers do not take up any of the memory budget."""
+
+    executable = psutil.Process().exe()
+    memory = 0
+    for process in psutil.Process().children(recursive=True):
+        try:
+            rss = process.memory_info().rss
+            if process.exe() == executable:
+                rss = max(rss - idle_worker_memory, 0)
+        except psutil.Error:
+            # the process finished in the meantime
+            continue
+        memory += rss
+    return memory
+
+
+def _file_size(path) -> int:
+    return path.stat().st_size if serial.path_exists_and_not_empty(path) else 0
+
+
+def estimate_sample(config: Config) -> dict:
+    """Estimate the work (in seconds on a single core) and the peak memory of a sample.
+
+    Uses the sizes of the mismatch and stat files if they already exist,
+    otherwise the size of the alignment file.
+    """
+
+    bam_size = _file_size(config["bam"])
+    mismatch_size = _file_size(config["path_mismatches_txt"])
+    mismatch_size += _file_size(config["path_mismatches_stat"])
+
+    if mismatch_size > 0:
+        time_cpp = 0
+    else:
+        time_cpp = bam_size / BAM_BYTES_PER_SECOND
+        mismatch_size = bam_size * MISMATCH_TO_BAM_RATIO
+
+    if config["bayesian"]:
+        fit_bytes_per_second = FIT_BYTES_PER_SECOND_BAYESIAN
+    else:
+        fit_bytes_per_second = FIT_BYTES_PER_SECOND_MAP
+
+    return {
+        "sample": config["sample"],
+        "time_serial": time_cpp + mismatch_size / MISMATCH_BYTES_PER_SECOND,
+        "time_fit": mismatch_size / fit_bytes_per_second,
+        "memory": max(mismatch_size * MEMORY_TO_MISMATCH_RATIO, MEMORY_MINIMUM),
+    }
+
+
+def get_sample_time(estimate: dict, cores_per_sample: int) -> float:
+    return estimate["time_serial"] + estimate["time_fit"] / cores_per_sample
+
+
+def estimate_wall_time(
+    estimates: list[dict],
+    parallel_samples: int,
+    cores_per_sample: int,
+    sample_cores: Optional[dict] = None,
+) -> float:
+    """Estimate the total wall time by scheduling the samples, largest first,
+    on the first available of the `parallel_samples` workers."""
+
+    if sample_cores is None:
+        sample_cores = {}
+
+    workers = [0.0] * parallel_samples
+    for estimate in sorted(estimates, key=lambda e: -e["time_fit"]):
+        cores = sample_cores.get(estimate["sample"], cores_per_sample)
+        i = workers.index(min(workers))
+        workers[i] += get_sample_time(estimate, cores)
+    return max(workers)
+
+
+#%%
+
+
+def find_best_split(
+    estimates: list[dict],
+    N_cores: int,
+    memory: float,
+    parallel_samples=None,
+    cores_per_sample=None,
+):
+    """Find the split of parallel samples and cores per sample that minimises the
+    estimated wall time, while the largest samples running in parallel fit in memory.
+    Fixed (non-auto) values of parallel_samples and cores_per_sample are respected.
+    """
+
+    memory_sorted = sorted((e["memory"] for e in estimates), reverse=True)
+
+    best = None
+    for P in range(1, len(estimates) + 1):
+
+        if parallel_samples is not None and P != parallel_samples:
+            continue
+
+        if P > 1 and sum(memory_sorted[:P]) > memory:
+            break
+
+        C = cores_per_sample if cores_per_sample is not None else N_cores // P
+        if C < 1:
+            break
+
+        wall_time = estimate_wall_time(estimates, P, C)
+        if best is None or wall_time < best[2]:
+            best = (P, C, wall_time)
+
+    if best is None:
+        P = parallel_samples or 1
+        C = cores_per_sample or max(N_cores // P, 1)
+        best = (P, C, estimate_wall_time(estimates, P, C))
+
+    return best
+
+
+def get_sample_cores(
+    estimates: list[dict],
+    N_cores: int,
+    parallel_samples: int,
+    cores_per_sample: int,
+) -> dict:
+    """Give the samples much larger than the median sample more cores, since they
+    dominate the total wall time while the smaller samples finish quickly.
+
+    The cores are taken from the smaller samples, such that the samples running in
+    parallel never use more than `N_cores` in total, even when all the large samples
+    (up to `parallel_samples`) run at the same time.
+    """
+
+    if len(estimates) < 2 or parallel_samples == 1:
+        return {}
+
+    time_median = median(e["time_fit"] for e in estimates)
+    samples_large = [
+        estimate["sample"]
+        for estimate in estimates
+        if estimate["time_fit"] > HETEROGENEITY_RATIO * max(time_median, 1e-9)
+    ]
+    if len(samples_large) == 0:
+        return {}
+
+    # the number of large samples that may run at the same time, and the other
+    # samples running next to them (with at least a core each)
+    N_large = min(parallel_samples, len(samples_large))
+    N_small = parallel_samples - N_large
+
+    cores_large = min(N_cores // 2, (N_cores - N_small) // N_large)
+    if cores_large <= cores_per_sample:
+        return {}
+
+    sample_cores = {sample: cores_large for sample in samples_large}
+
+    if N_small > 0:
+        cores_small = (N_cores - N_large * cores_large) // N_small
+        if cores_small < cores_per_sample:
+            for estimate in estimates:
+                sample_cores.setdefault(estimate["sample"], cores_small)
+
+    return sample_cores
+
+
+#%%
+
+
+def is_auto(value) -> bool:
+    return isinstance(value, str) and value.lower() == "auto"
+
+
+def resolve_auto(configs: Configs) -> None:
+    """Replace `parallel_samples: auto` and/or `cores_per_sample: auto` in the configs
+    with the values that minimise the estimated total wall time."""
+
+    auto_parallel = is_auto(configs["parallel_samples"])
+    auto_cores = is_auto(configs["cores_per_sample"])
+
+    if not (auto_parallel or auto_cores):
+        return
+
+    N_cores = configs.get("max_cores") or get_available_cores()
+    memory = get_available_memory()
+    estimates = [estimate_sample(config) for config in configs]
+
+    P, C, wall_time = find_best_split(
+        estimates,
+        N_cores=N_cores,
+        memory=memory,
+        parallel_samples=None if auto_parallel else configs["parallel_samples"],
+        cores_per_sample=None if auto_cores else configs["cores_per_sample"],
+    )
+
+    configs["parallel_samples"] = P
+    configs["cores_per_sample"] = C
+
+    logger.info(
+        f"Automatically chose parallel_samples = {P} and cores_per_sample = {C} "
+        f"using {N_cores} core(s) and {memory / 1e9:.1f} GB of memory."
+    )
+    logger.info(f"Estimated total wall time: {wall_time / 60:.1f} minutes.")
+
+    if auto_cores and "sample_cores" not in configs:
+        sample_cores = get_sample_cores(estimates, N_cores, P, C)
+        if len(sample_cores) == 0:
+            return
+
+        # only if it is faster, since the smaller samples may get fewer cores
+        wall_time_sample_cores = estimate_wall_time(estimates, P, C, sample_cores)
+        if wall_time_sample_cores >= wall_time:
+            return
+
+        configs["sample_cores"] = sample_cores
+        cores_large = max(sample_cores.values())
+        samples_large = [s for s, c in sample_cores.items() if c == cores_large]
+        logger.info(
+            f"Using {cores_large} core(s) for the large samples: "
+            f"{', '.join(samples_large)}. "
+            f"Estimated total wall time: {wall_time_sample_cores / 60:.1f} minutes."
+        )
+
+
+#%%
+
+
+class MemoryBudget:
+    """Admission control of samples based on their estimated peak memory.
+
+    A new sample is only admitted if its estimated peak memory (see `estimate_sample`)
+    fits in the `memory_budget` (in GB), together with the memory in use by the
+    running samples: the largest of their estimated peak memory and their measured
+    memory (without the memory of the idle workers, see `get_memory_of_children`).
+    A sample larger than the budget is run alone. Without a budget,
+    all samples are admitted.
+    """
+
+    def __init__(self, memory_budget: Optional[float]):
+        self.budget = memory_budget * 1e9 if memory_budget else None
+        self.estimates = {}
+        # measured before any sample is loaded
+        self.idle_worker_memory = get_idle_worker_memory() if self.budget else 0
+
+    def get_memory_in_use(self) -> float:
+        memory_measured = get_memory_of_children(self.idle_worker_memory)
+        return max(sum(self.estimates.values()), memory_measured)
+
+    def admit(self, config: Config) -> bool:
+
+        if self.budget is None:
+            return True
+
+        sample = config["sample"]
+        memory = estimate_sample(config)["memory"]
+
+        if len(self.estimates) == 0:
+            if memory > self.budget:
+                logger.warning(
+                    f"{sample} is estimated to use {memory / 1e9:.1f} GB of memory, "
+                    f"more than the memory budget, so it is run alone."
+                )
+
+        elif self.get_memory_in_use() + memory > self.budget:
+            return False
+
+        self.estimates[sample] = memory
+        return True
+
+    def release(self, sample: str) -> None:
+        self.estimates.pop(sample, None)
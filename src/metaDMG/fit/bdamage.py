@@ -0,0 +1,162 @@
+#%%
+import gzip
+import struct
+from pathlib import Path
+from typing import Iterator, Optional, Union
+
+import numpy as np
+import pandas as pd
+
+from metaDMG.errors import MismatchFileError
+from metaDMG.fit import fit_utils
+from metaDMG.utils import Config
+
+
+#%%
+
+# The binary {sample}.bdamage.gz files written by metaDMG-cpp are BGZF compressed
+# (and thus readable as multi-member gzip files) with the layout:
+#   magic "bdam1", int32 printlength (L),
+#   and for each reference: int32 id, int32 nreads,
+#   float32[L][16] 5' mismatch counts, float32[L][16] 3' mismatch counts,
+# where the 16 counts are in the order of fit_utils.ref_obs_bases.
+
+MAGIC = b"bdam1"
+
+DIRECTIONS = ["5'", "3'"]
+
+
+def uses_native_reader(config: Config) -> bool:
+    """Read the bdamage file directly instead of through `print_ugly`.
+    Only for the non-LCA damage modes, since the LCA mode needs the taxonomy."""
+    return config["damage_mode"] != "lca" and config["bdamage_reader"] == "native"
+
+
+def get_record_dtype(printlength: int) -> np.dtype:
+    return np.dtype(
+        [
+            ("id", "<i4"),
+            ("nreads", "<i4"),
+            ("counts", "<f4", (len(DIRECTIONS), printlength, 16)),
+        ]
+    )
+
+
+#%%
+
+
+def read_bam_reference_names(path: Union[Path, str]) -> list[str]:
+    """Read the reference names from the header of a BAM, SAM, or SAM.gz file."""
+
+    path = Path(path)
+
+    if path.name.endswith(".bam"):
+        with gzip.open(path, "rb") as f:
+            if f.read(4) != b"BAM\1":
+                raise MismatchFileError(f"{path} is not a valid BAM file.")
+            (l_text,) = struct.unpack("<i", f.read(4))
+            f.read(l_text)
+            (n_ref,) = struct.unpack("<i", f.read(4))
+            names = []
+            for _ in range(n_ref):
+                (l_name,) = struct.unpack("<i", f.read(4))
+                names.append(f.read(l_name)[:-1].decode("ascii"))
+                f.read(4)  # l_ref
+            return names
+
+    opener = gzip.open if path.name.endswith(".gz") else open
+    names = []
+    with opener(path, "rt") as f:
+        for line in f:
+            if not line.startswith("@"):
+                break
+            if line.startswith("@SQ"):
+                for field in line.rstrip("\n").split("\t")[1:]:
+                    if field.startswith("SN:"):
+                        names.append(field[3:])
+    return names
+
+
+def get_tax_ids(ids: np.ndarray, names: list[str]) -> np.ndarray:
+    # reference ids outside of the BAM header (e.g. the global damage) are kept as is
+    return np.array(
+        [names[i] if 0 <= i < len(names) else str(i) for i in ids],
+        dtype=object,
+    )
+
+
+def records_to_dataframe(records: np.ndarray, tax_ids: np.ndarray) -> pd.DataFrame:
+    """Convert bdamage records into the (long) format of the print_ugly text output."""
+
+    N_records = len(records)
+    _, printlength, _ = records.dtype["counts"].shape
+    N_rows_per_record = len(DIRECTIONS) * printlength
+
+    counts = records["counts"].reshape(N_records * N_rows_per_record, 16)
+    if np.all(counts == np.round(counts)):
+        counts = counts.astype(np.int64)
+    else:
+        counts = counts.astype(np.float64)
+
+    df = pd.DataFrame(counts, columns=fit_utils.ref_obs_bases)
+    df.insert(0, "tax_id", np.repeat(tax_ids, N_rows_per_record))
+    df.insert(
+        1,
+        "direction",
+        np.tile(np.repeat(DIRECTIONS, printlength), N_records),
+    )
+    df.insert(2, "position", np.tile(np.arange(printlength), N_records * 2))
+    return df
+
+
+def iterate_bdamage(
+    path: Union[Path, str],
+    names: list[str],
+    chunk_size: Optional[float] = None,
+    tax_ids_to_keep: Optional[set] = None,
+) -> Iterator[pd.DataFrame]:
+    """Read the bdamage file in chunks of about `chunk_size` MB (all at once if None).
+    Each reference is fully contained in a single chunk.
+    Only keeps the tax IDs in `tax_ids_to_keep` (if not None)."""
+
+    with gzip.open(path, "rb") as f:
+
+        if f.read(len(MAGIC)) != MAGIC:
+            raise MismatchFileError(f"{path} is not a valid bdamage file.")
+        (printlength,) = struct.unpack("<i", f.read(4))
+
+        dtype = get_record_dtype(printlength)
+        if chunk_size is None:
+            N_bytes = -1
+        else:
+            N_bytes = max(int(chunk_size * 1024**2) // dtype.itemsize, 1)
+            N_bytes *= dtype.itemsize
+
+        N_records = 0
+        while True:
+            data = f.read(N_bytes)
+            if len(data) == 0:
+                break
+            if len(data) % dtype.itemsize != 0:
+                raise MismatchFileError(f"{path} is truncated.")
+
+            records = np.frombuffer(data, dtype=dtype)
+            N_records += len(records)
+
+            tax_ids = get_tax_ids(records["id"], names)
+            if tax_ids_to_keep is not None:
+                mask = np.isin(tax_ids, list(tax_ids_to_keep))
+                records, tax_ids = records[mask], tax_ids[mask]
+
+            yield records_to_dataframe(records, tax_ids)
+
+    if N_records == 0:
+        raise MismatchFileError(f"{path} does not contain any data.")
+
+
+def read_bdamage(config: Config, tax_ids: Optional[set] = None) -> pd.DataFrame:
+    names = read_bam_reference_names(config["bam"])
+    return pd.concat(
+        iterate_bdamage(config["path_bdamage"], names, tax_ids_to_keep=tax_ids),
+        ignore_index=True,
+    )
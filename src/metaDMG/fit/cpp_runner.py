@@ -0,0 +1,163 @@
+#%%
+import asyncio
+import shlex
+import threading
+from collections import Counter
+from concurrent.futures import Future
+
+from logger_tt import logger
+
+from metaDMG.fit import mismatches, serial
+from metaDMG.utils import Config
+
+
+#%%
+
+
+def split_cores(N_cores: int, N_samples: int) -> int:
+    """The number of metaDMG-cpp threads per sample when `N_samples` samples
+    share `N_cores` cores (at least one each)."""
+    return max(N_cores // max(N_samples, 1), 1)
+
+
+async def run_command(config: Config, command: str) -> None:
+    """Run a metaDMG-cpp command as an asyncio subprocess, streaming its (merged)
+    output to the log like `serial.run_command_helper`, with the sample as prefix."""
+
+    process = await asyncio.create_subprocess_exec(
+        *shlex.split(command),
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.STDOUT,
+    )
+
+    # add a counter to avoid too many similar lines
+    counter = Counter()
+    prefix = f"{config['sample']} | "
+
+    try:
+        async for line in process.stdout:  # type: ignore
+            line = line.decode("utf-8").rstrip("\n")
+            if line:
+                serial.handle_line(config, line, counter, prefix=prefix)
+        returncode = await process.wait()
+
+    finally:
+        # e.g. if cancelled or if the alignment file is not sorted
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+
+    serial.handle_returncode(command, returncode, counter)
+
+
+async def run_cpp(config: Config, force: bool = False) -> None:
+    """The C++ stage of a sample, see `serial.run_cpp`."""
+
+    sample = config["sample"]
+
+    # the file system calls (e.g. fingerprinting or moving the output files) block,
+    # so they run in threads, such that the other C++ stages keep being supervised
+    if not await asyncio.to_thread(serial.do_run_cpp, config, force=force):
+        logger.info(f"{sample} | The C++ stage has already been run before.")
+        return
+
+    await asyncio.to_thread(serial.check_cpp_inputs, config)
+    logger.info(f"{sample} | Running the C++ stage. This can take a while.")
+
+    await asyncio.to_thread(serial.create_tmp_dir, config)
+
+    commands = serial.get_cpp_commands(config)
+    for i, command in enumerate(commands):
+        logger.debug(f"{sample} | {command}")
+        into_pipe = mismatches.uses_pipe(config) and i == len(commands) - 1
+        # other samples run in the same process, so only the wall time and bytes
+        with serial.get_cpp_stage(config, command, into_pipe, measure_process=False):
+            if into_pipe:
+                # the parsing of the pipe is CPU-bound, so it runs in a thread
+                await asyncio.to_thread(serial.run_command_into_pipe, config, command)
+            else:
+                await run_command(config, command)
+
+    # moves the output files and deletes the temporary directory
+    await asyncio.to_thread(serial.finish_cpp, config)
+    logger.info(f"{sample} | Finished the C++ stage.")
+
+
+#%%
+
+
+class CppRunner:
+    """Supervises the C++ stages (metaDMG-cpp processes) of many samples from a
+    single controller thread running an asyncio event loop, such that no worker
+    process is tied up waiting for metaDMG-cpp.
+
+    At most `max_jobs` C++ stages run at the same time. `submit` returns a
+    `concurrent.futures.Future` with the number of errors (0 or 1), which can be
+    waited for together with the futures of a process pool. Running metaDMG-cpp
+    processes are killed when the runner is closed.
+
+    The `N_cores` cores are split between the C++ stages when they start, such that
+    the last ones (with fewer jobs left) get more threads.
+    """
+
+    def __init__(self, max_jobs: int, N_cores: int):
+        self.max_jobs = max_jobs
+        self.N_cores = N_cores
+        # the number of submitted (and not yet finished) jobs
+        self.N_jobs = 0
+        self.lock = threading.Lock()
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(
+            target=self.loop.run_forever,
+            name="metaDMG-cpp",
+            daemon=True,
+        )
+        self.thread.start()
+        self.semaphore = self._call(self._make_semaphore())
+
+    def _call(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    async def _make_semaphore(self) -> asyncio.Semaphore:
+        # created inside the event loop, since it is bound to it in Python 3.9
+        return asyncio.Semaphore(self.max_jobs)
+
+    async def _run(self, config: Config, force: bool) -> int:
+        try:
+            async with self.semaphore:
+                N_threads = split_cores(self.N_cores, min(self.N_jobs, self.max_jobs))
+                config = Config(config, cpp_threads=N_threads)
+                await run_cpp(config, force=force)
+                return 0
+        except Exception:
+            logger.exception(
+                f"{config['sample']} | "
+                f"Error in the C++ stage. See log-file for more information."
+            )
+            return 1
+        finally:
+            with self.lock:
+                self.N_jobs -= 1
+
+    def submit(self, config: Config, force: bool = False) -> Future:
+        with self.lock:
+            self.N_jobs += 1
+        return asyncio.run_coroutine_threadsafe(self._run(config, force), self.loop)
+
+    async def _cancel_all(self) -> None:
+        tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def close(self) -> None:
+        self._call(self._cancel_all())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    def __enter__(self) -> "CppRunner":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
@@ -0,0 +1,158 @@
+#%%
+import json
+import os
+import uuid
+from pathlib import Path
+from typing import Iterable, Optional
+
+import joblib
+from logger_tt import logger
+
+from metaDMG.fit import fit_cache
+from metaDMG.utils import Config
+
+
+#%%
+
+# The stages of a sample, in order. Each stage saves a fingerprint of its inputs
+# when computed, and is only rerun if the fingerprint changed. The fingerprint
+# of a stage includes the one of the previous stage, such that a change propagates
+# to all the later stages.
+STAGES = ["cpp", "mismatches", "fit_results", "results"]
+
+# The version of the output of each stage. Increase it when the output of a stage
+# changes (e.g. its format), such that it (and all the later stages) are recomputed.
+STAGE_VERSIONS = {
+    "cpp": 1,
+    "mismatches": 1,
+    "fit_results": 1,
+    "results": 1,
+}
+
+# config keys that change the output of metaDMG-cpp
+CPP_KEYS = ["damage_mode", "max_position"]
+
+CPP_KEYS_LCA = [
+    "min_similarity_score",
+    "max_similarity_score",
+    "min_edit_dist",
+    "max_edit_dist",
+    "lca_rank",
+    "min_mapping_quality",
+    "weight_type",
+    "custom_database",
+]
+
+# input files of metaDMG-cpp, compared by size and modification time
+CPP_FILES = ["bam", "metaDMG_cpp"]
+CPP_FILES_LCA = ["names", "nodes", "acc2tax"]
+
+# config keys that change the parsed mismatches
+MISMATCHES_KEYS = ["forward_only"]
+
+# config keys that change the final results (apart from the fit results)
+RESULTS_KEYS = ["bayesian"]
+
+
+def get_path(config: Config, stage: str) -> Path:
+    return config["output_dir"] / "fingerprints" / f"{config['sample']}.{stage}.json"
+
+
+def get_file_stat(path) -> Optional[list]:
+    try:
+        stat = Path(path).stat()
+    except (FileNotFoundError, TypeError):
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+#%%
+
+
+def get_inputs(config: Config, stage: str) -> dict:
+    """The inputs of a single stage, excluding the previous stages."""
+
+    if stage == "cpp":
+        keys, files = CPP_KEYS, CPP_FILES
+        if config["damage_mode"] == "lca":
+            keys, files = keys + CPP_KEYS_LCA, files + CPP_FILES_LCA
+        inputs = {key: config.get(key) for key in keys}
+        inputs.update({key: get_file_stat(config.get(key)) for key in files})
+        return inputs
+
+    if stage == "mismatches":
+        return {key: config[key] for key in MISMATCHES_KEYS}
+
+    if stage == "fit_results":
+        return {
+            "settings": fit_cache.get_settings_hash(config),
+            "min_reads": config["min_reads"],
+        }
+
+    if stage == "results":
+        return {key: config[key] for key in RESULTS_KEYS}
+
+    raise AssertionError(f"Got wrong stage. Got: {stage}")
+
+
+def get_fingerprint(config: Config, stage: str) -> dict:
+
+    fingerprint = get_inputs(config, stage)
+    fingerprint["version"] = STAGE_VERSIONS[stage]
+
+    i = STAGES.index(stage)
+    if i > 0:
+        fingerprint["previous_stage"] = joblib.hash(
+            get_fingerprint(config, STAGES[i - 1])
+        )
+
+    # the same types as when loaded from the json file, e.g. no paths or tuples
+    return json.loads(json.dumps(fingerprint, default=str))
+
+
+def load(config: Config, stage: str) -> Optional[dict]:
+    try:
+        with open(get_path(config, stage), "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def save(config: Config, stage: str) -> None:
+    path = get_path(config, stage)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path_tmp = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+    with open(path_tmp, "w") as f:
+        json.dump(get_fingerprint(config, stage), f)
+    os.replace(path_tmp, path)
+
+
+def has_changed(config: Config, stage: str, outputs: Iterable) -> bool:
+    """Whether the inputs of the stage changed since it was last computed.
+
+    Outputs from before the fingerprints were introduced are assumed to be up to date,
+    and their fingerprint is saved, such that later changes are detected. If (any of)
+    the outputs do not exist, the fingerprint is only saved once they are computed.
+    """
+
+    fingerprint_saved = load(config, stage)
+    fingerprint = get_fingerprint(config, stage)
+
+    if fingerprint_saved is None:
+        if all(Path(path).exists() for path in outputs):
+            save(config, stage)
+        return False
+
+    if fingerprint_saved == fingerprint:
+        return False
+
+    changed = [
+        key
+        for key in fingerprint.keys() | fingerprint_saved.keys()
+        if fingerprint.get(key) != fingerprint_saved.get(key)
+    ]
+    logger.info(
+        f"The inputs of the {stage} stage changed ({', '.join(sorted(changed))}), "
+        "recomputing it."
+    )
+    return True
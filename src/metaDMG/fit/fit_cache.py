@@ -0,0 +1,188 @@
+#%%
+import os
+import pickle
+import uuid
+from pathlib import Path
+from typing import Optional, Union
+
+import joblib
+import numpy as np
+import pandas as pd
+from logger_tt import logger
+
+from metaDMG.__version__ import __version__
+from metaDMG.fit import fit_utils
+from metaDMG.utils import Config
+
+
+#%%
+
+# config keys that change the outcome of a single fit
+FIT_SETTINGS_KEYS = ["max_position", "forward_only", "bayesian"]
+
+
+def get_fit_settings(config: Config) -> dict:
+    settings = {key: config[key] for key in FIT_SETTINGS_KEYS}
+    settings["priors"] = fit_utils.get_priors()
+    settings["version"] = __version__
+    return settings
+
+
+def get_settings_hash(config: Config) -> str:
+    return joblib.hash(get_fit_settings(config))
+
+
+def get_group_key(group: pd.DataFrame, settings_hash: str) -> str:
+    # hash the counts as float64, such that the key does not depend on the dtypes
+    # of the mismatch file (e.g. integer counts or the downcasted float32 counts)
+    counts = group[["position", *fit_utils.ref_obs_bases]].to_numpy(dtype=np.float64)
+    return joblib.hash((counts, settings_hash))
+
+
+#%%
+
+
+class FitCache:
+    """Content-addressed disk cache of single tax ID fit results.
+
+    The fit results are keyed by a hash of the mismatch counts and the fit settings
+    (see `get_fit_settings`), such that identical groups are only fitted once across
+    samples and runs. Entries are written atomically, so several samples can share
+    the same cache directory. The least recently used entries are evicted when the
+    cache grows larger than `max_size` (in MB).
+
+    The size of the cache is only scanned once (on the first store) and then counted
+    while storing, such that the directory is only scanned again when evicting.
+    The entries stored by other processes are not counted until then.
+    """
+
+    def __init__(self, cache_dir: Union[Path, str], max_size: float = 1000):
+        self.cache_dir = Path(cache_dir)
+        self.max_size = max_size
+        self.size = None
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / f"{key}.pkl"
+
+    def get(self, key: str) -> Optional[dict]:
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                fit_result = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return None
+
+        # mark as recently used (for the LRU eviction)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+
+        return fit_result
+
+    def set(self, key: str, fit_result: dict) -> int:
+        """Store the fit result, returning the size of the entry in bytes."""
+
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        # write to a unique temporary file first and then atomically move it in place
+        path_tmp = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+        with open(path_tmp, "wb") as f:
+            pickle.dump(fit_result, f, protocol=pickle.HIGHEST_PROTOCOL)
+            size = f.tell()
+        os.replace(path_tmp, path)
+        return size
+
+    def get_max_bytes(self) -> float:
+        return self.max_size * 1024**2
+
+    def get_entries(self) -> list:
+        """The (modification time, size, path) of all the entries in the cache."""
+
+        entries = []
+        for path in self.cache_dir.glob("*/*.pkl"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def evict(self) -> None:
+        max_bytes = self.get_max_bytes()
+
+        entries = self.get_entries()
+        total_size = sum(size for _, size, _ in entries)
+        self.size = total_size
+
+        if total_size <= max_bytes:
+            return
+
+        # remove the least recently used entries until below 90% of the max size
+        N_removed = 0
+        for _, size, path in sorted(entries):
+            if total_size <= 0.9 * max_bytes:
+                break
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            total_size -= size
+            N_removed += 1
+
+        self.size = total_size
+        logger.debug(f"Evicted {N_removed} entries from the fit cache.")
+
+    def lookup(self, config: Config, df_mismatches: pd.DataFrame):
+        """Find the cached fit results for the tax IDs in df_mismatches.
+
+        Returns
+        -------
+            A dict of the cached fit results (by tax ID) and a dict of the cache keys
+            for all the tax IDs.
+        """
+
+        settings_hash = get_settings_hash(config)
+
+        d_fit_results = {}
+        d_keys = {}
+        groupby = df_mismatches.groupby("tax_id", sort=False, observed=True)
+        for tax_id, group in groupby:
+            key = get_group_key(group, settings_hash)
+            d_keys[tax_id] = key
+            fit_result = self.get(key)
+            if fit_result is not None:
+                d_fit_results[tax_id] = fit_result
+
+        return d_fit_results, d_keys
+
+    def store(self, d_fit_results: dict, d_keys: dict) -> None:
+        if self.size is None:
+            self.size = sum(size for _, size, _ in self.get_entries())
+
+        for tax_id, fit_result in d_fit_results.items():
+            if tax_id in d_keys:
+                self.size += self.set(d_keys[tax_id], fit_result)
+
+        if self.size > self.get_max_bytes():
+            self.evict()
+
+
+# The fit caches of this process, such that the size of the cache is kept between
+# the samples
+_fit_caches = {}
+
+
+def get_fit_cache(config: Config) -> Optional[FitCache]:
+    if not config.get("fit_cache_dir"):
+        return None
+
+    key = (str(config["fit_cache_dir"]), config["fit_cache_max_size"])
+    if key not in _fit_caches:
+        _fit_caches[key] = FitCache(
+            config["fit_cache_dir"],
+            max_size=config["fit_cache_max_size"],
+        )
+    return _fit_caches[key]
@@ -0,0 +1,145 @@
+#%%
+import json
+import os
+import pickle
+import time
+import uuid
+from pathlib import Path
+from typing import Optional
+
+from logger_tt import logger
+
+from metaDMG import utils
+from metaDMG.fit import fit_cache
+from metaDMG.utils import Config
+
+
+#%%
+
+
+def get_checkpoint_dir(config: Config) -> Path:
+    return config["output_dir"] / "fit_checkpoints" / config["sample"]
+
+
+def get_checkpoint_fingerprint(config: Config) -> dict:
+    """The fit settings and the mismatch file that the checkpointed fits are based on.
+    A checkpoint with a different fingerprint is stale and is discarded."""
+
+    from metaDMG.fit.serial import get_mismatches_target
+
+    path_mismatches = get_mismatches_target(config)
+    try:
+        stat = path_mismatches.stat()
+        mismatches = [stat.st_size, stat.st_mtime_ns]
+    except FileNotFoundError:
+        mismatches = None
+
+    return {
+        "settings": fit_cache.get_settings_hash(config),
+        "min_reads": config["min_reads"],
+        "mismatches": mismatches,
+    }
+
+
+#%%
+
+
+class FitCheckpoint:
+    """Append-only, per-sample store of fit results, allowing a killed run to resume.
+
+    The fit results are buffered and flushed to a new part file every `N_taxa`
+    tax IDs or `seconds` seconds, whichever comes first. Part files are written
+    atomically, so a checkpoint is never corrupted by killing the process while
+    flushing. The checkpoint is removed when the final fit results have been saved.
+    """
+
+    def __init__(self, config: Config, N_taxa: int = 1000, seconds: float = 300):
+        self.path = get_checkpoint_dir(config)
+        self.fingerprint = get_checkpoint_fingerprint(config)
+        self.N_taxa = N_taxa
+        self.seconds = seconds
+        self.buffer = {}
+        self.time_last_flush = time.time()
+
+    @property
+    def path_meta(self) -> Path:
+        return self.path / "meta.json"
+
+    def _is_valid(self) -> bool:
+        try:
+            with open(self.path_meta, "r") as f:
+                fingerprint = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return False
+        return fingerprint == self.fingerprint
+
+    def _initialise(self) -> None:
+        self.path.mkdir(parents=True, exist_ok=True)
+        with open(self.path_meta, "w") as f:
+            json.dump(self.fingerprint, f)
+
+    def load(self) -> dict:
+        """Load the checkpointed fit results (by tax ID).
+        Stale checkpoints (different fit settings or mismatches) are discarded."""
+
+        if not self._is_valid():
+            if self.path.exists():
+                logger.debug(f"Discarding the stale fit checkpoint in {self.path}.")
+            self.remove()
+            return {}
+
+        d_fit_results = {}
+        for path in sorted(self.path.glob("part-*.pkl")):
+            try:
+                with open(path, "rb") as f:
+                    d_fit_results.update(pickle.load(f))
+            except (EOFError, pickle.UnpicklingError):
+                logger.debug(f"Skipping the corrupt fit checkpoint part {path}.")
+
+        return d_fit_results
+
+    def add(self, d_fit_results: dict) -> None:
+        self.buffer.update(d_fit_results)
+        too_many = len(self.buffer) >= self.N_taxa
+        too_old = time.time() - self.time_last_flush >= self.seconds
+        if too_many or too_old:
+            self.flush()
+
+    def flush(self) -> None:
+        self.time_last_flush = time.time()
+        if len(self.buffer) == 0:
+            return
+
+        if not self.path_meta.exists():
+            self._initialise()
+
+        # time-ordered names, such that newer parts take precedence when loading
+        name = f"part-{time.time_ns()}-{uuid.uuid4().hex[:8]}.pkl"
+        path = self.path / name
+        path_tmp = path.with_name(f".{name}.tmp")
+        with open(path_tmp, "wb") as f:
+            pickle.dump(self.buffer, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path_tmp, path)
+
+        logger.debug(f"Checkpointed {len(self.buffer)} fit results.")
+        self.buffer = {}
+
+    def remove(self) -> None:
+        self.buffer = {}
+        utils.remove_directory(self.path, missing_ok=True)
+
+        # also remove the parent directory if this was the last checkpoint
+        try:
+            self.path.parent.rmdir()
+        except OSError:
+            pass
+
+
+def get_fit_checkpoint(config: Config) -> Optional[FitCheckpoint]:
+    if not config.get("checkpoint"):
+        return None
+    return FitCheckpoint(
+        config,
+        N_taxa=config["checkpoint_every_N_taxa"],
+        seconds=config["checkpoint_every_seconds"],
+    )
@@ -80,7 +80,10 @@ def downcast_dataframe(df, categories=None, fully_automatic=False):
     d_categories = {category: "category" for category in categories}
     df2 = df.astype(d_categories)
 
-    int_cols = df2.select_dtypes(include=["integer"]).columns
+    # the tax IDs are identifiers, not counts, and are kept as they are
+    int_cols = df2.select_dtypes(include=["integer"]).columns.drop(
+        "tax_id", errors="ignore"
+    )
 
     int_type = "uint32"
     if df2[int_cols].max().max() > np.iinfo("uint32").max:
@@ -14,8 +14,17 @@ from tqdm.rich import tqdm
 from tqdm.std import TqdmExperimentalWarning
 
 from metaDMG.errors import BadDataError, FittingError
-from metaDMG.fit import bayesian, fit_utils, frequentist
+from metaDMG.fit import (
+    bayesian,
+    fit_cache,
+    fit_checkpoint,
+    fit_utils,
+    frequentist,
+    profiling,
+    trace,
+)
 from metaDMG.fit.mismatches import add_reference_count
+from metaDMG.fit.stats import cut_minimum_reads, read_stats
 from metaDMG.utils import Config
 
 
@@ -27,6 +36,10 @@ numpyro.enable_x64()
 
 BAYESIAN_MAXIMUM_SIZE = 100
 
+# maximum number of tax IDs in a MAP fit chunk when the fit results are needed along
+# the way (for checkpoints and partial results) and not only at the end
+MAP_CHUNK_SIZE = 100
+
 #%%
 
 # XXX Works, but should be a better way
@@ -201,7 +214,12 @@ def fit_single_group(
     return fit_result
 
 
-def compute_fits_seriel(config, df_mismatches, with_progressbar=False):
+def compute_fits_seriel(
+    config,
+    df_mismatches,
+    with_progressbar=False,
+    writers=(),
+):
 
     # Do not initialise MCMC if config["bayesian"] is False
     mcmm = bayesian.init_mcmc(config)
@@ -227,17 +245,31 @@ def compute_fits_seriel(config, df_mismatches, with_progressbar=False):
 
         if res is not None:
             d_fit_results[tax_id] = res
+            add_to_writers(writers, {tax_id: res})
 
     return d_fit_results
 
 
 def compute_fits_parallel_worker(df_mismatches_config):
     df_mismatches, config, with_progressbar = df_mismatches_config
-    return compute_fits_seriel(
-        config=config,
-        df_mismatches=df_mismatches,
-        with_progressbar=with_progressbar,
-    )
+    N_tax_ids = df_mismatches["tax_id"].nunique()
+    span = trace.span(config, "fit_chunk", category="fit", N_tax_ids=N_tax_ids)
+    with span, profiling.profile(config, "fit"):
+        return compute_fits_seriel(
+            config=config,
+            df_mismatches=df_mismatches,
+            with_progressbar=with_progressbar,
+        )
+
+
+def add_to_writers(writers, d_fit_results):
+    for writer in writers:
+        writer.add(d_fit_results)
+
+
+def flush_writers(writers):
+    for writer in writers:
+        writer.flush()
 
 
 def grouper(iterable, n):
@@ -260,6 +292,25 @@ def use_progressbar(config, position):
     return False
 
 
+def split_by_tax_ids(df_mismatches_unique, tax_ids, N_splits):
+    """Split df_mismatches_unique into N_splits chunks of (about) equally many tax IDs.
+
+    The rows are sorted once by the order of the tax IDs (keeping the order of the
+    rows within each tax ID), such that each chunk is a slice of the sorted dataframe.
+    """
+
+    codes = pd.Categorical(df_mismatches_unique["tax_id"], categories=tax_ids).codes
+    order = np.argsort(codes, kind="stable")
+    df_mismatches_unique = df_mismatches_unique.iloc[order]
+
+    sizes = [len(chunk) for chunk in np.array_split(np.arange(len(tax_ids)), N_splits)]
+    bounds = np.searchsorted(codes[order], np.cumsum(sizes))
+    starts = [0, *bounds[:-1]]
+    return [
+        df_mismatches_unique.iloc[start:stop] for start, stop in zip(starts, bounds)
+    ]
+
+
 def get_list_of_groups(
     config,
     df_mismatches_unique,
@@ -275,31 +326,32 @@ def get_list_of_groups(
             len(tax_ids) / cores_per_sample / N_maximum_group_size
         )
 
-    tax_id_list = np.array_split(tax_ids, N_splits)
-
     dfs = []
-    for position, tax_ids in enumerate(tax_id_list):
-        dfs.append(
-            (
-                df_mismatches_unique.query(f"tax_id in {list(tax_ids)}"),
-                config,
-                use_progressbar(config, position),
-            )
-        )
+    for position, group in enumerate(
+        split_by_tax_ids(df_mismatches_unique, tax_ids, N_splits)
+    ):
+        dfs.append((group, config, use_progressbar(config, position)))
     return dfs
 
 
 def compute_fits_parallel(
     config,
     df_mismatches_unique,
+    writers=(),
 ):
 
     cores_per_sample = config["cores_per_sample"]
 
+    N_splits = cores_per_sample
+    if len(writers) > 0 or config["fit_order"]:
+        # use smaller chunks, such that the fit results are available along the way
+        N_tax_ids = df_mismatches_unique["tax_id"].nunique()
+        N_splits = max(N_splits, ceil(N_tax_ids / MAP_CHUNK_SIZE))
+
     dfs = get_list_of_groups(
         config,
         df_mismatches_unique,
-        N_splits=cores_per_sample,
+        N_splits=N_splits,
     )
 
     d_fit_results = {}
@@ -309,6 +361,7 @@ def compute_fits_parallel(
             dfs,
         ):
             d_fit_results.update(d_fit_results_)
+            add_to_writers(writers, d_fit_results_)
 
     return d_fit_results
 
@@ -317,6 +370,7 @@ def compute_fits_parallel_Bayesian(
     config,
     df_mismatches_unique,
     N_maximum_group_size=BAYESIAN_MAXIMUM_SIZE,
+    writers=(),
 ):
 
     cores_per_sample = config["cores_per_sample"]
@@ -335,6 +389,7 @@ def compute_fits_parallel_Bayesian(
             config,
             df_mismatches_unique,
             with_progressbar=do_progressbar,
+            writers=writers,
         )
         return d_fit_results
 
@@ -355,6 +410,7 @@ def compute_fits_parallel_Bayesian(
                 dfs,
             ):
                 d_fit_results.update(d_fit_results_)
+                add_to_writers(writers, d_fit_results_)
         return d_fit_results
 
     it = grouper(dfs, cores_per_sample)
@@ -375,6 +431,7 @@ def compute_fits_parallel_Bayesian(
                 dfs_,
             ):
                 d_fit_results.update(d_fit_results_)
+                add_to_writers(writers, d_fit_results_)
 
     return d_fit_results
 
@@ -444,82 +501,6 @@ def split(strng, sep, pos):
 #%%
 
 
-def read_stats_lca(config: Config):
-
-    import gzip
-    from io import StringIO
-
-    columns = [
-        "tax_id",
-        "tax_name",
-        "tax_rank",
-        "N_alignments",
-        "N_reads",
-        "mean_L",
-        "var_L",
-        "mean_GC",
-        "var_GC",
-        "tax_path",
-    ]
-
-    # TODO: remove when Thorfinn updates his code
-    with gzip.open(config["path_mismatches_stat"], "rt") as f:
-        data = f.read()
-
-    data = data.replace("'", "")  # remove '
-    data = data.replace("\t\t", "\t'")
-    data = data.replace('1:root:"no rank"', """1:root:"no rank"'""")
-
-    string_columns = ["tax_id", "tax_name", "tax_rank", "tax_path"]
-
-    df_stats = pd.read_csv(
-        StringIO(data),  # config["path_mismatches_stat"]
-        sep="\t",
-        skiprows=1,
-        index_col=False,
-        quotechar="'",
-        names=columns,
-        dtype={column: "string" for column in string_columns},
-    )
-
-    for column in ("tax_name", "tax_rank"):
-        df_stats[column] = df_stats[column].str.replace('"', "")
-
-    df_stats["std_L"] = np.sqrt(df_stats["var_L"])
-    df_stats["std_GC"] = np.sqrt(df_stats["var_GC"])
-    return df_stats
-
-
-def read_stats_non_lca(config: Config):
-
-    columns = ["tax_id", "N_reads", "mean_L", "var_L", "mean_GC", "var_GC"]
-
-    df_stats = pd.read_csv(
-        config["path_mismatches_stat"],
-        sep="\t",
-        names=columns,
-        usecols=columns,
-    )
-
-    df_stats["std_L"] = np.sqrt(df_stats["var_L"])
-    df_stats["std_GC"] = np.sqrt(df_stats["var_GC"])
-    return df_stats
-
-
-def read_stats(config: Config):
-    if config["damage_mode"] == "lca":
-        return read_stats_lca(config)
-    else:
-        return read_stats_non_lca(config)
-
-
-def cut_minimum_reads(
-    config: Config,
-    df_stats: pd.DataFrame,
-) -> pd.DataFrame:
-    return df_stats.query(f"(N_reads >= {config['min_reads']})")
-
-
 def filter_tax_ids(
     config: Config,
     df_stats: pd.DataFrame,
@@ -565,7 +546,45 @@ def filter_max_N_in_group(
 #%%
 
 
-def compute(config, df_mismatches):
+def read_tax_ids_list(path) -> list[str]:
+    with open(path, "r") as f:
+        tax_ids = [line.strip() for line in f]
+    return [tax_id for tax_id in tax_ids if tax_id != "" and not tax_id.startswith("#")]
+
+
+def order_tax_ids(config, df_mismatches, df_stat_cut):
+    """Order the tax IDs in df_mismatches according to `fit_order`:
+    either "N_reads" (descending number of reads) or the path to a file with a
+    list of tax IDs (one per line), which are then fitted first.
+    """
+
+    fit_order = config["fit_order"]
+    if not fit_order or len(df_mismatches) == 0:
+        return df_mismatches
+
+    N_reads = dict(zip(df_stat_cut["tax_id"].astype(str), df_stat_cut["N_reads"]))
+    tax_ids = sorted(
+        df_mismatches["tax_id"].unique(),
+        key=lambda tax_id: -N_reads.get(str(tax_id), 0),
+    )
+
+    if fit_order != "N_reads":
+        tax_ids_first = read_tax_ids_list(fit_order)
+        rank = {tax_id: i for i, tax_id in enumerate(tax_ids_first)}
+        tax_ids = sorted(tax_ids, key=lambda tax_id: rank.get(str(tax_id), len(rank)))
+
+    codes = pd.Categorical(df_mismatches["tax_id"], categories=tax_ids).codes
+    return df_mismatches.iloc[np.argsort(codes, kind="stable")]
+
+
+def prepare_fits(config, df_mismatches):
+    """Filter the mismatches and find the tax IDs that actually need to be fitted.
+
+    Returns
+    -------
+        A dict with the stats, the duplicates, the cached fit results, and
+        `df_mismatches_unique`, the dataframe of the tax IDs to fit.
+    """
 
     df_stats = read_stats(config)
     df_stat_cut = cut_minimum_reads(config, df_stats)
@@ -606,36 +625,67 @@ def compute(config, df_mismatches):
         f"only fit the {len(unique)} unique ones."
     )
 
-    df_mismatches_unique = df_mismatches.query(f"tax_id in {unique}")
+    df_mismatches_unique = df_mismatches.query("tax_id in @unique")
+
+    # only fit the tax IDs that have not been fitted before (in any sample or run)
+    d_fit_results_cached = {}
+    d_cache_keys = {}
+    cache = fit_cache.get_fit_cache(config)
+    if cache is not None:
+        d_fit_results_cached, d_cache_keys = cache.lookup(config, df_mismatches_unique)
+        logger.debug(
+            f"Found {len(d_fit_results_cached)} of the {len(unique)} unique tax IDs "
+            f"in the fit cache."
+        )
+        tax_ids_cached = list(d_fit_results_cached.keys())
+        df_mismatches_unique = df_mismatches_unique.query(
+            "tax_id not in @tax_ids_cached"
+        )
+
+    # resume from the fit results checkpointed by a previous (interrupted) run
+    d_fit_results_checkpoint = {}
+    checkpoint = fit_checkpoint.get_fit_checkpoint(config)
+    if checkpoint is not None:
+        d_fit_results_checkpoint = checkpoint.load()
+        if len(d_fit_results_checkpoint) > 0:
+            logger.info(
+                f"Resuming from {len(d_fit_results_checkpoint)} checkpointed fits."
+            )
+            tax_ids_checkpoint = list(d_fit_results_checkpoint.keys())
+            df_mismatches_unique = df_mismatches_unique.query(
+                "tax_id not in @tax_ids_checkpoint"
+            )
 
-    if config["bayesian"]:
-        # logger.debug(f"Computing Bayesian fits")
-        d_fit_results = compute_fits_parallel_Bayesian(config, df_mismatches_unique)
+    # fit the most important tax IDs first
+    df_mismatches_unique = order_tax_ids(config, df_mismatches_unique, df_stat_cut)
 
-    else:
-        if config["cores_per_sample"] == 1:
-            logger.debug(f"Fitting in seriel.")
+    return {
+        "df_stat_cut": df_stat_cut,
+        "duplicates": duplicates,
+        "d_fit_results_cached": d_fit_results_cached,
+        "d_fit_results_checkpoint": d_fit_results_checkpoint,
+        "d_cache_keys": d_cache_keys,
+        "df_mismatches_unique": df_mismatches_unique,
+    }
 
-            if config["parallel_samples"] == 1 or len(config["samples"]) == 1:
-                with_progressbar = True
-            else:
-                with_progressbar = False
 
-            d_fit_results = compute_fits_seriel(
-                config,
-                df_mismatches_unique,
-                with_progressbar=with_progressbar,
-            )
+def finalize_fits(config, fit_plan, d_fit_results, df_mismatches):
+    """Combine the fit results of `fit_plan` into the final fit results dataframe."""
 
-        else:
-            s = f"Fitting in parallel with {config['cores_per_sample']} cores."
-            logger.debug(s)
-            d_fit_results = compute_fits_parallel(
-                config,
-                df_mismatches_unique,
-            )
+    d_fit_results.update(fit_plan["d_fit_results_checkpoint"])
+
+    cache = fit_cache.get_fit_cache(config)
+    if cache is not None:
+        cache.store(d_fit_results, fit_plan["d_cache_keys"])
+    d_fit_results.update(fit_plan["d_fit_results_cached"])
+
+    de_duplicate_fit_results(d_fit_results, fit_plan["duplicates"])
 
-    de_duplicate_fit_results(d_fit_results, duplicates)
+    return make_df_fit_results(config, fit_plan, d_fit_results, df_mismatches)
+
+
+def make_df_fit_results(config, fit_plan, d_fit_results, df_mismatches):
+    """Make the fit results dataframe (including the stats) of d_fit_results."""
 
     df_fit_results = make_df_fit_results_from_fit_results(
         config,
@@ -643,7 +693,7 @@ def compute(config, df_mismatches):
         df_mismatches,
     )
 
-    df_fit_results = pd.merge(df_fit_results, df_stat_cut, on="tax_id")
+    df_fit_results = pd.merge(df_fit_results, fit_plan["df_stat_cut"], on="tax_id")
 
     prefix = "" if config["bayesian"] else "MAP_"
     cols_ordered = [
@@ -675,5 +725,66 @@ def compute(config, df_mismatches):
     return df_fit_results
 
 
+def get_writers(config, fit_plan, df_mismatches, submit=None) -> list:
+    """The writers that receive the fit results while fitting,
+    i.e. the fit checkpoint and the partial results (see `PartialResults` for
+    `df_mismatches` and `submit`)."""
+
+    from metaDMG.fit.partial_results import get_partial_results
+
+    writers = [
+        fit_checkpoint.get_fit_checkpoint(config),
+        get_partial_results(config, fit_plan, df_mismatches, submit),
+    ]
+    return [writer for writer in writers if writer is not None]
+
+
+def compute(config, df_mismatches):
+
+    fit_plan = prepare_fits(config, df_mismatches)
+    df_mismatches_unique = fit_plan["df_mismatches_unique"]
+    writers = get_writers(config, fit_plan, df_mismatches)
+
+    if len(df_mismatches_unique) == 0:
+        d_fit_results = {}
+
+    elif config["bayesian"]:
+        # logger.debug(f"Computing Bayesian fits")
+        d_fit_results = compute_fits_parallel_Bayesian(
+            config,
+            df_mismatches_unique,
+            writers=writers,
+        )
+
+    else:
+        if config["cores_per_sample"] == 1:
+            logger.debug(f"Fitting in seriel.")
+
+            if config["parallel_samples"] == 1 or len(config["samples"]) == 1:
+                with_progressbar = True
+            else:
+                with_progressbar = False
+
+            d_fit_results = compute_fits_seriel(
+                config,
+                df_mismatches_unique,
+                with_progressbar=with_progressbar,
+                writers=writers,
+            )
+
+        else:
+            s = f"Fitting in parallel with {config['cores_per_sample']} cores."
+            logger.debug(s)
+            d_fit_results = compute_fits_parallel(
+                config,
+                df_mismatches_unique,
+                writers=writers,
+            )
+
+    flush_writers(writers)
+
+    return finalize_fits(config, fit_plan, d_fit_results, df_mismatches)
+
+
 # %%
 #
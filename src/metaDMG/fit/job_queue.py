@@ -0,0 +1,402 @@
+#%%
+import json
+import os
+import pickle
+import shutil
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime
+from multiprocessing import current_process
+from pathlib import Path
+from typing import Callable, Optional
+
+from logger_tt import logger
+
+from metaDMG.errors import QueueError
+from metaDMG.fit import manifest, profiling, trace
+from metaDMG.fit.autotune import resolve_auto
+from metaDMG.fit.serial import run_single_config_count_errors
+from metaDMG.utils import Config, Configs
+
+
+#%%
+
+# A job queue on a shared filesystem, such that any number of workers (on any node)
+# can run the samples. The queue directory contains the configs and a file per job
+# (sample), which is moved between the states with atomic renames:
+#
+#   configs.pkl
+#   jobs/pending/{sample}.json
+#   jobs/running/{worker}/{sample}.json  (claimed by a worker)
+#   jobs/done/{sample}.json
+#   jobs/failed/{sample}.json
+#   jobs/retry/{sample}.json.{uuid}  (being released by a worker)
+#
+# A claimed job is leased to the worker, which touches the job file while running it
+# (the heartbeat). Jobs whose lease expired (e.g. the node died) and failed jobs are
+# moved back to pending, or to failed after `queue_max_attempts` attempts.
+# Jobs left in retry by a worker that died while releasing them are moved on once
+# their lease expired as well.
+# The first worker to find all the jobs done or failed merges the run manifests, traces and
+# profiles and writes summary.json.
+
+STATES = ["pending", "running", "done", "failed", "retry"]
+
+# The number of heartbeats within a lease
+HEARTBEATS_PER_LEASE = 10
+
+# How often (in seconds) an idle worker checks for new or expired jobs
+POLL_SECONDS = 10
+
+
+def get_dir(queue_dir: Path, state: str) -> Path:
+    return Path(queue_dir) / "jobs" / state
+
+
+def get_worker_id() -> str:
+    return f"{socket.gethostname()}.{os.getpid()}.{uuid.uuid4().hex[:6]}"
+
+
+def _write_json(path: Path, data: dict) -> None:
+    path_tmp = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+    with open(path_tmp, "w") as f:
+        json.dump(data, f)
+    os.replace(path_tmp, path)
+
+
+def _update_json(path: Path, data: dict) -> bool:
+    """Replace the file, unless it was moved (e.g. released by another worker)
+    in the meantime, in which case it is not written again and False is returned."""
+
+    path_tmp = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+    with open(path_tmp, "w") as f:
+        json.dump(data, f)
+
+    # the old file is moved away first, which fails if it is gone
+    path_old = path.with_name(f".{path.name}.{uuid.uuid4().hex}.old")
+    try:
+        os.rename(path, path_old)
+    except FileNotFoundError:
+        os.remove(path_tmp)
+        return False
+    os.rename(path_tmp, path)
+    os.remove(path_old)
+    return True
+
+
+def _load_json(path: Path) -> dict:
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def get_jobs(queue_dir: Path, state: str) -> list[Path]:
+    if state == "running":
+        return sorted(get_dir(queue_dir, state).glob("*/*.json"))
+    if state == "retry":
+        paths = get_dir(queue_dir, state).glob("*.json.*")
+        # not the temporary files of `_write_json`
+        return sorted(path for path in paths if not path.name.startswith("."))
+    return sorted(get_dir(queue_dir, state).glob("*.json"))
+
+
+def is_finished(queue_dir: Path, configs: Configs) -> bool:
+    """Whether all the jobs are done or failed. Since these are the final states,
+    this does not depend on the order in which the job files are listed."""
+    N_jobs = len(get_jobs(queue_dir, "done")) + len(get_jobs(queue_dir, "failed"))
+    return N_jobs >= len(configs["samples"])
+
+
+#%%
+
+
+def enqueue(configs: Configs, queue_dir: Path) -> int:
+    """Add a job for each sample to the queue, replacing a finished queue.
+
+    Returns
+    -------
+        The number of jobs.
+    """
+
+    queue_dir = Path(queue_dir)
+    if any(get_jobs(queue_dir, state) for state in ["pending", "running", "retry"]):
+        raise QueueError(f"The queue {queue_dir} still has unfinished jobs.")
+
+    shutil.rmtree(queue_dir / "jobs", ignore_errors=True)
+    (queue_dir / "merged").unlink(missing_ok=True)
+    (queue_dir / "summary.json").unlink(missing_ok=True)
+    for state in STATES:
+        get_dir(queue_dir, state).mkdir(parents=True, exist_ok=True)
+
+    with open(queue_dir / "configs.pkl", "wb") as f:
+        pickle.dump(configs, f)
+
+    manifest.start(configs)
+    trace.start(configs)
+    profiling.start(configs)
+
+    enqueued = time.time()
+    for config in configs:
+        job = {"sample": config["sample"], "attempts": 0, "enqueued": enqueued}
+        _write_json(get_dir(queue_dir, "pending") / f"{config['sample']}.json", job)
+
+    return len(configs["samples"])
+
+
+def load_configs(
+    queue_dir: Path,
+    log_port: Optional[int] = None,
+    log_path: Optional[str] = None,
+) -> Configs:
+    """The configs of the queue, logging to the logger of this worker."""
+
+    try:
+        with open(Path(queue_dir) / "configs.pkl", "rb") as f:
+            configs = pickle.load(f)
+    except FileNotFoundError:
+        raise QueueError(f"{queue_dir} is not a metaDMG queue.")
+
+    configs["log_port"] = log_port
+    configs["log_path"] = log_path
+    # e.g. `cores_per_sample: auto` is resolved on each node
+    resolve_auto(configs)
+    return configs
+
+
+#%%
+
+
+def claim(queue_dir: Path, worker: str) -> Optional[Path]:
+    """Claim the next pending job, if any. Only a single worker can move (rename)
+    a job file, so a job is never claimed twice."""
+
+    path_worker = get_dir(queue_dir, "running") / worker
+    path_worker.mkdir(parents=True, exist_ok=True)
+
+    for path in get_jobs(queue_dir, "pending"):
+        path_running = path_worker / path.name
+        try:
+            # starts the lease (kept by the rename), such that the job is not
+            # recovered as expired before it is updated below
+            os.utime(path)
+            os.rename(path, path_running)
+        except FileNotFoundError:
+            # claimed by another worker in the meantime
+            continue
+
+        try:
+            job = _load_json(path_running)
+        except FileNotFoundError:
+            # released by another worker in the meantime
+            continue
+
+        job["attempts"] += 1
+        job["worker"] = worker
+        job["claimed"] = time.time()
+        if not _update_json(path_running, job):
+            continue
+        return path_running
+
+    return None
+
+
+def release(queue_dir: Path, path: Path, max_attempts: int, reason: str) -> bool:
+    """Move a claimed job back to pending, or to failed after `max_attempts`.
+
+    Returns
+    -------
+        False if the job was already moved by another worker.
+    """
+
+    # first moved out of the running jobs, such that only one worker releases it
+    path_retry = get_dir(queue_dir, "retry") / f"{path.name}.{uuid.uuid4().hex}"
+    try:
+        os.rename(path, path_retry)
+    except FileNotFoundError:
+        return False
+
+    job = _load_json(path_retry)
+    job.setdefault("errors", []).append(reason)
+    state = get_release_state(job, max_attempts)
+    _write_json(path_retry, job)
+    os.rename(path_retry, get_dir(queue_dir, state) / path.name)
+
+    logger.info(f"{job['sample']} | {reason}, moved the job to {state}.")
+    return True
+
+
+def get_release_state(job: dict, max_attempts: int) -> str:
+    return "failed" if job["attempts"] >= max_attempts else "pending"
+
+
+def complete(queue_dir: Path, path: Path) -> bool:
+    try:
+        os.rename(path, get_dir(queue_dir, "done") / path.name)
+        return True
+    except FileNotFoundError:
+        return False
+
+
+def get_age(path: Path) -> Optional[float]:
+    try:
+        return time.time() - path.stat().st_mtime
+    except FileNotFoundError:
+        return None
+
+
+def recover_expired(queue_dir: Path, lease_seconds: float, max_attempts: int) -> None:
+    """Release the jobs whose lease expired, i.e. without a recent heartbeat,
+    and finish the releases of workers that died while releasing a job."""
+
+    for path in get_jobs(queue_dir, "running"):
+        age = get_age(path)
+        if age is not None and age > lease_seconds:
+            reason = f"The lease of {path.parent.name} expired"
+            release(queue_dir, path, max_attempts, reason)
+
+    # a release only takes a moment, so these were left by a dead worker
+    for path in get_jobs(queue_dir, "retry"):
+        age = get_age(path)
+        if age is None or age <= lease_seconds:
+            continue
+
+        try:
+            job = _load_json(path)
+        except FileNotFoundError:
+            # recovered by another worker in the meantime
+            continue
+
+        state = get_release_state(job, max_attempts)
+        name = path.name.rsplit(".", 1)[0]
+        try:
+            os.rename(path, get_dir(queue_dir, state) / name)
+        except FileNotFoundError:
+            continue
+        logger.info(
+            f"{job['sample']} | The release of the job was interrupted, "
+            f"moved the job to {state}."
+        )
+
+
+class Heartbeat:
+    """Touches the file of a claimed job in a thread, renewing the lease."""
+
+    def __init__(self, path: Path, interval: float):
+        self.path = path
+        self.interval = interval
+        self.lost = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._beat, daemon=True)
+
+    def _beat(self) -> None:
+        while not self.stopped.wait(self.interval):
+            try:
+                os.utime(self.path)
+            except FileNotFoundError:
+                # released by another worker
+                self.lost = True
+                return
+
+    def __enter__(self) -> "Heartbeat":
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.stopped.set()
+        self.thread.join()
+
+
+#%%
+
+
+def merge(queue_dir: Path, configs: Configs) -> bool:
+    """The final step, run by a single worker once all the jobs are done or failed:
+    merge the run manifests, traces and profiles of all the workers and write
+    summary.json."""
+
+    try:
+        os.close(os.open(Path(queue_dir) / "merged", os.O_CREAT | os.O_EXCL))
+    except FileExistsError:
+        return False
+
+    done = [_load_json(path) for path in get_jobs(queue_dir, "done")]
+    failed = [_load_json(path) for path in get_jobs(queue_dir, "failed")]
+    enqueued = min(job["enqueued"] for job in done + failed) if done + failed else 0
+
+    manifest.save_summary(configs, time.time() - enqueued, len(failed))
+    trace.merge(configs)
+    profiling.save_report(configs)
+
+    summary = {
+        "finished": datetime.now().isoformat(timespec="seconds"),
+        "done": [job["sample"] for job in done],
+        "failed": {job["sample"]: job.get("errors", []) for job in failed},
+    }
+    _write_json(Path(queue_dir) / "summary.json", summary)
+
+    logger.info(
+        f"The queue is finished: {len(done)} sample(s) done, {len(failed)} failed."
+    )
+    return True
+
+
+def run_worker(
+    queue_dir: Path,
+    log_port: Optional[int] = None,
+    log_path: Optional[str] = None,
+    poll_seconds: float = POLL_SECONDS,
+    run_job: Callable[[Config], int] = run_single_config_count_errors,
+) -> int:
+    """Run jobs from the queue until all of them are done or failed.
+
+    Returns
+    -------
+        The number of failed jobs (attempts) run by this worker.
+    """
+
+    configs = load_configs(queue_dir, log_port, log_path)
+    configs_by_sample = {config["sample"]: config for config in configs}
+    lease_seconds = configs["queue_lease_seconds"]
+    max_attempts = configs["queue_max_attempts"]
+
+    worker = get_worker_id()
+    logger.info(f"Starting worker {worker} on the queue {queue_dir}.")
+
+    N_errors = 0
+    while True:
+
+        recover_expired(queue_dir, lease_seconds, max_attempts)
+
+        path = claim(queue_dir, worker)
+        if path is None:
+            if is_finished(queue_dir, configs):
+                break
+            # wait for the running jobs, which may be retried
+            time.sleep(poll_seconds)
+            continue
+
+        job = _load_json(path)
+        config = configs_by_sample[job["sample"]]
+
+        with Heartbeat(path, lease_seconds / HEARTBEATS_PER_LEASE) as heartbeat:
+            N_job_errors = run_job(config)
+        current_process().name = "MainProcess"
+
+        if N_job_errors > 0:
+            N_errors += 1
+            reason = f"Attempt {job['attempts']} failed on {worker}"
+            released = release(queue_dir, path, max_attempts, reason)
+        else:
+            released = complete(queue_dir, path)
+
+        if heartbeat.lost or not released:
+            logger.warning(
+                f"{job['sample']} | The lease of the job expired while running it, "
+                f"so it may be run again by another worker."
+            )
+
+    (get_dir(queue_dir, "running") / worker).rmdir()
+    merge(queue_dir, configs)
+    logger.info(f"Worker {worker} finished, all the jobs are done or failed.")
+    return N_errors
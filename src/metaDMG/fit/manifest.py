@@ -0,0 +1,238 @@
+#%%
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+from pathlib import Path
+from typing import Iterable, Optional
+
+import psutil
+
+from metaDMG.__version__ import __version__
+from metaDMG.fit import profiling, trace
+from metaDMG.utils import Config, Configs
+
+
+#%%
+
+# The run manifest records, for each stage of a sample (e.g. lca, print_ugly, parse,
+# fit, merge, write), the wall time, the CPU time and the peak memory (RSS) of the
+# process and its child processes, and the number of bytes read and written:
+#   output_dir/run_manifest/{sample}.json
+# along with a summary of the whole workflow:
+#   output_dir/run_manifest/workflow.json
+
+# How often (in seconds) the memory is sampled while a stage is running
+RSS_SAMPLE_INTERVAL = 0.1
+
+WORKFLOW = "workflow"
+
+
+def get_dir(config: Config) -> Path:
+    return config["output_dir"] / "run_manifest"
+
+
+def get_path(config: Config) -> Path:
+    return get_dir(config) / f"{config['sample']}.json"
+
+
+def _write_json(path: Path, data: dict) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path_tmp = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+    with open(path_tmp, "w") as f:
+        json.dump(data, f, indent=2)
+    os.replace(path_tmp, path)
+
+
+def _load_json(path: Path) -> Optional[dict]:
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def get_size(paths: Iterable) -> int:
+    """The total size of the files (and directories) in bytes."""
+    size = 0
+    for path in paths:
+        path = Path(path)
+        files = path.rglob("*") if path.is_dir() else [path]
+        for file in files:
+            try:
+                if file.is_file():
+                    size += file.stat().st_size
+            except OSError:
+                # e.g. removed in the meantime
+                pass
+    return size
+
+
+#%%
+
+
+def get_cpu_time(process: psutil.Process) -> float:
+    """The CPU time of the process and its (finished) child processes."""
+    times = process.cpu_times()
+    children = getattr(times, "children_user", 0) + getattr(times, "children_system", 0)
+    return times.user + times.system + children
+
+
+def get_rss(process: psutil.Process) -> int:
+    """The resident memory of the process and its child processes."""
+    rss = process.memory_info().rss
+    for child in process.children(recursive=True):
+        try:
+            rss += child.memory_info().rss
+        except psutil.Error:
+            # the process finished in the meantime
+            pass
+    return rss
+
+
+class PeakRSS:
+    """Samples the memory of the process (tree) in a thread, keeping the maximum."""
+
+    def __init__(self, process: psutil.Process):
+        self.process = process
+        self.peak = get_rss(process)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._sample, daemon=True)
+        self.thread.start()
+
+    def _sample(self) -> None:
+        while not self.stopped.wait(RSS_SAMPLE_INTERVAL):
+            self.peak = max(self.peak, get_rss(self.process))
+
+    def stop(self) -> int:
+        self.stopped.set()
+        self.thread.join()
+        return max(self.peak, get_rss(self.process))
+
+
+def get_record(
+    name: str,
+    wall_time: float,
+    cpu_time: Optional[float] = None,
+    peak_rss: Optional[int] = None,
+    input_bytes: Optional[int] = None,
+    output_bytes: Optional[int] = None,
+) -> dict:
+    return {
+        "stage": name,
+        "wall_time": wall_time,
+        "cpu_time": cpu_time,
+        "peak_rss": peak_rss,
+        "input_bytes": input_bytes,
+        "output_bytes": output_bytes,
+    }
+
+
+def start_sample(config: Config) -> dict:
+    return {
+        "sample": config["sample"],
+        "version": __version__,
+        "started": datetime.now().isoformat(timespec="seconds"),
+        "stages": [],
+    }
+
+
+def add(config: Config, record: dict) -> None:
+    """Add the record of a stage to the manifest of the sample."""
+
+    path = get_path(config)
+    data = _load_json(path) or start_sample(config)
+    data["stages"].append(record)
+    _write_json(path, data)
+
+
+@contextmanager
+def stage(
+    config: Config,
+    name: str,
+    inputs: Iterable = (),
+    outputs: Iterable = (),
+    measure_process: bool = True,
+    trace_category: str = "stage",
+):
+    """Record the wall time, CPU time, peak RSS and input and output bytes of a stage.
+    The stage is also added as a span to the trace (with `--trace`) and profiled
+    (with `--profile`, only if `measure_process`).
+
+    The CPU time and peak RSS are of the whole process (and its child processes), so
+    they are not measured (`measure_process=False`) for stages running next to other
+    samples in the same process, e.g. in the `CppRunner`. The output bytes are the
+    growth of the `outputs` during the stage.
+    """
+
+    inputs, outputs = list(inputs), list(outputs)
+    output_bytes = get_size(outputs)
+
+    if measure_process:
+        process = psutil.Process()
+        cpu_time = get_cpu_time(process)
+        peak_rss = PeakRSS(process)
+        profile = profiling.profile(config, name)
+    else:
+        profile = nullcontext()
+
+    time_start = time.perf_counter()
+    try:
+        with trace.span(config, name, category=trace_category), profile:
+            yield
+    finally:
+        record = get_record(
+            name,
+            wall_time=time.perf_counter() - time_start,
+            input_bytes=get_size(inputs),
+            output_bytes=get_size(outputs) - output_bytes,
+        )
+        if measure_process:
+            record["cpu_time"] = get_cpu_time(process) - cpu_time
+            record["peak_rss"] = peak_rss.stop()
+        add(config, record)
+
+
+#%%
+
+
+def start(configs: Configs) -> None:
+    """Start the manifests of a new run, removing the ones of the previous run."""
+    for config in configs:
+        _write_json(get_path(config), start_sample(config))
+
+
+def _add_totals(totals: dict, record: dict) -> None:
+    for key in ["wall_time", "cpu_time", "input_bytes", "output_bytes"]:
+        if record[key] is not None:
+            totals[key] = totals.get(key, 0) + record[key]
+    if record["peak_rss"] is not None:
+        totals["peak_rss"] = max(totals.get("peak_rss", 0), record["peak_rss"])
+
+
+def save_summary(configs: Configs, wall_time: float, N_errors: int) -> None:
+    """Save the summary of the workflow: the totals of each stage (over all the
+    samples) and of each sample (over all the stages)."""
+
+    stages = {}
+    samples = {}
+    for config in configs:
+        data = _load_json(get_path(config)) or start_sample(config)
+        samples[config["sample"]] = {}
+        for record in data["stages"]:
+            _add_totals(stages.setdefault(record["stage"], {}), record)
+            _add_totals(samples[config["sample"]], record)
+
+    summary = {
+        "version": __version__,
+        "finished": datetime.now().isoformat(timespec="seconds"),
+        "N_samples": len(configs["samples"]),
+        "N_errors": N_errors,
+        "wall_time": wall_time,
+        "stages": stages,
+        "samples": samples,
+    }
+    _write_json(get_dir(configs) / f"{WORKFLOW}.json", summary)
@@ -4,7 +4,7 @@ import numpy as np
 import pandas as pd
 
 from metaDMG import __version__ as version
-from metaDMG.fit import mismatches
+from metaDMG.fit import mismatches, tensor
 
 
 #%%
@@ -79,9 +79,15 @@ def df_mismatch_to_mapDamage(df_mismatch):
     return df_mapDamage
 
 
+def read_df_mismatch(filename):
+    if filename.suffix in tensor.STORES.values():
+        return tensor.load_dataframe(filename)
+    return pd.read_parquet(filename)
+
+
 def convert(filename, csv_out):
 
-    df_mismatch = pd.read_parquet(filename)
+    df_mismatch = read_df_mismatch(filename)
     df_mapDamage = df_mismatch_to_mapDamage(df_mismatch)
 
     out = ""
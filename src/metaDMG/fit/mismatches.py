@@ -1,10 +1,22 @@
 #%%
 
+import json
+import shutil
+import subprocess
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, Optional
+
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from logger_tt import logger
+from pyarrow import csv as pa_csv
 
 from metaDMG.errors import MismatchFileError
-from metaDMG.fit import fit_utils
+from metaDMG.fit import bdamage, fit_utils, stats
 from metaDMG.utils import Config
 
 
@@ -132,54 +144,21 @@ def make_reverse_position_negative(df):
 # return df.fillna(0)
 
 
-def compute_k_sum_total(group):
-    k_sum_total = 0
+def add_k_sum_counts(df):
+    # k is C->T for the forward positions and G->A for the reverse positions
     forward_bases = bases_forward[0] + bases_forward[1]
-    k_sum_total += group[group.position > 0][forward_bases].sum()
     reverse_bases = bases_reverse[0] + bases_reverse[1]
-    k_sum_total += group[group.position < 0][reverse_bases].sum()
-    return k_sum_total
-
-
-def add_k_sum_counts(df):
-    ds = df.groupby("tax_id").apply(compute_k_sum_total)
-    ds = ds.reset_index().rename(columns={0: "k_sum_total"})
-    df = pd.merge(df, ds, on=["tax_id"])
+    k = np.where(df["position"] > 0, df[forward_bases], 0)
+    df["k_sum_total"] = np.where(df["position"] < 0, df[reverse_bases], k)
+    groupby = df.groupby("tax_id", sort=False, observed=True)["k_sum_total"]
+    df["k_sum_total"] = groupby.transform("sum")
     return df
 
 
-def compute_min_max_N_in_group(group, config):
-    min_N, max_N = group["N"].min(), group["N"].max()
-    return pd.Series({"min_N_in_group": min_N, "max_N_in_group": max_N})
-
-    # mask_forward = group.position > 0
-    # mask_reverse = group.position < 0
-
-    # if config["forward_only"]:
-    #     min_N = group[mask_forward][bases_forward[0]].min()
-    #     max_N = group[mask_forward][bases_forward[0]].max()
-    #     # return min_N, max_N
-    #     return pd.Series({"min_N_in_group": min_N, "max_N_in_group": max_N})
-
-    # min_N_forward = group[mask_forward > 0][bases_forward[0]].min()
-    # min_N_reverse = group[mask_reverse < 0][bases_reverse[0]].min()
-    # min_N = min(min_N_forward, min_N_reverse)
-
-    # max_N_forward = group[mask_forward > 0][bases_forward[0]].max()
-    # max_N_reverse = group[mask_reverse < 0][bases_reverse[0]].max()
-    # max_N = max(max_N_forward, max_N_reverse)
-
-    # # return min_N, max_N
-    # return pd.Series({"min_N_in_group": min_N, "max_N_in_group": max_N})
-
-
 def add_min_max_N_in_group(df, config):
-    ds = (
-        df.groupby("tax_id")
-        .apply(compute_min_max_N_in_group, config)
-        .reset_index(drop=False)
-    )
-    df = pd.merge(df, ds, on=["tax_id"])
+    groupby = df.groupby("tax_id", sort=False, observed=True)["N"]
+    df["min_N_in_group"] = groupby.transform("min")
+    df["max_N_in_group"] = groupby.transform("max")
     return df
 
 
@@ -197,34 +176,187 @@ def add_k_N_x_names(df, config):
     return df
 
 
-def make_tax_id_str(df):
+def set_tax_id_dtype(df, config):
+    # the LCA tax IDs are integers, the non-LCA ones are reference (contig) names
+    if config["damage_mode"] == "lca":
+        return df.astype({"tax_id": "int64"})
     return df.astype({"tax_id": "str"})
 
 
-def csv_contains_less_than_N_lines(filename, N=2):
-    import csv
-    import gzip
+# The types of the key columns. The mismatch counts are inferred (integers or floats).
+column_types = {
+    "#taxid": pa.string(),
+    "#taxidStr": pa.string(),
+    "direction": pa.string(),
+    "position": pa.int64(),
+}
 
-    counter = 0
-    with gzip.open(filename, "rt") as f:
-        rows = csv.reader(f)
-        for row in rows:
-            counter += 1
-            if counter >= N:
-                return False
-    return True
+# When reading in chunks, the types cannot be inferred from the first chunk only,
+# since later chunks may contain non-integer counts, so the counts are read as floats
+# (and converted back to integers if they are, see `counts_to_integers`).
+column_types_chunks = {
+    **column_types,
+    **{base: pa.float64() for base in fit_utils.ref_obs_bases},
+}
 
 
-def compute(config: Config) -> pd.DataFrame:
+def get_read_options(block_size=None) -> pa_csv.ReadOptions:
+    if block_size is None:
+        return pa_csv.ReadOptions(use_threads=True)
+    return pa_csv.ReadOptions(use_threads=True, block_size=block_size)
+
+
+parse_options = pa_csv.ParseOptions(delimiter="\t")
+convert_options = pa_csv.ConvertOptions(column_types=column_types)
+convert_options_chunks = pa_csv.ConvertOptions(column_types=column_types_chunks)
+
+
+def counts_to_integers(df: pd.DataFrame) -> pd.DataFrame:
+    """Convert the (float) mismatch counts to integers, if they all are."""
+    counts = df[fit_utils.ref_obs_bases].to_numpy()
+    if np.all(counts == np.round(counts)):
+        return df.astype({base: "int64" for base in fit_utils.ref_obs_bases})
+    return df
+
+
+@contextmanager
+def open_mismatches(filename):
+    """Open the (gzipped) mismatch file as a source for the Arrow CSV reader.
+    Uses pigz for the decompression (in separate threads) if it is installed.
+    """
+
+    pigz = shutil.which("pigz")
+    is_gzip = str(filename).endswith(".gz")
+
+    try:
+        if pigz is not None and is_gzip:
+            # read through stdin, since pigz skips named pipes
+            with open(filename, "rb") as f, subprocess.Popen(
+                [pigz, "-dc"],
+                stdin=f,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+            ) as process:
+                yield process.stdout
+
+            if process.returncode != 0:
+                raise MismatchFileError(f"Could not decompress {filename} with pigz.")
+            return
 
-    filename = config["path_mismatches_txt"]
+        if Path(filename).is_file():
+            # Arrow decompresses .gz files automatically
+            yield str(filename)
+            return
 
-    if csv_contains_less_than_N_lines(filename, N=2):
+        # named pipes cannot be opened by path in Arrow, since it seeks
+        with open(filename, "rb") as f:
+            source = pa.PythonFile(f, mode="r")
+            if is_gzip:
+                source = pa.CompressedInputStream(source, "gzip")
+            yield source
+
+    except pa.ArrowInvalid as e:
+        raise MismatchFileError(f"Could not read {filename}: {e}")
+
+
+def filter_tax_ids(table, tax_ids: Optional[set]):
+    """Only keep the rows (of an Arrow table or record batch) with the given tax IDs."""
+
+    if tax_ids is None:
+        return table
+
+    column = "#taxidStr" if "#taxidStr" in table.schema.names else "#taxid"
+    value_set = pa.array([str(tax_id) for tax_id in tax_ids], type=pa.string())
+    return table.filter(pc.is_in(table.column(column), value_set=value_set))
+
+
+def read_mismatches(filename, tax_ids: Optional[set] = None) -> pd.DataFrame:
+    """Read the mismatch file with the multithreaded Arrow CSV parser.
+    Only keeps the tax IDs in `tax_ids` (if not None)."""
+
+    with open_mismatches(filename) as source:
+        table = pa_csv.read_csv(
+            source,
+            read_options=get_read_options(),
+            parse_options=parse_options,
+            convert_options=convert_options,
+        )
+
+    if table.num_rows == 0:
         raise MismatchFileError(f"{filename} only contains a header, no data.")
 
+    return filter_tax_ids(table, tax_ids).to_pandas()
+
+
+def iterate_mismatches(
+    filename,
+    chunk_size: float,
+    tax_ids: Optional[set] = None,
+) -> Iterator[pd.DataFrame]:
+    """Read the mismatch file in chunks of about `chunk_size` MB (uncompressed),
+    aligned such that all the rows of a tax ID are in the same chunk.
+    Only keeps the tax IDs in `tax_ids` (if not None).
+    """
+
+    block_size = int(chunk_size * 1024**2)
+    tax_ids_seen = set()
+    df_rest = None
+    df_empty = None
+    N_rows = 0
+
+    def check_tax_ids(df):
+        tax_ids = set(df["tax_id"].unique())
+        if not tax_ids_seen.isdisjoint(tax_ids):
+            raise MismatchFileError(
+                f"The tax IDs in {filename} are not sorted, "
+                "cannot read it in chunks (mismatches_chunk_size)."
+            )
+        tax_ids_seen.update(tax_ids)
+
+    with open_mismatches(filename) as source:
+        reader = pa_csv.open_csv(
+            source,
+            read_options=get_read_options(block_size=block_size),
+            parse_options=parse_options,
+            convert_options=convert_options_chunks,
+        )
+
+        for batch in reader:
+            N_rows += batch.num_rows
+            df = rename_columns(filter_tax_ids(batch, tax_ids).to_pandas())
+            df = counts_to_integers(df)
+            if df_rest is not None:
+                df = pd.concat([df_rest, df], ignore_index=True)
+
+            if len(df) == 0:
+                df_empty = df
+                continue
+
+            # keep the last tax ID for the next chunk, it might continue in there
+            is_last = (df["tax_id"] == df["tax_id"].iloc[-1]).to_numpy()
+            df_rest = df[is_last]
+            df = df[~is_last]
+
+            if len(df) > 0:
+                check_tax_ids(df)
+                yield df
+
+    if N_rows == 0:
+        raise MismatchFileError(f"{filename} only contains a header, no data.")
+
+    if df_rest is not None and len(df_rest) > 0:
+        check_tax_ids(df_rest)
+        yield df_rest
+
+    # all the tax IDs were filtered away
+    elif len(tax_ids_seen) == 0:
+        yield df_empty
+
+
+def process(config: Config, df: pd.DataFrame) -> pd.DataFrame:
+
     df = (
-        pd.read_csv(filename, sep="\t")
-        .pipe(rename_columns)
+        df.pipe(rename_columns)
         .pipe(select_read_directions, config)
         .pipe(add_reference_counts, config, bases_forward, bases_reverse)
         .pipe(add_error_rates, config, bases_forward, bases_reverse)
@@ -233,14 +365,250 @@ def compute(config: Config) -> pd.DataFrame:
         .pipe(add_k_N_x_names, config)
         .pipe(add_k_sum_counts)
         .pipe(add_min_max_N_in_group, config)
-        .pipe(make_tax_id_str)
+        .pipe(set_tax_id_dtype, config)
         .reset_index(drop=True)
         .fillna(0)
     )
 
     df["sample"] = config["sample"]
-    categories = ["tax_id", "direction", "sample"]
+    categories = ["direction", "sample"]
+    if config["damage_mode"] != "lca":
+        categories.append("tax_id")
 
     df_mismatches = fit_utils.downcast_dataframe(df, categories, fully_automatic=False)
+    df_mismatches = downcast_counts(df_mismatches)
 
     return df_mismatches
+
+
+def uses_pipe(config: Config) -> bool:
+    """Parse the print_ugly output from a named pipe while it is being written,
+    see `serial.run_command_into_pipe`."""
+    return config["mismatches_pipe"] and not bdamage.uses_native_reader(config)
+
+
+def get_min_reads_filter(config: Config) -> int:
+    """The `min_reads` the mismatches are filtered with while parsing.
+    When parsing from the pipe, the stat file is not complete yet,
+    so nothing is filtered."""
+    return 0 if uses_pipe(config) else config["min_reads"]
+
+
+def get_tax_ids_to_keep(config: Config) -> Optional[set]:
+    """The tax IDs to keep when parsing, i.e. the ones with at least `min_reads` reads.
+    Filtering already while parsing saves both time and memory."""
+
+    if get_min_reads_filter(config) <= 0:
+        return None
+
+    tax_ids = stats.get_tax_ids_with_minimum_reads(config)
+    if tax_ids is not None:
+        logger.debug(
+            f"Only keeping the {len(tax_ids)} tax IDs with at least "
+            f"{config['min_reads']} reads."
+        )
+    return tax_ids
+
+
+def compute(config: Config) -> pd.DataFrame:
+    tax_ids = get_tax_ids_to_keep(config)
+    if bdamage.uses_native_reader(config):
+        df = bdamage.read_bdamage(config, tax_ids)
+    else:
+        df = read_mismatches(config["path_mismatches_txt"], tax_ids)
+    return process(config, df)
+
+
+def iterate_chunks(config: Config) -> Iterator[pd.DataFrame]:
+    tax_ids = get_tax_ids_to_keep(config)
+    chunk_size = config["mismatches_chunk_size"]
+    if bdamage.uses_native_reader(config):
+        names = bdamage.read_bam_reference_names(config["bam"])
+        return bdamage.iterate_bdamage(
+            config["path_bdamage"],
+            names,
+            chunk_size,
+            tax_ids,
+        )
+    return iterate_mismatches(config["path_mismatches_txt"], chunk_size, tax_ids)
+
+
+#%%
+
+# key of the metaDMG specific metadata in the mismatch parquet files
+METADATA_KEY = b"metaDMG"
+
+
+def get_metadata(config: Config) -> dict:
+    return {"min_reads": get_min_reads_filter(config)}
+
+
+def add_metadata(schema: pa.Schema, config: Config) -> pa.Schema:
+    metadata = dict(schema.metadata or {})
+    metadata[METADATA_KEY] = json.dumps(get_metadata(config)).encode()
+    return schema.with_metadata(metadata)
+
+
+def save(config: Config, df_mismatches: pd.DataFrame, target: Path) -> None:
+    table = pa.Table.from_pandas(df_mismatches)
+    table = table.replace_schema_metadata(add_metadata(table.schema, config).metadata)
+    pq.write_table(table, target)
+
+
+def load(target: Path) -> pd.DataFrame:
+    """Load the mismatch parquet file, freeing the Arrow memory while converting it to
+    a dataframe, such that the peak memory is about the size of the dataframe.
+
+    The counts of mismatches parsed in chunks are saved as float64 (see `get_schema`),
+    and converted to the same types as when parsing the whole file at once
+    (see `downcast_counts`).
+    """
+
+    return table_to_dataframe(pq.read_table(target))
+
+
+def table_to_dataframe(table: pa.Table) -> pd.DataFrame:
+    """Convert the Arrow table (with the schema of `get_schema`) to a dataframe,
+    with the counts downcast as in `downcast_counts`."""
+    df = table.to_pandas(split_blocks=True, self_destruct=True)
+    return downcast_counts(df)
+
+
+def is_valid(config: Config, target: Path) -> bool:
+    """Whether the mismatch parquet file is up to date and contains all the tax IDs
+    needed, i.e. if it was not filtered with a higher `min_reads` than the current one.
+    """
+
+    schema = pq.read_schema(target)
+    tax_id_type = schema.field("tax_id").type
+    if config["damage_mode"] == "lca" and not pa.types.is_integer(tax_id_type):
+        # from before the LCA tax IDs were saved as integers
+        return False
+
+    metadata = schema.metadata or {}
+    if METADATA_KEY not in metadata:
+        # files from before the filtering while parsing are not filtered
+        return True
+
+    min_reads = json.loads(metadata[METADATA_KEY])["min_reads"]
+    return min_reads <= config["min_reads"]
+
+
+def is_rate_column(column: str) -> bool:
+    return column == "f" or column.startswith("f_")
+
+
+def get_count_columns(df: pd.DataFrame) -> list[str]:
+    return [
+        column
+        for column in df.select_dtypes(include=["number"]).columns
+        if column not in ["tax_id", "position"] and not is_rate_column(column)
+    ]
+
+
+def is_integral(series: pd.Series) -> bool:
+    if pd.api.types.is_integer_dtype(series):
+        return True
+    values = series.to_numpy()
+    return bool(np.all(values == np.round(values)))
+
+
+def downcast_counts(df: pd.DataFrame) -> pd.DataFrame:
+    """Use the same types for all the counts (and the columns derived from them),
+    no matter if the mismatches were parsed at once or in chunks: unsigned integers
+    (uint32 or uint64, depending on the largest count) if all the counts are
+    integers and otherwise float32, see `fit_utils.downcast_dataframe`.
+    """
+
+    count_columns = get_count_columns(df)
+    if len(count_columns) == 0 or len(df) == 0:
+        return df
+
+    if all(is_integral(df[column]) for column in count_columns):
+        dtype = "uint32"
+        if max(df[column].max() for column in count_columns) > np.iinfo("uint32").max:
+            dtype = "uint64"
+    else:
+        dtype = "float32"
+
+    for column in count_columns:
+        if df[column].dtype != dtype:
+            df[column] = df[column].astype(dtype)
+    return df
+
+
+def get_schema(config: Config, columns: list[str]) -> pa.Schema:
+    """The explicit Arrow schema of the mismatch chunks, which does not depend on the
+    values in the (first) chunk: the counts are saved as float64 (exact for integers
+    up to 2**53), since the chunks may need different integer sizes or contain
+    non-integer counts, and the categories with fixed size codes."""
+
+    category = pa.dictionary(pa.int32(), pa.string())
+    if config["damage_mode"] == "lca":
+        tax_id = pa.int64()
+    else:
+        tax_id = category
+
+    fields = []
+    for column in columns:
+        if column == "tax_id":
+            field = pa.field(column, tax_id)
+        elif column in ["direction", "sample"]:
+            field = pa.field(column, category)
+        elif column == "position":
+            field = pa.field(column, pa.int8())
+        elif is_rate_column(column):
+            field = pa.field(column, pa.float32())
+        else:
+            field = pa.field(column, pa.float64())
+        fields.append(field)
+    return pa.schema(fields)
+
+
+def compute_streaming(config: Config, target: Path) -> None:
+    """Compute the mismatch dataframe chunk by chunk (see `iterate_chunks`)
+    and write it to the parquet file `target`, with the schema of `get_schema`.
+    The peak memory while parsing is bounded by the `mismatches_chunk_size` (in MB).
+    """
+
+    target_tmp = target.with_name(f".{target.name}.tmp")
+
+    writer = None
+    df_mismatches_empty = None
+    try:
+        for df in iterate_chunks(config):
+            df_mismatches = process(config, df)
+
+            if len(df_mismatches) == 0:
+                df_mismatches_empty = df_mismatches
+                continue
+
+            if writer is None:
+                schema = get_schema(config, list(df_mismatches.columns))
+                schema = add_metadata(schema, config)
+                writer = pq.ParquetWriter(target_tmp, schema)
+
+            try:
+                table = pa.Table.from_pandas(
+                    df_mismatches,
+                    schema=schema,
+                    preserve_index=False,
+                )
+            except (pa.ArrowInvalid, pa.ArrowTypeError) as e:
+                raise MismatchFileError(
+                    f"Could not write the mismatches of {config['sample']} in chunks: {e}"
+                )
+            writer.write_table(table)
+
+    except BaseException:
+        if writer is not None:
+            writer.close()
+        target_tmp.unlink(missing_ok=True)
+        raise
+
+    if writer is None:
+        # all the tax IDs were filtered away
+        save(config, df_mismatches_empty, target_tmp)
+    else:
+        writer.close()
+    target_tmp.replace(target)
@@ -0,0 +1,169 @@
+#%%
+import os
+import time
+import uuid
+from pathlib import Path
+from typing import Callable, Optional
+
+import pandas as pd
+from logger_tt import logger
+
+from metaDMG import utils
+from metaDMG.fit import fits, results, tensor
+from metaDMG.utils import Config
+
+
+#%%
+
+
+def get_partial_results_path(config: Config) -> Path:
+    return (
+        config["output_dir"] / "results_partial" / f"{config['sample']}.results.parquet"
+    )
+
+
+def remove_partial_results(config: Config) -> None:
+    path = get_partial_results_path(config)
+    utils.remove_directory(path, missing_ok=True)
+
+    # also remove the parent directory if this was the last sample
+    try:
+        path.parent.rmdir()
+    except OSError:
+        pass
+
+
+def load_df_mismatches(config: Config, tax_ids: list) -> pd.DataFrame:
+    """The mismatches of the tax IDs, only reading those from the parquet file."""
+
+    from metaDMG.fit.serial import get_mismatches_target
+
+    if tensor.uses_tensor_store(config):
+        return tensor.load_tax_ids(config, tax_ids)
+
+    filters = [("tax_id", "in", tax_ids)]
+    return pd.read_parquet(get_mismatches_target(config), filters=filters)
+
+
+def save_partial_results(
+    config: Config,
+    fit_plan: dict,
+    d_fit_results: dict,
+    df_mismatches: Optional[pd.DataFrame] = None,
+) -> None:
+    """Save the results of the fitted tax IDs as a new part of the partial results.
+    Only the mismatches of these tax IDs are read, if `df_mismatches` is None."""
+
+    d_fit_results = dict(d_fit_results)
+
+    # include the duplicates of the fitted tax IDs
+    for tax_id_unique, tax_ids_non_unique in fit_plan["duplicates"].items():
+        if tax_id_unique in d_fit_results:
+            for tax_id_non_unique in tax_ids_non_unique:
+                d_fit_results[tax_id_non_unique] = d_fit_results[tax_id_unique]
+
+    tax_ids = list(d_fit_results.keys())
+    if df_mismatches is None:
+        df_mismatches = load_df_mismatches(config, tax_ids)
+    else:
+        df_mismatches = df_mismatches.query("tax_id in @tax_ids")
+
+    df_fit_results = fits.make_df_fit_results(
+        config,
+        fit_plan,
+        d_fit_results,
+        df_mismatches,
+    )
+    df_results = results.merge(config, df_mismatches, df_fit_results)
+
+    # time-ordered names, written atomically (hidden files are not read)
+    path = get_partial_results_path(config)
+    path.mkdir(parents=True, exist_ok=True)
+    name = f"part-{time.time_ns()}-{uuid.uuid4().hex[:8]}.parquet"
+    path_tmp = path / f".{name}.tmp"
+    df_results.to_parquet(path_tmp)
+    os.replace(path_tmp, path / name)
+
+    logger.debug(f"Saved partial results of {len(df_results)} tax IDs.")
+
+
+#%%
+
+
+class PartialResults:
+    """The results of the tax IDs fitted so far, while the rest are still being fitted.
+
+    The results are saved to `results_partial/{sample}.results.parquet`, a directory
+    of parquet files which is read as a single parquet file, e.g. by
+    `metaDMG dashboard --results {output_dir}/results_partial`. Every update (at most
+    every `seconds` seconds) only adds the newly fitted tax IDs as a new file.
+    The directory is removed when the final results have been saved.
+
+    The updates are saved right away, or, if given, `submit(args)` is called with the
+    arguments of `save_partial_results` instead (e.g. to save them in another process).
+    """
+
+    def __init__(
+        self,
+        config: Config,
+        fit_plan: dict,
+        df_mismatches: Optional[pd.DataFrame] = None,
+        seconds: float = 60,
+        submit: Optional[Callable] = None,
+    ):
+        self.config = config
+        self.fit_plan = fit_plan
+        self.df_mismatches = df_mismatches
+        self.seconds = seconds
+        self.submit = submit
+        self.buffer = {}
+        self.time_last_flush = 0.0
+
+        # a new run starts over
+        remove_partial_results(config)
+
+        # the cached and checkpointed fit results are available right away
+        self.add(fit_plan["d_fit_results_cached"])
+        self.add(fit_plan["d_fit_results_checkpoint"])
+
+    def add(self, d_fit_results: dict) -> None:
+        self.buffer.update(d_fit_results)
+        if time.time() - self.time_last_flush >= self.seconds:
+            self.flush()
+
+    def flush(self) -> None:
+        self.time_last_flush = time.time()
+        if len(self.buffer) == 0:
+            return
+
+        d_fit_results = self.buffer
+        self.buffer = {}
+
+        if self.submit is None:
+            save_partial_results(
+                self.config,
+                self.fit_plan,
+                d_fit_results,
+                self.df_mismatches,
+            )
+        else:
+            self.submit((self.config, self.fit_plan, d_fit_results))
+
+
+def get_partial_results(
+    config: Config,
+    fit_plan: dict,
+    df_mismatches: Optional[pd.DataFrame] = None,
+    submit: Optional[Callable] = None,
+) -> Optional[PartialResults]:
+
+    if not config.get("partial_results"):
+        return None
+
+    return PartialResults(
+        config,
+        fit_plan,
+        df_mismatches,
+        seconds=config["partial_results_every_seconds"],
+        submit=submit,
+    )
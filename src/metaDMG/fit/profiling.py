@@ -0,0 +1,115 @@
+#%%
+import cProfile
+import io
+import os
+import pstats
+import shutil
+import socket
+import threading
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+
+from logger_tt import logger
+
+from metaDMG.utils import Config, Configs
+
+
+#%%
+
+# With `--profile`, the stages of each sample (see `manifest.stage`) and the fit chunks
+# of the workers are profiled with cProfile. Every process saves a profile per stage
+#   output_dir/profiles/{stage}.{host}.{pid}.{id}.prof
+# (shared by all the workers of a queue), which are merged into a ranked report per
+# stage:
+#   output_dir/profiles/report.txt
+
+# The number of functions per stage in the report
+N_FUNCTIONS = 30
+
+# The profiles of this process, by stage (enabled and disabled for each block).
+# Only a single profiler can be active in a process at a time, so blocks in other
+# threads (or nested blocks) are not profiled, see the lock.
+_process = {"pid": None}
+
+
+def is_enabled(config: Config) -> bool:
+    return bool(config.get("profile"))
+
+
+def get_dir(config: Config) -> Path:
+    return config["output_dir"] / "profiles"
+
+
+def _get_process() -> dict:
+    # reset in (forked) child processes, which inherit the profiles (and the possibly
+    # acquired lock) of the parent
+    if _process["pid"] != os.getpid():
+        _process["pid"] = os.getpid()
+        _process["id"] = f"{socket.gethostname()}.{os.getpid()}.{uuid.uuid4().hex[:8]}"
+        _process["profiles"] = {}
+        _process["lock"] = threading.Lock()
+    return _process
+
+
+@contextmanager
+def profile(config: Config, stage: str):
+    """Profile the block (if enabled), adding to the profile of the stage."""
+
+    if not is_enabled(config):
+        yield
+        return
+
+    process = _get_process()
+    if not process["lock"].acquire(blocking=False):
+        yield
+        return
+
+    try:
+        profiler = process["profiles"].setdefault(stage, cProfile.Profile())
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            path = get_dir(config) / f"{stage}.{process['id']}.prof"
+            path.parent.mkdir(parents=True, exist_ok=True)
+            # the profile includes all the blocks of the stage in this process so far
+            profiler.dump_stats(path)
+    finally:
+        process["lock"].release()
+
+
+#%%
+
+
+def start(configs: Configs) -> None:
+    """Remove the profiles of a previous run, such that they are not included in
+    the report."""
+    if is_enabled(configs):
+        shutil.rmtree(get_dir(configs), ignore_errors=True)
+
+
+def save_report(configs: Configs) -> None:
+    """Merge the profiles of all the processes into a ranked report per stage,
+    sorted by the time spent in each function (excluding sub-functions)."""
+
+    if not is_enabled(configs):
+        return
+
+    directory = get_dir(configs)
+    paths = defaultdict(list)
+    for path in sorted(directory.glob("*.prof")):
+        paths[path.name.split(".")[0]].append(path)
+
+    stream = io.StringIO()
+    for stage, stage_paths in paths.items():
+        stream.write(f"{'#' * 80}\n# {stage} ({len(stage_paths)} process(es))\n\n")
+        stats = pstats.Stats(*map(str, stage_paths), stream=stream)
+        stats.sort_stats("tottime").print_stats(N_FUNCTIONS)
+
+    path = directory / "report.txt"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(stream.getvalue())
+    logger.info(f"Saved the profiling report to {path}.")
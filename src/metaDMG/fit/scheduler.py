@@ -0,0 +1,383 @@
+#%%
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ProcessPoolExecutor as Pool
+from concurrent.futures import wait
+from contextlib import nullcontext
+from math import ceil
+from pathlib import Path
+from time import perf_counter
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from logger_tt import logger
+
+from metaDMG import utils
+from metaDMG.errors import BadDataError
+from metaDMG.fit import fits, manifest, partial_results, serial
+from metaDMG.fit.autotune import MEMORY_CHECK_INTERVAL, MemoryBudget
+from metaDMG.fit.cpp_runner import CppRunner, split_cores
+from metaDMG.utils import Config, Configs
+
+
+#%%
+
+# maximum number of tax IDs in a single MAP fit chunk
+MAP_MAXIMUM_SIZE = 1000
+
+
+def get_N_cores(configs: Configs) -> int:
+    """The global core budget: `max_cores` if set, otherwise the same number of cores
+    as the static split of `parallel_samples` and `cores_per_sample` would use."""
+
+    if configs.get("max_cores"):
+        return configs["max_cores"]
+
+    parallel_samples = min(configs["parallel_samples"], len(configs))
+    return parallel_samples * configs["cores_per_sample"]
+
+
+def get_fit_chunks_path(config: Config) -> Path:
+    return config["path_tmp"] / f"{config['sample']}.fit_chunks.parquet"
+
+
+def save_fit_chunks(
+    config: Config,
+    df_mismatches_unique: pd.DataFrame,
+    N_cores: int,
+) -> int:
+    """Split the tax IDs to fit into chunks and save them as a row group each, such
+    that the fit workers only read their own chunk instead of the whole sample being
+    sent (pickled) to the parent and then to each worker.
+
+    Returns
+    -------
+        The number of chunks.
+    """
+
+    if config["bayesian"]:
+        N_maximum_group_size = fits.BAYESIAN_MAXIMUM_SIZE
+    else:
+        N_maximum_group_size = MAP_MAXIMUM_SIZE
+
+    tax_ids = df_mismatches_unique["tax_id"].unique()
+    N_tax_ids = len(tax_ids)
+    if N_tax_ids == 0:
+        return 0
+
+    # make at least as many chunks as cores (if possible) to keep all cores busy
+    N_splits = max(min(N_cores, N_tax_ids), ceil(N_tax_ids / N_maximum_group_size))
+
+    # keep the order of the tax IDs (see `fits.order_tax_ids`), with their rows next
+    # to each other
+    codes = pd.Categorical(df_mismatches_unique["tax_id"], categories=tax_ids).codes
+    order = np.argsort(codes, kind="stable")
+    df_mismatches_unique = df_mismatches_unique.iloc[order]
+    chunks = np.array_split(np.arange(N_tax_ids), N_splits)
+    bounds = np.searchsorted(codes[order], [chunk[0] for chunk in chunks[1:]])
+
+    path = get_fit_chunks_path(config)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    table = pa.Table.from_pandas(df_mismatches_unique, preserve_index=False)
+    with pq.ParquetWriter(path, table.schema) as writer:
+        for start, stop in zip([0, *bounds], [*bounds, len(table)]):
+            writer.write_table(table.slice(start, stop - start))
+
+    return N_splits
+
+
+def load_fit_chunk(config: Config, i: int) -> pd.DataFrame:
+    return pq.ParquetFile(get_fit_chunks_path(config)).read_row_group(i).to_pandas()
+
+
+def remove_fit_chunks(config: Config) -> None:
+    path = get_fit_chunks_path(config)
+    utils.remove_file(path, missing_ok=True)
+    # also the temporary directories, unless in use (by the C++ stages)
+    for directory in [path.parent, path.parent.parent]:
+        try:
+            directory.rmdir()
+        except OSError:
+            break
+
+
+#%%
+
+
+def prepare_sample(config: Config, N_cores: int, force_cpp: Optional[bool] = None):
+    """Run the C++ stage, the mismatch parsing, and the fit preparation of a sample,
+    saving the tax IDs to fit in chunks, see `save_fit_chunks`.
+    `force_cpp`: see `serial.run_cpp_and_get_df_mismatches`.
+
+    Returns
+    -------
+        The fit plan (see `fits.prepare_fits`, without `df_mismatches_unique` but
+        with the number of chunks, `N_chunks`), or None if the sample is already done.
+    """
+
+    serial._setup_logger(config)
+    force = config["force"]
+
+    df_mismatches = serial.run_cpp_and_get_df_mismatches(config, force, force_cpp)
+
+    df_fit_results = serial.load_df_fit_results(config, force=force)
+    if df_fit_results is not None:
+        serial.get_df_results(config, df_mismatches, df_fit_results, force=force)
+        logger.info("Finished.")
+        return None
+
+    serial.log_fit_info(config)
+
+    try:
+        fit_plan = fits.prepare_fits(config, df_mismatches)
+    except BadDataError as e:
+        logger.warning(
+            f"{config['sample']} | "
+            f"BadDataError happened while fitting, see log file for more info. "
+            f"Skipping for now."
+        )
+        raise e
+
+    df_mismatches_unique = fit_plan.pop("df_mismatches_unique")
+    fit_plan["N_chunks"] = save_fit_chunks(config, df_mismatches_unique, N_cores)
+
+    return fit_plan
+
+
+def fit_chunk(config: Config, i: int) -> dict:
+    serial._setup_logger(config)
+    df_mismatches = load_fit_chunk(config, i)
+    return fits.compute_fits_parallel_worker((df_mismatches, config, False))
+
+
+def save_partial_results(config: Config, fit_plan: dict, d_fit_results: dict) -> None:
+    serial._setup_logger(config)
+    partial_results.save_partial_results(config, fit_plan, d_fit_results)
+
+
+def finalize_sample(config: Config, fit_plan: dict, d_fit_results: dict) -> None:
+
+    serial._setup_logger(config)
+    force = config["force"]
+
+    df_mismatches = serial.get_df_mismatches(config)
+    df_fit_results = fits.finalize_fits(config, fit_plan, d_fit_results, df_mismatches)
+    serial.save_df_fit_results(config, df_fit_results)
+    serial.get_df_results(config, df_mismatches, df_fit_results, force=force)
+    remove_fit_chunks(config)
+
+    logger.info("Finished.")
+
+
+def finalize_when_fitted(state: dict, sample: str, tasks_pending: deque) -> None:
+    """Finalize the sample once all its chunks are fitted and its partial results
+    saved, since the partial results are removed when finalizing."""
+
+    if state["N_chunks_left"] == 0 and state["N_partial_running"] == 0:
+        args = (state["config"], state["fit_plan"], state["d_fit_results"])
+        tasks_pending.appendleft(("finalize", sample, args))
+        # only once
+        state["N_chunks_left"] = -1
+
+
+#%%
+
+
+def get_N_preparing(N_cores: int, tasks_running: dict, N_samples_pending: int) -> int:
+    """The number of C++ stages to split the cores between when preparing the next
+    sample: the preparations that are running and the ones that are submitted now,
+    i.e. the next sample and the other pending ones that get one of the free cores.
+    The samples still waiting for a core are not counted."""
+
+    N_running = sum(kind == "prepare" for kind, _ in tasks_running.values())
+    N_submitted = min(1 + N_samples_pending, N_cores - len(tasks_running))
+    return N_running + max(N_submitted, 1)
+
+
+def run_global_scheduler(configs: Configs) -> int:
+    """Run all the samples with a single pool of workers.
+
+    The unit of work is either the preparation of a sample (C++ stage, parsing and
+    fit preparation), a chunk of tax IDs to fit, an update of the partial results,
+    or the final merge of a sample.
+    Fit chunks and merges of already started samples are prioritised over starting
+    new samples, such that finished samples free up their memory quickly while
+    otherwise idle cores start on the next samples.
+
+    With `cpp_max_jobs`, the C++ stages of all the samples are instead run by a
+    `CppRunner` (at most `cpp_max_jobs` at a time) outside of the pool of workers,
+    and a sample is prepared as soon as its C++ stage is done.
+
+    In both cases, the metaDMG-cpp threads are split from the same `N_cores` cores,
+    such that the C++ stages of the last samples get more threads.
+
+    With a `memory_budget`, a sample is only prepared when its estimated peak memory
+    fits, see `MemoryBudget`.
+
+    Parameters
+    ----------
+    configs
+        A Configs object containing the configuration parameters for the workflow.
+
+    Returns
+    -------
+        The number of samples that failed.
+    """
+
+    N_cores = get_N_cores(configs)
+    logger.info(f"Running with a global scheduler using {N_cores} core(s) in total.")
+
+    samples_pending = deque(configs)
+    tasks_pending = deque()
+    tasks_running = {}
+    cpp_running = {}
+    states = {}
+    budget = MemoryBudget(configs["memory_budget"])
+    N_errors = 0
+
+    if configs["cpp_max_jobs"]:
+        runner = CppRunner(max_jobs=configs["cpp_max_jobs"], N_cores=N_cores)
+    else:
+        runner = nullcontext()
+
+    with Pool(max_workers=N_cores) as pool, runner:
+
+        if configs["cpp_max_jobs"]:
+            for config in samples_pending:
+                states[config["sample"]] = {"config": config, "failed": False}
+                cpp_running[runner.submit(config, config["force"])] = config
+            samples_pending.clear()
+
+        while samples_pending or tasks_pending or tasks_running or cpp_running:
+
+            # fill up the free cores, prioritising the samples already started
+            while len(tasks_running) < N_cores and (tasks_pending or samples_pending):
+                if tasks_pending:
+                    kind, sample, args = tasks_pending.popleft()
+                elif not budget.admit(samples_pending[0]):
+                    break
+                else:
+                    config = samples_pending.popleft()
+                    kind, sample = "prepare", config["sample"]
+
+                    if configs["cpp_max_jobs"]:
+                        # the C++ stage was just run (forced, if force)
+                        args = (config, N_cores, False)
+                    else:
+                        states[sample] = {"config": config, "failed": False}
+
+                        N_preparing = get_N_preparing(
+                            N_cores,
+                            tasks_running,
+                            len(samples_pending),
+                        )
+                        N_threads = split_cores(N_cores, N_preparing)
+                        args = (Config(config, cpp_threads=N_threads), N_cores)
+
+                function = {
+                    "prepare": prepare_sample,
+                    "fit": fit_chunk,
+                    "partial": save_partial_results,
+                    "finalize": finalize_sample,
+                }[kind]
+                tasks_running[pool.submit(function, *args)] = (kind, sample)
+
+            # wait with a timeout when a sample is waiting for memory,
+            # since the measured memory of the running samples changes
+            timeout = MEMORY_CHECK_INTERVAL if samples_pending else None
+            done, _ = wait(
+                [*tasks_running, *cpp_running],
+                timeout=timeout,
+                return_when=FIRST_COMPLETED,
+            )
+
+            for future in done:
+
+                if future in cpp_running:
+                    config = cpp_running.pop(future)
+                    if future.result() > 0:
+                        states[config["sample"]]["failed"] = True
+                        N_errors += 1
+                    else:
+                        samples_pending.append(config)
+                    continue
+
+                kind, sample = tasks_running.pop(future)
+                state = states[sample]
+
+                try:
+                    result = future.result()
+                except KeyboardInterrupt as e:
+                    raise e
+                except Exception:
+                    if kind == "partial" and not state["failed"]:
+                        # only the partial results are missing, not the final ones
+                        logger.warning(f"{sample} | Could not save partial results.")
+                        state["N_partial_running"] -= 1
+                        finalize_when_fitted(state, sample, tasks_pending)
+                        continue
+                    if not state["failed"]:
+                        state["failed"] = True
+                        N_errors += 1
+                        budget.release(sample)
+                        logger.debug(f"{sample} failed during the '{kind}' step.")
+                    tasks_pending = deque(
+                        task for task in tasks_pending if task[1] != sample
+                    )
+                    continue
+
+                if state["failed"]:
+                    continue
+
+                config = state["config"]
+
+                if kind == "prepare":
+                    if result is None:
+                        budget.release(sample)
+                        continue
+
+                    N_chunks = result.pop("N_chunks")
+                    state["fit_plan"] = result
+                    state["d_fit_results"] = {}
+                    # the partial results are saved by the workers
+                    state["partial_args"] = []
+                    state["N_partial_running"] = 0
+                    submit = state["partial_args"].append
+                    state["writers"] = fits.get_writers(config, result, None, submit)
+                    state["N_chunks_left"] = N_chunks
+                    state["time_fit"] = perf_counter()
+
+                    for i in range(N_chunks):
+                        tasks_pending.append(("fit", sample, (config, i)))
+
+                elif kind == "fit":
+                    state["d_fit_results"].update(result)
+                    state["N_chunks_left"] -= 1
+
+                    fits.add_to_writers(state["writers"], result)
+
+                    if state["N_chunks_left"] == 0:
+                        # the chunks run in different workers, so only the wall time
+                        wall_time = perf_counter() - state["time_fit"]
+                        manifest.add(config, manifest.get_record("fit", wall_time))
+                        fits.flush_writers(state["writers"])
+
+                elif kind == "partial":
+                    state["N_partial_running"] -= 1
+
+                if kind in ("prepare", "fit", "partial"):
+                    for args in state["partial_args"]:
+                        tasks_pending.appendleft(("partial", sample, args))
+                        state["N_partial_running"] += 1
+                    state["partial_args"].clear()
+                    finalize_when_fitted(state, sample, tasks_pending)
+
+                elif kind == "finalize":
+                    # free the memory of finished samples
+                    states[sample] = {"config": config, "failed": False}
+                    budget.release(sample)
+
+    return N_errors
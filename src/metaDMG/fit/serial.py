@@ -1,7 +1,9 @@
 #%%
+import os
 import shlex
 import shutil
 import subprocess
+import threading
 
 # import json
 from collections import Counter
@@ -20,7 +22,17 @@ from metaDMG.errors import (
     MismatchFileError,
     metadamageError,
 )
-from metaDMG.fit import fits, mismatches, results
+from metaDMG.fit import (
+    bdamage,
+    fingerprint,
+    fit_checkpoint,
+    fits,
+    manifest,
+    mismatches,
+    partial_results,
+    results,
+    tensor,
+)
 from metaDMG.loggers.loggers import setup_logger
 from metaDMG.utils import Config
 
@@ -131,6 +143,22 @@ def get_runmode(config: Config) -> int:
     raise AssertionError(f"Got wrong runmode. Got: {runmode}")
 
 
+def get_cpp_threads(config: Config) -> int:
+    """The number of threads of metaDMG-cpp, as allocated by the workflow
+    (`cpp_threads`), otherwise the share of `max_cores` (all the available cores by
+    default) of each of the samples running in parallel."""
+
+    from metaDMG.fit.autotune import get_available_cores
+    from metaDMG.fit.cpp_runner import split_cores
+
+    if config.get("cpp_threads"):
+        return config["cpp_threads"]
+
+    N_cores = config.get("max_cores") or get_available_cores()
+    N_samples = min(config["parallel_samples"], len(config["samples"]))
+    return split_cores(N_cores, N_samples)
+
+
 def get_damage_command(config: Config) -> str:
     "'Direct' damage, no LCA"
 
@@ -141,7 +169,7 @@ def get_damage_command(config: Config) -> str:
         f"{config['metaDMG_cpp']} getdamage "
         f"--minlength 10 "
         f"--printlength {config['max_position']} "
-        f"--threads 8 "
+        f"--threads {get_cpp_threads(config)} "
         f"--runmode {runmode} "
         f"--outname {outname} "
         f"{config['bam']} "
@@ -158,20 +186,28 @@ def get_damage_ugly_command(config: Config) -> str:
 #%%
 
 
+def get_ugly_mismatch_path(config: Config) -> Path:
+    sample = config["sample"]
+    return config["path_tmp"] / f"{sample}.bdamage.gz.uglyprint.mismatch.txt.gz"
+
+
 def move_files(config: Config) -> None:
 
     sample = config["sample"]
     path_tmp = config["path_tmp"]
 
-    mismatch = path_tmp / f"{sample}.bdamage.gz.uglyprint.mismatch.txt.gz"
     stat = path_tmp / f"{sample}.bdamage.gz.uglyprint.stat.txt.gz"
 
     d_move_source_target = {
-        mismatch: config["path_mismatches_txt"],
+        get_ugly_mismatch_path(config): config["path_mismatches_txt"],
         stat: config["path_mismatches_stat"],
         path_tmp / f"{sample}.lca.gz": config["path_lca"],
         path_tmp / f"{sample}.log": config["path_lca_log"],
     }
+
+    # the mismatches were parsed straight from the pipe, there is no text file
+    if mismatches.uses_pipe(config):
+        del d_move_source_target[get_ugly_mismatch_path(config)]
     for source_path, target_path in d_move_source_target.items():
         logger.debug(f"Moving {source_path} to {target_path}.")
         if not source_path.is_file():
@@ -189,13 +225,23 @@ def move_files_non_lca(config: Config) -> None:
     sample = config["sample"]
     path_tmp = config["path_tmp"]
 
-    mismatch = path_tmp / f"{sample}.bdamage.gz.uglyprint.mismatch.txt.gz"
     stat = path_tmp / f"{sample}.stat"
 
     d_move_source_target = {
-        mismatch: config["path_mismatches_txt"],
+        get_ugly_mismatch_path(config): config["path_mismatches_txt"],
         stat: config["path_mismatches_stat"],
     }
+
+    # the mismatches were parsed straight from the pipe, there is no text file
+    if mismatches.uses_pipe(config):
+        del d_move_source_target[get_ugly_mismatch_path(config)]
+
+    # the bdamage file is read directly, so there is no print_ugly output
+    if bdamage.uses_native_reader(config):
+        d_move_source_target = {
+            path_tmp / f"{sample}.bdamage.gz": config["path_bdamage"],
+            stat: config["path_mismatches_stat"],
+        }
     for source_path, target_path in d_move_source_target.items():
         logger.debug(f"Moving {source_path} to {target_path}.")
         if not source_path.is_file():
@@ -249,6 +295,31 @@ def handle_returncode(command, line, counter):
     logger.debug(f"Got return code {returncode} from {command}.")
 
 
+def handle_line(config: Config, line: str, counter: Counter, prefix: str = "") -> None:
+
+    if "ERROR: We require files to be sorted by readname, will exit" in line:
+        logger.debug(prefix + line)
+        s = (
+            f"\n\nThe alignment file has to be sorted by filename. "
+            + f"\nUse samtools sort -n to sort the file: "
+            + f"'samtools sort -n {config['bam']}' \n"
+        )
+        raise metadamageError(s)
+
+    # continue running and logging
+    if counter[line] < 3:
+        logger.debug(prefix + line)
+
+    # do not print the same line more than 3 times
+    elif counter[line] == 3:
+        # -> Problem finding level for rank: serotype
+        logger.debug(prefix + "	...")
+        logger.debug(prefix + "	...")
+        logger.debug(prefix + "	...")
+
+    counter[line] += 1
+
+
 def run_command_helper(config: Config, command: str):
 
     # add a counter to avoid too many similar lines
@@ -259,111 +330,213 @@ def run_command_helper(config: Config, command: str):
         if isinstance(line, int):
             return handle_returncode(command, line, counter)
 
-        if "ERROR: We require files to be sorted by readname, will exit" in line:
-            logger.debug(line)
-            s = (
-                f"\n\nThe alignment file has to be sorted by filename. "
-                + f"\nUse samtools sort -n to sort the file: "
-                + f"'samtools sort -n {config['bam']}' \n"
-            )
-            raise metadamageError(s)
+        handle_line(config, line, counter)
 
-        # continue running and logging
-        if counter[line] < 3:
-            logger.debug(line)
 
-        # do not print the same line more than 3 times
-        elif counter[line] == 3:
-            # -> Problem finding level for rank: serotype
-            logger.debug("	...")
-            logger.debug("	...")
-            logger.debug("	...")
+def compute_mismatches_from_pipe(config: Config, path_pipe: Path) -> None:
+    """Parse the mismatches from the pipe and save them in the mismatch store."""
 
-        counter[line] += 1
+    config_pipe = Config(config)
+    config_pipe["path_mismatches_txt"] = path_pipe
 
+    target = get_mismatches_target(config)
+    target.parent.mkdir(parents=True, exist_ok=True)
 
-#%%
+    if tensor.uses_tensor_store(config):
+        tax_ids, counts = tensor.compute(config_pipe)
+        tensor.save(config, tax_ids, counts)
+    elif config["mismatches_chunk_size"]:
+        mismatches.compute_streaming(config_pipe, target)
+    else:
+        df_mismatches = mismatches.compute(config_pipe)
+        mismatches.save(config, df_mismatches, target)
 
+    fingerprint.save(config, "mismatches")
 
-def run_LCA(config: Config, force: bool = False) -> None:
 
-    logger.info(f"Getting LCA.")
+def run_command_into_pipe(config: Config, command: str) -> None:
+    """Run print_ugly with its mismatch output replaced by a named pipe, which is
+    parsed into the mismatch store while print_ugly is still writing to it.
+    This avoids writing (and reading back) the large mismatch text file, but not its
+    gzip compression, since print_ugly still compresses its output into the pipe."""
+
+    path_pipe = get_ugly_mismatch_path(config)
+    path_pipe.unlink(missing_ok=True)
+    os.mkfifo(path_pipe)
+
+    errors = []
+    is_parsed = threading.Event()
+
+    def run():
+        try:
+            run_command_helper(config, command)
+        except Exception as e:
+            errors.append(e)
+
+        # if the command failed before opening the pipe, the parser would wait
+        # for it forever, so open (and close) it until the parser got the EOF
+        while not is_parsed.is_set():
+            try:
+                os.close(os.open(path_pipe, os.O_WRONLY | os.O_NONBLOCK))
+            except OSError:
+                # the parser has not opened the pipe (yet)
+                pass
+            is_parsed.wait(0.1)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+
+    try:
+        compute_mismatches_from_pipe(config, path_pipe)
+    except Exception:
+        # likewise, if the parser failed before the command opened the pipe,
+        # open (and close) it until the command got a broken pipe and finished
+        is_parsed.set()
+        while thread.is_alive():
+            os.close(os.open(path_pipe, os.O_RDONLY | os.O_NONBLOCK))
+            thread.join(0.1)
+        # the parser most likely failed because the command did
+        if errors:
+            raise errors[0]
+        raise
+
+    is_parsed.set()
+    thread.join()
+    if errors:
+        raise errors[0]
+
+    path_pipe.unlink()
+
+
+#%%
+
+
+def get_cpp_targets(config: Config) -> list[Path]:
 
     targets = [
         config["path_mismatches_txt"],
         config["path_mismatches_stat"],
-        config["path_lca"],
     ]
+    if config["damage_mode"] == "lca":
+        targets.append(config["path_lca"])
 
-    if do_run(targets, force=force):
+    if bdamage.uses_native_reader(config):
+        targets[0] = config["path_bdamage"]
+    elif mismatches.uses_pipe(config):
+        targets[0] = get_mismatches_target(config)
 
-        if not BAM_file_is_valid(config):
-            raise AlignmentFileError(
-                f"{config['sample']}: The alignment file is invalid."
-            )
+    return targets
 
-        if not metaDMG_cpp_is_valid(config):
-            raise metadamageError()
 
-        config["metaDMG_cpp"]
+def do_run_cpp(config: Config, force: bool = False) -> bool:
 
-        logger.info(f"LCA has to be computed. This can take a while, please wait.")
+    targets = get_cpp_targets(config)
+    force = force or fingerprint.has_changed(config, "cpp", targets)
+    if mismatches.uses_pipe(config):
+        # the mismatches can only be parsed again by running print_ugly again
+        force = force or fingerprint.has_changed(config, "mismatches", targets[:1])
 
-        command_LCA = get_LCA_command(config)
-        command_LCA_mismatches = get_LCA_mismatches_command(config)
+    return do_run(targets, force=force)
 
-        create_tmp_dir(config)
 
-        logger.debug(command_LCA)
-        run_command_helper(config, command_LCA)
+def check_cpp_inputs(config: Config) -> None:
 
-        logger.debug(command_LCA_mismatches)
-        run_command_helper(config, command_LCA_mismatches)
+    if not BAM_file_is_valid(config):
+        raise AlignmentFileError(f"{config['sample']}: The alignment file is invalid.")
 
-        move_files(config)
-        delete_tmp_dir(config)
+    if not metaDMG_cpp_is_valid(config):
+        raise metadamageError()
+
+
+def get_cpp_commands(config: Config) -> list[str]:
+    """The metaDMG-cpp commands of the C++ stage, in order.
+    The print_ugly command (if any) is the last one."""
+
+    if config["damage_mode"] == "lca":
+        return [get_LCA_command(config), get_LCA_mismatches_command(config)]
+
+    # the bdamage file is read directly, so there is no need for print_ugly
+    if bdamage.uses_native_reader(config):
+        return [get_damage_command(config)]
+
+    return [get_damage_command(config), get_damage_ugly_command(config)]
 
+
+def finish_cpp(config: Config) -> None:
+
+    if config["damage_mode"] == "lca":
+        move_files(config)
     else:
-        logger.info(f"LCA already been run before.")
+        move_files_non_lca(config)
 
+    delete_tmp_dir(config)
+    fingerprint.save(config, "cpp")
 
-#%%
 
+def get_cpp_stage(
+    config: Config,
+    command: str,
+    into_pipe: bool,
+    measure_process: bool = True,
+):
+    """The run manifest stage of a metaDMG-cpp command, named by its subcommand
+    (lca, getdamage or print_ugly)."""
+
+    outputs = [config["path_tmp"]]
+    if into_pipe:
+        outputs.append(get_mismatches_target(config))
+
+    return manifest.stage(
+        config,
+        shlex.split(command)[1],
+        inputs=[config["bam"]],
+        outputs=outputs,
+        measure_process=measure_process,
+        trace_category="cpp",
+    )
 
-def run_damage_no_lca(config: Config, force: bool = False) -> None:
 
-    # logger.info(f"Getting damage.")
+def run_cpp_commands(config: Config) -> None:
 
-    targets = [
-        config["path_mismatches_txt"],
-        config["path_mismatches_stat"],
-    ]
+    create_tmp_dir(config)
 
-    if do_run(targets, force=force):
+    commands = get_cpp_commands(config)
+    for i, command in enumerate(commands):
+        logger.debug(command)
+        into_pipe = mismatches.uses_pipe(config) and i == len(commands) - 1
+        with get_cpp_stage(config, command, into_pipe):
+            if into_pipe:
+                run_command_into_pipe(config, command)
+            else:
+                run_command_helper(config, command)
 
-        if not BAM_file_is_valid(config):
-            raise AlignmentFileError(
-                f"{config['sample']}: The alignment file is invalid."
-            )
+    finish_cpp(config)
 
-        if not metaDMG_cpp_is_valid(config):
-            raise metadamageError()
 
-        logger.info(f"Computing mismatch matrices (without LCA).")
+def run_LCA(config: Config, force: bool = False) -> None:
+
+    logger.info(f"Getting LCA.")
+
+    if do_run_cpp(config, force=force):
+        check_cpp_inputs(config)
+        logger.info(f"LCA has to be computed. This can take a while, please wait.")
+        run_cpp_commands(config)
 
-        command_damage = get_damage_command(config)
-        command_damage_ugly = get_damage_ugly_command(config)
+    else:
+        logger.info(f"LCA already been run before.")
 
-        create_tmp_dir(config)
 
-        logger.debug(command_damage)
-        run_command_helper(config, command_damage)
+#%%
 
-        logger.debug(command_damage_ugly)
-        run_command_helper(config, command_damage_ugly)
 
-        move_files_non_lca(config)
-        delete_tmp_dir(config)
+def run_damage_no_lca(config: Config, force: bool = False) -> None:
+
+    # logger.info(f"Getting damage.")
+
+    if do_run_cpp(config, force=force):
+        check_cpp_inputs(config)
+        logger.info(f"Computing mismatch matrices (without LCA).")
+        run_cpp_commands(config)
 
     else:
         logger.info(f"Loading mismatch matrices (without LCA).")
@@ -382,23 +555,84 @@ def run_cpp(config: Config, force: bool = False) -> None:
 #%%
 
 
+def get_mismatches_target(config: Config) -> Path:
+    if tensor.uses_tensor_store(config):
+        return tensor.get_paths(config)["counts"]
+    return data_dir(config, name="mismatches")
+
+
+def get_mismatches_inputs(config: Config) -> list[Path]:
+    """The output files of the C++ stage that are parsed."""
+    if bdamage.uses_native_reader(config):
+        return [config["path_bdamage"], config["path_mismatches_stat"]]
+    return [config["path_mismatches_txt"], config["path_mismatches_stat"]]
+
+
+def get_df_mismatches_tensor(config: Config, force: bool = False) -> pd.DataFrame:
+
+    paths = tensor.get_paths(config)
+    targets = [paths["counts"], paths["tax_ids"]]
+
+    if do_load(targets, force=force) and not tensor.is_valid(config):
+        logger.info(
+            f"The sparse mismatches were made with a higher min_reads, recomputing them."
+        )
+        force = True
+
+    if do_run(targets, force=force):
+        logger.info(f"Computing sparse mismatches.")
+        with manifest.stage(
+            config,
+            "parse",
+            inputs=get_mismatches_inputs(config),
+            outputs=paths.values(),
+        ):
+            tax_ids, counts = tensor.compute(config)
+            tensor.save(config, tax_ids, counts)
+        fingerprint.save(config, "mismatches")
+
+    else:
+        logger.info(f"Loading sparse mismatches.")
+        tax_ids, counts = tensor.load(config)
+
+    return tensor.to_dataframe(config, tax_ids, counts)
+
+
 def get_df_mismatches(config: Config, force: bool = False) -> pd.DataFrame:
 
     # logger.info(f"Getting df_mismatches")
 
-    target = data_dir(config, name="mismatches")
+    target = get_mismatches_target(config)
+    force = force or fingerprint.has_changed(config, "mismatches", [target])
+
+    if tensor.uses_tensor_store(config):
+        return get_df_mismatches_tensor(config, force=force)
+
+    if do_load(target, force=force) and not mismatches.is_valid(config, target):
+        logger.info(f"The saved mismatch matrix dataframes are outdated, recomputing.")
+        force = True
 
     if do_run(target, force=force):
         logger.info(f"Computing mismatch matrix dataframes.")
-        df_mismatches = mismatches.compute(config)
         target.parent.mkdir(parents=True, exist_ok=True)
-        df_mismatches.to_parquet(target)
-
-    else:
-        logger.info(f"Loading mismatch matrix dataframes.")
-        df_mismatches = pd.read_parquet(target)
-
-    return df_mismatches
+        with manifest.stage(
+            config,
+            "parse",
+            inputs=get_mismatches_inputs(config),
+            outputs=[target],
+        ):
+            if config["mismatches_chunk_size"]:
+                mismatches.compute_streaming(config, target)
+            else:
+                df_mismatches = mismatches.compute(config)
+                mismatches.save(config, df_mismatches, target)
+        fingerprint.save(config, "mismatches")
+
+        if not config["mismatches_chunk_size"]:
+            return df_mismatches
+
+    logger.info(f"Loading mismatch matrix dataframes.")
+    return mismatches.load(target)
 
 
 #%%
@@ -408,19 +642,29 @@ def dataframe_columns_contains(df: pd.DataFrame, s: str) -> bool:
     return any(s in column for column in df.columns)
 
 
-def get_df_fit_results(
+def is_integer_tax_id(df: pd.DataFrame) -> bool:
+    return pd.api.types.is_integer_dtype(df["tax_id"])
+
+
+def load_df_fit_results(
     config: Config,
-    df_mismatches: pd.DataFrame,
     force: bool = False,
-) -> pd.DataFrame:
-
-    # logger.info(f"Getting df_fit_results.")
+) -> Optional[pd.DataFrame]:
 
     target = data_dir(config, name="fit_results")
+    force = force or fingerprint.has_changed(config, "fit_results", [target])
     if do_load(target, force=force):
         logger.info(f"Try to load fit results.")
         df_fit_results = pd.read_parquet(target)
 
+        if config["damage_mode"] == "lca" and not is_integer_tax_id(df_fit_results):
+            # from before the LCA tax IDs were saved as integers
+            try:
+                df_fit_results = df_fit_results.astype({"tax_id": "int64"})
+            except (TypeError, ValueError):
+                logger.info(f"The saved fit results are outdated, refitting.")
+                return None
+
         # if frequentist fits only, return immediately
         if not config["bayesian"]:
             logger.info(f"Loading fit results (MAP).")
@@ -431,17 +675,48 @@ def get_df_fit_results(
             logger.info(f"Loading fit results (Bayesian).")
             return df_fit_results
 
-    # Compute the fits
+    return None
+
+
+def save_df_fit_results(config: Config, df_fit_results: pd.DataFrame) -> None:
+    target = data_dir(config, name="fit_results")
+    target.parent.mkdir(parents=True, exist_ok=True)
+    with manifest.stage(config, "write", outputs=[target]):
+        df_fit_results.to_parquet(target)
+    fingerprint.save(config, "fit_results")
+
+    # the checkpointed fits are now part of the (compacted) fit results
+    checkpoint = fit_checkpoint.get_fit_checkpoint(config)
+    if checkpoint is not None:
+        checkpoint.remove()
+
+
+def log_fit_info(config: Config) -> None:
     info = "Fitting the data"
     if config["bayesian"]:
         info += " with a Bayesian model, please wait."
     else:
         info += " with a frequentist (MAP) model."
-
     logger.info(info)
-    df_fit_results = fits.compute(config, df_mismatches)
-    target.parent.mkdir(parents=True, exist_ok=True)
-    df_fit_results.to_parquet(target)
+
+
+def get_df_fit_results(
+    config: Config,
+    df_mismatches: pd.DataFrame,
+    force: bool = False,
+) -> pd.DataFrame:
+
+    # logger.info(f"Getting df_fit_results.")
+
+    df_fit_results = load_df_fit_results(config, force=force)
+    if df_fit_results is not None:
+        return df_fit_results
+
+    # Compute the fits
+    log_fit_info(config)
+    with manifest.stage(config, "fit", inputs=[get_mismatches_target(config)]):
+        df_fit_results = fits.compute(config, df_mismatches)
+    save_df_fit_results(config, df_fit_results)
 
     return df_fit_results
 
@@ -459,10 +734,12 @@ def get_df_results(
     # logger.info(f"Getting df_results.")
 
     target = data_dir(config, name="results")
+    force = force or fingerprint.has_changed(config, "results", [target])
 
     if do_load(target, force=force):
         logger.info(f"Loading results as dataframe.")
         df_results = pd.read_parquet(target)
+        partial_results.remove_partial_results(config)
 
         # if frequentist fits only, return immediately
         if not config["bayesian"]:
@@ -474,9 +751,13 @@ def get_df_results(
 
     # Compute the results:
     logger.info(f"Computing final results.")
-    df_results = results.merge(config, df_mismatches, df_fit_results)
+    with manifest.stage(config, "merge"):
+        df_results = results.merge(config, df_mismatches, df_fit_results)
     target.parent.mkdir(parents=True, exist_ok=True)
-    df_results.to_parquet(target)
+    with manifest.stage(config, "write", outputs=[target]):
+        df_results.to_parquet(target)
+    fingerprint.save(config, "results")
+    partial_results.remove_partial_results(config)
 
     return df_results
 
@@ -524,13 +805,7 @@ def metaDMG_cpp_is_valid(config: Config) -> bool:
 #%%
 
 
-def run_single_config(
-    config: Config,
-) -> Optional[Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]]:
-
-    _setup_logger(config)
-
-    force = config["force"]
+def run_cpp_and_log_errors(config: Config, force: bool = False) -> None:
 
     try:
         run_cpp(config, force=force)
@@ -551,6 +826,21 @@ def run_single_config(
         delete_tmp_dir(config)
         raise KeyboardInterrupt
 
+
+def run_cpp_and_get_df_mismatches(
+    config: Config,
+    force: bool = False,
+    force_cpp: Optional[bool] = None,
+) -> pd.DataFrame:
+    """Run the C++ stage and parse the mismatches.
+    `force_cpp` defaults to `force`, set it to False if the C++ stage was just run."""
+
+    run_cpp_and_log_errors(config, force=force if force_cpp is None else force_cpp)
+
+    if mismatches.uses_pipe(config):
+        # already parsed (if needed) while running metaDMG-cpp
+        force = False
+
     try:
         df_mismatches = get_df_mismatches(config, force=force)
     except MismatchFileError as e:
@@ -561,6 +851,20 @@ def run_single_config(
         )
         raise e
 
+    return df_mismatches
+
+
+def run_single_config(
+    config: Config,
+    force_cpp: Optional[bool] = None,
+) -> Optional[Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]]:
+
+    _setup_logger(config)
+
+    force = config["force"]
+
+    df_mismatches = run_cpp_and_get_df_mismatches(config, force, force_cpp)
+
     try:
         df_fit_results = get_df_fit_results(config, df_mismatches, force=force)
     except BadDataError as e:
@@ -580,6 +884,7 @@ def run_single_config(
 
 def run_single_config_count_errors(
     config: Config,
+    force_cpp: Optional[bool] = None,
 ) -> int:
     """Allows for using pool.map() (multiprocessing) while also counting the errors.
 
@@ -587,6 +892,8 @@ def run_single_config_count_errors(
     ----------
     config
         A config file.
+    force_cpp
+        Whether to force the C++ stage, see `run_cpp_and_get_df_mismatches`.
 
     Returns
     -------
@@ -594,7 +901,7 @@ def run_single_config_count_errors(
     """
 
     try:
-        run_single_config(config)
+        run_single_config(config, force_cpp=force_cpp)
         return 0
     except KeyboardInterrupt as e:
         raise e
@@ -0,0 +1,286 @@
+#%%
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future
+from concurrent.futures import ProcessPoolExecutor as Pool
+from concurrent.futures import wait
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+from multiprocessing import current_process
+from pathlib import Path
+
+from logger_tt import logger
+
+from metaDMG import utils
+from metaDMG.cli.cli_utils import extract_name, path_endswith
+from metaDMG.fit import manifest
+from metaDMG.fit.autotune import MemoryBudget, resolve_auto
+from metaDMG.fit.serial import run_single_config_count_errors
+from metaDMG.utils import Config, Configs
+
+
+#%%
+
+# `metaDMG serve` watches a spool directory for new alignment files (a sample each,
+# using the settings of the config file) and config files (with their own samples
+# and settings), and runs them in a pool of workers which is kept alive between the
+# samples. Files are moved to `processed/` when picked up, and to `failed/` if any
+# of their samples failed. The latency of each sample is appended to
+#   output_dir/run_manifest/serve.jsonl
+
+ALIGNMENT_SUFFIXES = (".bam", ".sam", ".sam.gz")
+CONFIG_SUFFIXES = (".yaml", ".yml")
+
+# How often (in seconds) the spool directory is checked for new files
+SPOOL_POLL_SECONDS = 5
+
+# A new file is only picked up once its size did not change for this long (in
+# seconds), such that files which are still being copied are not picked up.
+SPOOL_SETTLE_SECONDS = 10
+
+
+def is_spool_file(path: Path) -> bool:
+    if not path.is_file() or path.name.startswith("."):
+        return False
+    suffixes = ALIGNMENT_SUFFIXES + CONFIG_SUFFIXES
+    return any(path_endswith(path, suffix) for suffix in suffixes)
+
+
+class Spool:
+    """The new files of the spool directory, which are picked up once they settled."""
+
+    def __init__(self, spool_dir: Path, settle_seconds: float = SPOOL_SETTLE_SECONDS):
+        self.spool_dir = Path(spool_dir)
+        self.settle_seconds = settle_seconds
+        # path -> (size, the time the size last changed, the time it was first seen)
+        self.seen = {}
+        for state in ["processed", "failed"]:
+            (self.spool_dir / state).mkdir(parents=True, exist_ok=True)
+
+    def get_ready(self) -> list[tuple[Path, float]]:
+        """Pick up (move to `processed/`) the files that settled, returning their new
+        paths and the time they arrived."""
+
+        now = time.time()
+        paths = sorted(path for path in self.spool_dir.iterdir() if is_spool_file(path))
+        self.seen = {path: self.seen[path] for path in paths if path in self.seen}
+
+        ready = []
+        for path in paths:
+            try:
+                size = path.stat().st_size
+            except FileNotFoundError:
+                # e.g. picked up by another daemon in the meantime
+                continue
+            size_seen, changed, arrived = self.seen.get(path, (None, now, now))
+            if size != size_seen:
+                self.seen[path] = (size, now, arrived)
+                continue
+            if now - changed < self.settle_seconds:
+                continue
+
+            del self.seen[path]
+            path_processed = self.spool_dir / "processed" / path.name
+            try:
+                # only a single daemon picks up the file
+                os.rename(path, path_processed)
+            except FileNotFoundError:
+                continue
+            ready.append((path_processed, arrived))
+
+        return ready
+
+    def is_empty(self) -> bool:
+        return len(self.seen) == 0
+
+    def fail(self, path: Path) -> None:
+        os.replace(path, self.spool_dir / "failed" / path.name)
+
+
+#%%
+
+
+def get_configs(configs_base: Configs, path: Path) -> Configs:
+    """The configs of a new file: the samples (and settings) of a config file,
+    or an alignment file as a single sample with the settings of `configs_base`."""
+
+    if any(path_endswith(path, suffix) for suffix in CONFIG_SUFFIXES):
+        configs = utils.make_configs(
+            path,
+            log_port=configs_base["log_port"],
+            log_path=configs_base["log_path"],
+            force=configs_base["force"],
+        )
+        # e.g. `cores_per_sample: auto` is resolved for the samples of the file
+        resolve_auto(configs)
+        return configs
+
+    configs = Configs(configs_base)
+    configs["samples"] = {extract_name(path): path}
+    return configs
+
+
+def warm_up() -> None:
+    """Import the fit modules (e.g. JAX and numpyro) once in each worker."""
+    from metaDMG.fit import fits, serial  # noqa: F401
+
+
+def run_sample(config: Config) -> dict:
+    started = time.time()
+    N_errors = run_single_config_count_errors(config)
+    # set back the name of the (reused) process to the original name
+    current_process().name = "MainProcess"
+    return {"started": started, "finished": time.time(), "N_errors": N_errors}
+
+
+def get_result(future: Future, config: Config, submitted: float) -> dict:
+    """The result of `run_sample`, or a failed result if the worker died (e.g. killed
+    when running out of memory) or raised an error."""
+
+    try:
+        return future.result()
+    except BrokenProcessPool:
+        logger.error(f"{config['sample']} | The worker running the sample died.")
+    except Exception:
+        logger.exception(f"{config['sample']} | Error while running the sample.")
+    return {"started": submitted, "finished": time.time(), "N_errors": 1}
+
+
+def make_pool(parallel_samples: int) -> Pool:
+    return Pool(max_workers=parallel_samples, initializer=warm_up)
+
+
+def save_latency(config: Config, path: Path, arrived: float, result: dict) -> None:
+
+    latency = {
+        "sample": config["sample"],
+        "file": path.name,
+        "status": "failed" if result["N_errors"] > 0 else "done",
+        "arrived": datetime.fromtimestamp(arrived).isoformat(timespec="seconds"),
+        "wait_seconds": result["started"] - arrived,
+        "run_seconds": result["finished"] - result["started"],
+        "latency_seconds": result["finished"] - arrived,
+    }
+
+    path_latency = manifest.get_dir(config) / "serve.jsonl"
+    path_latency.parent.mkdir(parents=True, exist_ok=True)
+    with open(path_latency, "a") as f:
+        f.write(json.dumps(latency) + "\n")
+
+    logger.info(
+        f"{config['sample']} | {latency['status'].capitalize()} "
+        f"{latency['latency_seconds']:.1f} s after it arrived "
+        f"(waited {latency['wait_seconds']:.1f} s, "
+        f"ran {latency['run_seconds']:.1f} s)."
+    )
+
+
+#%%
+
+
+def serve(
+    configs: Configs,
+    spool_dir: Path,
+    once: bool = False,
+    poll_seconds: float = SPOOL_POLL_SECONDS,
+    settle_seconds: float = SPOOL_SETTLE_SECONDS,
+) -> int:
+    """Run the samples of the new files in the spool directory as they arrive, using
+    `parallel_samples` workers, which are kept alive (warm) between the samples.
+    With a `memory_budget`, a new sample is only started when it fits, see
+    `MemoryBudget`.
+
+    Parameters
+    ----------
+    configs
+        The settings used for new alignment files. Its samples are not run.
+    spool_dir
+        The directory to watch.
+    once
+        Stop when the spool directory is empty and all the samples are done,
+        instead of waiting for new files.
+
+    Returns
+    -------
+        The number of samples that failed.
+    """
+
+    # e.g. `parallel_samples: auto`, which is used for the new alignment files
+    resolve_auto(configs)
+
+    spool = Spool(spool_dir, settle_seconds)
+    budget = MemoryBudget(configs["memory_budget"])
+    parallel_samples = configs["parallel_samples"]
+
+    logger.info(
+        f"Watching {spool_dir} for new alignment and config files, "
+        f"running up to {parallel_samples} sample(s) in parallel."
+    )
+
+    samples_pending = deque()
+    running = {}
+    # the number of samples left of each file, and whether any of them failed
+    files = {}
+    N_errors = 0
+
+    pool = make_pool(parallel_samples)
+    try:
+
+        while True:
+
+            for path, arrived in spool.get_ready():
+                try:
+                    configs_file = get_configs(configs, path)
+                except Exception:
+                    logger.exception(f"Could not read the new file {path}.")
+                    spool.fail(path)
+                    continue
+
+                logger.info(f"Got {len(configs_file)} new sample(s) from {path.name}.")
+                files[path] = {"N_left": len(configs_file), "failed": False}
+                manifest.start(configs_file)
+                for config in configs_file:
+                    samples_pending.append((config, path, arrived))
+
+            while len(running) < parallel_samples and samples_pending:
+                if not budget.admit(samples_pending[0][0]):
+                    break
+                config, path, arrived = samples_pending.popleft()
+                future = pool.submit(run_sample, config)
+                running[future] = (config, path, arrived, time.time())
+
+            if once and not running and not samples_pending and spool.is_empty():
+                break
+
+            if not running:
+                time.sleep(poll_seconds)
+                continue
+
+            done, _ = wait(running, timeout=poll_seconds, return_when=FIRST_COMPLETED)
+
+            if any(isinstance(f.exception(), BrokenProcessPool) for f in done):
+                # all the samples running in the pool fail, so it is replaced
+                logger.warning("A worker died, starting a new pool of workers.")
+                pool.shutdown(wait=True, cancel_futures=True)
+                pool = make_pool(parallel_samples)
+                done = list(running)
+
+            for future in done:
+                config, path, arrived, submitted = running.pop(future)
+                budget.release(config["sample"])
+                result = get_result(future, config, submitted)
+                save_latency(config, path, arrived, result)
+
+                N_errors += result["N_errors"]
+                files[path]["failed"] |= result["N_errors"] > 0
+                files[path]["N_left"] -= 1
+                if files[path]["N_left"] == 0:
+                    if files.pop(path)["failed"]:
+                        spool.fail(path)
+
+    finally:
+        pool.shutdown()
+
+    return N_errors
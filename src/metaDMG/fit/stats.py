@@ -0,0 +1,133 @@
+#%%
+from typing import Iterator, Optional
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+from pyarrow import csv as pa_csv
+
+from metaDMG.utils import Config
+
+
+#%%
+
+
+# The columns of the LCA stat file and their types. The tax path (the last column)
+# contains tabs itself and is preceded by an empty column.
+columns_lca = {
+    "tax_id": pa.int64(),
+    "tax_name": pa.string(),
+    "tax_rank": pa.string(),
+    "N_alignments": pa.int64(),
+    "N_reads": pa.int64(),
+    "mean_L": pa.float64(),
+    "var_L": pa.float64(),
+    "mean_GC": pa.float64(),
+    "var_GC": pa.float64(),
+    "": pa.string(),
+    "tax_path": pa.string(),
+}
+
+
+def iterate_lines(filename) -> Iterator[pa.Array]:
+    """Stream the (gzipped) file as blocks of lines (without the header),
+    using the Arrow CSV reader without any delimiter or quoting."""
+
+    reader = pa_csv.open_csv(
+        filename,
+        read_options=pa_csv.ReadOptions(
+            use_threads=True,
+            skip_rows=1,
+            column_names=["line"],
+        ),
+        parse_options=pa_csv.ParseOptions(
+            delimiter="\x1f",
+            quote_char=False,
+            double_quote=False,
+        ),
+        convert_options=pa_csv.ConvertOptions(column_types={"line": pa.string()}),
+    )
+    for batch in reader:
+        yield batch.column(0)
+
+
+def parse_stats_lca_lines(lines: pa.Array) -> pa.RecordBatch:
+
+    # TODO: remove when Thorfinn updates his code
+    # The quotes are inconsistent: ' should be ignored, the tax names and ranks are
+    # quoted with ", and the tax path is unquoted but contains tabs.
+    lines = pc.replace_substring(lines, "'", "")
+    fields = pc.split_pattern(lines, "\t", max_splits=len(columns_lca) - 1)
+
+    data = {}
+    for i, (column, dtype) in enumerate(columns_lca.items()):
+        if column == "":
+            continue
+        values = pc.list_element(fields, i)
+        if column in ("tax_name", "tax_rank"):
+            values = pc.replace_substring(values, '"', "")
+        data[column] = values.cast(dtype)
+
+    return pa.RecordBatch.from_pydict(data)
+
+
+def read_stats_lca(config: Config):
+
+    # parsed block by block, such that only a single block of lines is kept in memory
+    batches = [
+        parse_stats_lca_lines(lines)
+        for lines in iterate_lines(config["path_mismatches_stat"])
+    ]
+    schema = pa.schema([(k, v) for k, v in columns_lca.items() if k != ""])
+    table = pa.Table.from_batches(batches, schema=schema)
+
+    string_columns = ["tax_name", "tax_rank", "tax_path"]
+    df_stats = table.to_pandas()
+    df_stats = df_stats.astype({column: "string" for column in string_columns})
+
+    df_stats["std_L"] = np.sqrt(df_stats["var_L"])
+    df_stats["std_GC"] = np.sqrt(df_stats["var_GC"])
+    return df_stats
+
+
+def read_stats_non_lca(config: Config):
+
+    columns = ["tax_id", "N_reads", "mean_L", "var_L", "mean_GC", "var_GC"]
+
+    # the non-LCA tax IDs are reference (contig) names
+    df_stats = pd.read_csv(
+        config["path_mismatches_stat"],
+        sep="\t",
+        names=columns,
+        usecols=columns,
+        dtype={"tax_id": "string"},
+    )
+
+    df_stats["std_L"] = np.sqrt(df_stats["var_L"])
+    df_stats["std_GC"] = np.sqrt(df_stats["var_GC"])
+    return df_stats
+
+
+def read_stats(config: Config):
+    if config["damage_mode"] == "lca":
+        return read_stats_lca(config)
+    else:
+        return read_stats_non_lca(config)
+
+
+def cut_minimum_reads(
+    config: Config,
+    df_stats: pd.DataFrame,
+) -> pd.DataFrame:
+    return df_stats.query(f"(N_reads >= {config['min_reads']})")
+
+
+def get_tax_ids_with_minimum_reads(config: Config) -> Optional[set]:
+    """The tax IDs with at least `min_reads` reads, or None if there is no cut."""
+
+    if config["min_reads"] <= 0:
+        return None
+
+    df_stat_cut = cut_minimum_reads(config, read_stats(config))
+    return set(df_stat_cut["tax_id"])
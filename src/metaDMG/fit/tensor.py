@@ -0,0 +1,278 @@
+#%%
+import json
+import os
+import uuid
+from pathlib import Path
+from typing import Iterator, Union
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from scipy import sparse
+
+from metaDMG.fit import fit_utils, mismatches
+from metaDMG.utils import Config
+
+
+#%%
+
+# The sparse mismatch store is an alternative to the long-form df_mismatches, which
+# only keeps the counts of the mismatch tensor
+#   counts[tax_id, direction, |x| - 1, ref, obs]
+# of shape [N_tax_ids, 2 (5' and 3'), L, 4, 4], with the bases in the order of
+# fit_utils.ACTG, as a CSR matrix of shape [N_tax_ids, 2 * L * 16] (the last four
+# axes flattened) with implicit zeros, plus an array of the tax IDs (in the order of
+# the mismatch file). This is much smaller for e.g. contigs in the local damage mode.
+# The derived columns (f, k, N, |x|, ...) are not stored but computed when loading,
+# for a block of ROW_BLOCK_SIZE tax IDs at a time.
+
+DIRECTIONS = ["5'", "3'"]
+
+# the file suffix of the counts of each mismatch store
+STORES = {
+    "sparse": ".npz",
+}
+
+# the number of tax IDs (rows) that are made dense at a time when loading
+ROW_BLOCK_SIZE = 10_000
+
+
+def uses_tensor_store(config: Config) -> bool:
+    return config["mismatch_store"] in STORES
+
+
+def get_paths_from_counts(path_counts: Union[Path, str]) -> dict[str, Path]:
+    # the tax IDs and metadata are named after the counts file (including its suffix),
+    # such that the stores never share them
+    path_counts = Path(path_counts)
+    return {
+        "counts": path_counts,
+        "tax_ids": path_counts.with_name(f"{path_counts.name}.tax_ids.npy"),
+        "metadata": path_counts.with_name(f"{path_counts.name}.json"),
+    }
+
+
+def get_paths(config: Config) -> dict[str, Path]:
+    suffix = STORES[config["mismatch_store"]]
+    name = f"{config['sample']}.mismatches{suffix}"
+    return get_paths_from_counts(config["output_dir"] / "mismatches" / name)
+
+
+#%%
+
+
+def get_indices(df_mismatches: pd.DataFrame):
+    """The tax IDs and, for each row, the tax ID index, direction index
+    and (zero-indexed) position, along with the number of positions, L."""
+
+    codes, tax_ids = pd.factorize(df_mismatches["tax_id"])
+    tax_ids = np.asarray(tax_ids)
+    if tax_ids.dtype == object:
+        # saved as fixed width strings, such that they can be loaded without pickle
+        tax_ids = tax_ids.astype(str)
+
+    position = df_mismatches["position"].to_numpy()
+    directions = (position < 0).astype(int)
+    positions = np.abs(position) - 1
+    L = int(positions.max()) + 1 if len(positions) > 0 else 0
+
+    return tax_ids, codes, directions, positions, L
+
+
+def from_dataframe(df_mismatches: pd.DataFrame) -> tuple[np.ndarray, sparse.csr_matrix]:
+    """Convert the (processed) long-form mismatch dataframe to the tax IDs
+    and the sparse counts."""
+
+    tax_ids, codes, directions, positions, L = get_indices(df_mismatches)
+    base_counts = df_mismatches[fit_utils.ref_obs_bases].to_numpy()
+
+    rows, bases = np.nonzero(base_counts)
+    columns = (directions[rows] * L + positions[rows]) * 16 + bases
+    counts = sparse.csr_matrix(
+        (base_counts[rows, bases], (codes[rows], columns)),
+        shape=(len(tax_ids), len(DIRECTIONS) * L * 16),
+    )
+    return tax_ids, counts
+
+
+def to_dense(counts: sparse.csr_matrix) -> np.ndarray:
+    L = counts.shape[1] // (len(DIRECTIONS) * 16)
+    return counts.toarray().reshape(-1, len(DIRECTIONS), L, 4, 4)
+
+
+def to_raw_dataframe(tax_ids: np.ndarray, counts: np.ndarray) -> pd.DataFrame:
+    """Convert the tensor back into the (long) format of the print_ugly text output,
+    i.e. the input of `mismatches.process`."""
+
+    N_tax_ids, N_directions, L, _, _ = counts.shape
+    N_rows_per_tax_id = N_directions * L
+
+    base_counts = counts.reshape(N_tax_ids * N_rows_per_tax_id, 16)
+    if np.issubdtype(base_counts.dtype, np.integer):
+        base_counts = base_counts.astype(np.int64)
+    else:
+        base_counts = base_counts.astype(np.float64)
+
+    df = pd.DataFrame(base_counts, columns=fit_utils.ref_obs_bases)
+    df.insert(0, "tax_id", np.repeat(tax_ids.astype(object), N_rows_per_tax_id))
+    df.insert(1, "direction", np.tile(np.repeat(DIRECTIONS, L), N_tax_ids))
+    df.insert(2, "position", np.tile(np.arange(L), N_tax_ids * N_directions))
+    return df
+
+
+def iterate_row_blocks(
+    tax_ids: np.ndarray,
+    counts: sparse.csr_matrix,
+    block_size: int = ROW_BLOCK_SIZE,
+) -> Iterator[tuple[np.ndarray, sparse.csr_matrix]]:
+    """The non-empty rows of the counts, in blocks of (at most) `block_size` rows.
+    Tax IDs without any counts are never fitted (max_N_in_group == 0),
+    so they are skipped."""
+
+    rows = np.flatnonzero(np.diff(counts.indptr) > 0)
+    for start in range(0, len(rows), block_size):
+        rows_block = rows[start : start + block_size]
+        yield tax_ids[rows_block], counts[rows_block]
+
+
+def iterate_dataframes(
+    config: Config,
+    tax_ids: np.ndarray,
+    counts: sparse.csr_matrix,
+    block_size: int = ROW_BLOCK_SIZE,
+) -> Iterator[pd.DataFrame]:
+    """The long-form df_mismatches, including the derived columns, for a block of
+    tax IDs at a time, such that only a single block of the counts is dense."""
+
+    for tax_ids_block, counts_block in iterate_row_blocks(tax_ids, counts, block_size):
+        df = to_raw_dataframe(tax_ids_block, to_dense(counts_block))
+        yield mismatches.process(config, df)
+
+
+def to_dataframe(
+    config: Config,
+    tax_ids: np.ndarray,
+    counts: sparse.csr_matrix,
+    block_size: int = ROW_BLOCK_SIZE,
+) -> pd.DataFrame:
+    """The long-form df_mismatches, including the derived columns. The blocks
+    (see `iterate_dataframes`) are collected with the same schema as the mismatches
+    parsed in chunks (see `mismatches.get_schema`), such that the types are the same
+    as when loading the parquet store."""
+
+    tables = []
+    for df in iterate_dataframes(config, tax_ids, counts, block_size):
+        if len(tables) == 0:
+            schema = mismatches.get_schema(config, list(df.columns))
+        tables.append(pa.Table.from_pandas(df, schema=schema, preserve_index=False))
+        del df
+
+    if len(tables) == 0:
+        df = to_raw_dataframe(tax_ids[:0], to_dense(counts[:0]))
+        return mismatches.process(config, df)
+
+    table = pa.concat_tables(tables)
+    del tables
+    return mismatches.table_to_dataframe(table)
+
+
+#%%
+
+
+def compute(config: Config) -> tuple[np.ndarray, sparse.csr_matrix]:
+    """Parse the mismatches into the sparse counts. With `mismatches_chunk_size`,
+    only a single chunk is kept in the long format at a time."""
+
+    if not config["mismatches_chunk_size"]:
+        return from_dataframe(mismatches.compute(config))
+
+    tax_ids, counts = [], []
+    for df in mismatches.iterate_chunks(config):
+        tax_ids_chunk, counts_chunk = from_dataframe(mismatches.process(config, df))
+        if len(tax_ids_chunk) > 0:
+            tax_ids.append(tax_ids_chunk)
+            counts.append(counts_chunk)
+
+    if len(tax_ids) == 0:
+        return from_dataframe(mismatches.process(config, df))
+
+    return np.concatenate(tax_ids), sparse.vstack(counts, format="csr")
+
+
+def get_metadata(config: Config) -> dict:
+    return {
+        **mismatches.get_metadata(config),
+        "sample": config["sample"],
+        "damage_mode": config["damage_mode"],
+        "forward_only": config["forward_only"],
+    }
+
+
+def save(config: Config, tax_ids: np.ndarray, counts: sparse.csr_matrix) -> None:
+    paths = get_paths(config)
+    paths["counts"].parent.mkdir(parents=True, exist_ok=True)
+    paths["metadata"].unlink(missing_ok=True)
+
+    for key, data in [("tax_ids", tax_ids), ("counts", counts)]:
+        path = paths[key]
+        path_tmp = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+        with open(path_tmp, "wb") as f:
+            if key == "counts":
+                sparse.save_npz(f, data)
+            else:
+                np.save(f, data)
+        os.replace(path_tmp, path)
+
+    # written last, such that it only exists for a complete store
+    paths["metadata"].write_text(json.dumps(get_metadata(config)))
+
+
+def load_paths(paths: dict[str, Path]) -> tuple[np.ndarray, sparse.csr_matrix]:
+    tax_ids = np.load(paths["tax_ids"])
+    counts = sparse.load_npz(paths["counts"]).tocsr()
+    return tax_ids, counts
+
+
+def load(config: Config) -> tuple[np.ndarray, sparse.csr_matrix]:
+    return load_paths(get_paths(config))
+
+
+def select(
+    tax_ids: np.ndarray,
+    counts: sparse.csr_matrix,
+    tax_ids_to_keep: list,
+) -> tuple[np.ndarray, sparse.csr_matrix]:
+    """Only the rows of the tax IDs in `tax_ids_to_keep`."""
+
+    mask = np.isin(tax_ids, list(tax_ids_to_keep))
+    indices = np.flatnonzero(mask)
+    return tax_ids[indices], counts[indices]
+
+
+def load_tax_ids(config: Config, tax_ids_to_keep: list) -> pd.DataFrame:
+    """The long-form df_mismatches of only the tax IDs in `tax_ids_to_keep`,
+    without expanding the rest of the counts."""
+
+    tax_ids, counts = select(*load(config), tax_ids_to_keep)
+    return to_dataframe(config, tax_ids, counts)
+
+
+def load_dataframe(path_counts: Union[Path, str]) -> pd.DataFrame:
+    """The long-form df_mismatches of a saved sparse store, using the settings it was
+    saved with."""
+
+    paths = get_paths_from_counts(path_counts)
+    metadata = json.loads(paths["metadata"].read_text())
+    return to_dataframe(metadata, *load_paths(paths))
+
+
+def is_valid(config: Config) -> bool:
+    """Whether the sparse store contains all the tax IDs needed,
+    see `mismatches.is_valid`."""
+
+    path = get_paths(config)["metadata"]
+    if not path.exists():
+        return False
+
+    min_reads = json.loads(path.read_text())["min_reads"]
+    return min_reads <= config["min_reads"]
@@ -0,0 +1,135 @@
+#%%
+import json
+import os
+import shutil
+import socket
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from multiprocessing import current_process
+from pathlib import Path
+
+from logger_tt import logger
+
+from metaDMG.utils import Config, Configs
+
+
+#%%
+
+# With `--trace`, every process writes its spans as trace events (one per line) to
+#   output_dir/trace/{host}.{pid}.{id}.jsonl
+# (unique for each process, also of the workers of a queue on other nodes)
+# which are merged into a single Chrome/Perfetto trace-event file at the end:
+#   output_dir/trace.json
+# (open it in https://ui.perfetto.dev or chrome://tracing).
+
+_lock = threading.Lock()
+
+# The name of the trace file of this process, see `get_file_name`
+_process = {"pid": None}
+
+
+def get_dir(config: Config) -> Path:
+    return config["output_dir"] / "trace"
+
+
+def get_path(config: Config) -> Path:
+    return config["output_dir"] / "trace.json"
+
+
+def get_file_name() -> str:
+    # set again in (forked) child processes
+    if _process["pid"] != os.getpid():
+        _process["pid"] = os.getpid()
+        host = socket.gethostname()
+        _process["name"] = f"{host}.{os.getpid()}.{uuid.uuid4().hex[:8]}.jsonl"
+    return _process["name"]
+
+
+def is_enabled(config: Config) -> bool:
+    return bool(config.get("trace"))
+
+
+def _now() -> float:
+    """The wall clock time in microseconds, comparable between processes."""
+    return time.time_ns() / 1000
+
+
+def add_span(config: Config, name: str, ts: float, category: str, **args) -> None:
+    """Add a complete event, which started at `ts` (see `_now`) and ends now."""
+
+    event = {
+        "name": name,
+        "cat": category,
+        "ph": "X",
+        "ts": ts,
+        "dur": _now() - ts,
+        "pid": os.getpid(),
+        "tid": threading.get_native_id(),
+        "args": {
+            "sample": config["sample"],
+            "worker": current_process().name,
+            **args,
+        },
+    }
+
+    path = get_dir(config) / get_file_name()
+    with _lock:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "a") as f:
+            f.write(json.dumps(event, default=str) + "\n")
+
+
+@contextmanager
+def span(config: Config, name: str, category: str = "stage", **args):
+    """Record the time spent in the block as a span of the trace (if enabled)."""
+
+    if not is_enabled(config):
+        yield
+        return
+
+    ts = _now()
+    try:
+        yield
+    finally:
+        add_span(config, name, ts, category, **args)
+
+
+#%%
+
+
+def start(configs: Configs) -> None:
+    """Remove the trace events of a previous (interrupted) run."""
+    if is_enabled(configs):
+        shutil.rmtree(get_dir(configs), ignore_errors=True)
+
+
+def merge(configs: Configs) -> None:
+    """Merge the trace events of all the processes into a single trace file."""
+
+    if not is_enabled(configs):
+        return
+
+    events = []
+    for path in sorted(get_dir(configs).glob("*.jsonl")):
+        with open(path, "r") as f:
+            events.extend(json.loads(line) for line in f if line.strip())
+
+    # the workers are shown by their process ID, the main process by name
+    events.append(
+        {
+            "name": "process_name",
+            "ph": "M",
+            "pid": os.getpid(),
+            "tid": 0,
+            "args": {"name": "metaDMG (main)"},
+        }
+    )
+
+    path = get_path(configs)
+    with open(path, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+    shutil.rmtree(get_dir(configs), ignore_errors=True)
+
+    logger.info(f"Saved the trace of the run to {path}.")
@@ -1,12 +1,154 @@
 # from multiprocessing import Pool
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED
 from concurrent.futures import ProcessPoolExecutor as Pool
+from concurrent.futures import wait
 from datetime import datetime
 from multiprocessing import current_process
+from time import perf_counter
 
 from logger_tt import logger
 
+from metaDMG.fit import manifest, profiling, trace
+from metaDMG.fit.autotune import (
+    MEMORY_CHECK_INTERVAL,
+    MEMORY_MINIMUM,
+    MemoryBudget,
+    get_available_cores,
+    get_available_memory,
+    resolve_auto,
+)
+from metaDMG.fit.cpp_runner import CppRunner
+from metaDMG.fit.scheduler import get_N_cores, run_global_scheduler
 from metaDMG.fit.serial import run_single_config_count_errors
-from metaDMG.utils import Configs
+from metaDMG.utils import Config, Configs
+
+
+def get_N_cores_free(configs: Configs) -> int:
+    """The cores not used by the fits of the current sample."""
+    N_cores = configs.get("max_cores") or get_available_cores()
+    return N_cores - configs["cores_per_sample"]
+
+
+def get_N_cpp_workers(configs: Configs) -> int:
+    """The number of C++ stages to run ahead at the same time: `cpp_lookahead`,
+    limited by the cores not used by the fits of the current sample."""
+    return max(min(configs["cpp_lookahead"], get_N_cores_free(configs)), 0)
+
+
+def can_run_ahead(budget: MemoryBudget, config: Config) -> bool:
+    if budget.budget is None:
+        return get_available_memory() >= MEMORY_MINIMUM
+    return budget.admit(config)
+
+
+def run_pipelined(configs: Configs) -> int:
+    """Run the samples one after another, while running the C++ stage (LCA or
+    getdamage) of the next `cpp_lookahead` samples in the background.
+
+    The C++ stage is mostly I/O-bound and single-threaded, while the fits are
+    CPU-bound, so this keeps both the disk and the cores busy. The C++ stages run
+    ahead on the cores not used by the fits (see `get_N_cpp_workers`), supervised by
+    a `CppRunner`. With a `memory_budget`, a sample is only run ahead when its
+    estimated peak memory fits, together with the current sample, see `MemoryBudget`.
+    Otherwise, it is only run ahead if there is at least `MEMORY_MINIMUM` of available
+    memory.
+
+    Parameters
+    ----------
+    configs
+        A Configs object containing the configuration parameters for the workflow.
+
+    Returns
+    -------
+        The number of samples that failed.
+    """
+
+    configs_list = list(configs)
+    N_workers = get_N_cpp_workers(configs)
+    lookahead = configs["cpp_lookahead"]
+    configs.check_number_of_jobs(N_jobs=configs["cores_per_sample"] + N_workers)
+    budget = MemoryBudget(configs["memory_budget"])
+
+    logger.info(
+        f"Running the samples in serial, each using {configs['cores_per_sample']} "
+        f"core(s), with the C++ stage of up to {N_workers} sample(s) running ahead."
+    )
+
+    futures = {}
+    N_errors = 0
+
+    runner = CppRunner(max_jobs=N_workers, N_cores=get_N_cores_free(configs))
+    with runner:
+
+        for i, config in enumerate(configs_list):
+
+            # the current sample always runs (it was admitted, if it was run ahead)
+            if config["sample"] not in futures:
+                budget.admit(config)
+
+            for config_ahead in configs_list[i + 1 : i + 1 + lookahead]:
+                sample = config_ahead["sample"]
+                N_running = sum(not future.done() for future in futures.values())
+                if sample in futures or N_running >= N_workers:
+                    continue
+                if not can_run_ahead(budget, config_ahead):
+                    logger.debug(f"Not enough memory to run {sample} ahead yet.")
+                    break
+                futures[sample] = runner.submit(config_ahead, config_ahead["force"])
+
+            future = futures.pop(config["sample"], None)
+            if future is None:
+                N_errors += run_single_config_count_errors(config)
+            elif future.result() > 0:
+                N_errors += 1
+            else:
+                # the C++ stage was just run (forced, if force)
+                N_errors += run_single_config_count_errors(config, force_cpp=False)
+
+            budget.release(config["sample"])
+
+    return N_errors
+
+
+def run_parallel(configs: Configs, parallel_samples: int) -> int:
+    """Run `parallel_samples` samples in parallel. With a `memory_budget`, a new
+    sample is only started when its estimated peak memory fits, see `MemoryBudget`.
+
+    Returns
+    -------
+        The number of samples that failed.
+    """
+
+    if not configs["memory_budget"]:
+        with Pool(max_workers=parallel_samples) as pool:
+            return sum(pool.map(run_single_config_count_errors, configs))
+
+    budget = MemoryBudget(configs["memory_budget"])
+    samples_pending = deque(configs)
+    running = {}
+    N_errors = 0
+
+    with Pool(max_workers=parallel_samples) as pool:
+
+        while samples_pending or running:
+
+            while len(running) < parallel_samples and samples_pending:
+                if not budget.admit(samples_pending[0]):
+                    break
+                config = samples_pending.popleft()
+                running[pool.submit(run_single_config_count_errors, config)] = config
+
+            # wait with a timeout when a sample is waiting for memory,
+            # since the measured memory of the running samples changes
+            timeout = MEMORY_CHECK_INTERVAL if samples_pending else None
+            done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                budget.release(running.pop(future)["sample"])
+                N_errors += future.result()
+
+    return N_errors
 
 
 def run_workflow(configs: Configs) -> int:
@@ -22,13 +164,25 @@ def run_workflow(configs: Configs) -> int:
         _description_
     """
 
-    parallel_samples = min(configs["parallel_samples"], len(configs))
-
     logger.info(f"Running metaDMG on {len(configs)} files in total.")
 
+    resolve_auto(configs)
+    manifest.start(configs)
+    trace.start(configs)
+    profiling.start(configs)
+    time_start = perf_counter()
+    parallel_samples = min(configs["parallel_samples"], len(configs))
+
     N_errors = 0
 
-    if parallel_samples == 1 or len(configs) == 1:
+    if configs["scheduler"] == "global":
+        configs.check_number_of_jobs(N_jobs=get_N_cores(configs))
+        N_errors += run_global_scheduler(configs)
+
+    elif parallel_samples == 1 and len(configs) > 1 and get_N_cpp_workers(configs):
+        N_errors += run_pipelined(configs)
+
+    elif parallel_samples == 1 or len(configs) == 1:
         N = configs["cores_per_sample"]
         s = f"Running the samples in serial (sequentially), each using {N} core(s)."
         logger.info(s)
@@ -39,13 +193,15 @@ def run_workflow(configs: Configs) -> int:
         logger.info(f"Running with {parallel_samples} processes in parallel")
         configs.check_number_of_jobs()
 
-        with Pool(max_workers=parallel_samples) as pool:
-            for n_error in pool.map(run_single_config_count_errors, configs):
-                N_errors += n_error
+        N_errors += run_parallel(configs, parallel_samples)
 
     # set back the name of the process to the original name
     current_process().name = "MainProcess"
 
+    manifest.save_summary(configs, perf_counter() - time_start, N_errors)
+    trace.merge(configs)
+    profiling.save_report(configs)
+
     if N_errors > 0:
         logger.error(f"{N_errors} error(s) occurred during the computation.")
 
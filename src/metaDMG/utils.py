@@ -55,11 +55,16 @@ class Configs(dict):
                 config["path_mismatches_stat"] = dir_lca / f"{sample}.stat.txt"
 
             config["path_lca"] = dir_lca / f"{sample}.lca.txt.gz"
+            config["path_bdamage"] = dir_lca / f"{sample}.bdamage.gz"
             config["path_lca_log"] = dir_lca / f"{sample}.log.txt"
             config["path_tmp"] = config["output_dir"] / "tmp" / sample
 
             config["path_pmd"] = dir_pmd / f"{sample}.pmd.txt.gz"
 
+            # allow for sample specific number of cores
+            if sample in self.get("sample_cores", {}):
+                config["cores_per_sample"] = self["sample_cores"][sample]
+
             yield config
 
     def get_nth(self, n: int) -> Config:
@@ -97,12 +102,19 @@ class Configs(dict):
         """
         return len(self["samples"].keys())
 
-    def check_number_of_jobs(self) -> None:
-        """Compare the number of configs to the number of parallel_samples used."""
+    def check_number_of_jobs(self, N_jobs: Optional[int] = None) -> None:
+        """Compare the number of configs to the number of parallel_samples used.
+
+        Parameters
+        ----------
+        N_jobs
+            The total number of jobs, by default parallel_samples * cores_per_sample
+        """
 
-        parallel_samples = min(self["parallel_samples"], len(self["samples"]))
-        cores_per_sample = self["cores_per_sample"]
-        N_jobs = parallel_samples * cores_per_sample
+        if N_jobs is None:
+            parallel_samples = min(self["parallel_samples"], len(self["samples"]))
+            cores_per_sample = self["cores_per_sample"]
+            N_jobs = parallel_samples * cores_per_sample
         max_cores = psutil.cpu_count(logical=True)
         max_cores_real = psutil.cpu_count(logical=False)
 
@@ -126,6 +138,8 @@ def make_configs(
     log_port: Optional[int] = None,
     log_path: Optional[str] = None,
     force: bool = False,
+    trace: bool = False,
+    profile: bool = False,
 ) -> Configs:
     """Create an instance of Configs from a config file
 
@@ -139,6 +153,10 @@ def make_configs(
         Optional log path, by default None
     force
         Whether or not the computations are force, by default False
+    trace
+        Whether or not to save a trace of the run, by default False
+    profile
+        Whether or not to profile the run, by default False
 
     Returns
     -------
@@ -170,9 +188,30 @@ def make_configs(
     d.setdefault("cores_per_sample", 1)
     d.setdefault("damage_mode", "lca")
     d.setdefault("min_reads", 0)
+    d.setdefault("fit_cache_dir", None)
+    d.setdefault("fit_cache_max_size", 1000)
+    d.setdefault("scheduler", "static")
+    d.setdefault("max_cores", None)
+    d.setdefault("checkpoint", False)
+    d.setdefault("checkpoint_every_N_taxa", 1000)
+    d.setdefault("checkpoint_every_seconds", 300)
+    d.setdefault("fit_order", "")
+    d.setdefault("partial_results", False)
+    d.setdefault("partial_results_every_seconds", 60)
+    d.setdefault("mismatches_chunk_size", None)
+    d.setdefault("bdamage_reader", "print_ugly")
+    d.setdefault("mismatch_store", "parquet")
+    d.setdefault("mismatches_pipe", False)
+    d.setdefault("cpp_lookahead", 0)
+    d.setdefault("cpp_max_jobs", None)
+    d.setdefault("memory_budget", None)
+    d.setdefault("queue_lease_seconds", 600)
+    d.setdefault("queue_max_attempts", 3)
     d["force"] = force
+    d["trace"] = trace
+    d["profile"] = profile
 
-    paths = ["names", "nodes", "acc2tax", "output_dir", "config_file"]
+    paths = ["names", "nodes", "acc2tax", "output_dir", "config_file", "fit_cache_dir"]
     for path in paths:
         if d[path]:
             d[path] = Path(d[path])
@@ -100,6 +100,14 @@ def correct_for_non_LCA(df):
     return df
 
 
+def set_tax_id_dtype(df):
+    # LCA tax IDs are integers, non-LCA ones are (categorical) reference names
+    if pd.api.types.is_integer_dtype(df["tax_id"]):
+        return df
+    df["tax_id"] = df["tax_id"].astype("str").astype("category")
+    return df
+
+
 #%%
 
 
@@ -137,9 +145,7 @@ class VizResults:
         df = self._load_parquet_file(self.results_dir)
         df = sort_dataframe(df)
 
-        # force tax_id to be categorical strings.
-        # XXX remove in final version
-        df["tax_id"] = df["tax_id"].astype("str").astype("category")
+        df = set_tax_id_dtype(df)
 
         add_MAP_measures(df)
 
@@ -202,6 +208,20 @@ class VizResults:
         self.max_of_size = np.max(self.df["size"])
         self.marker_size = slider
 
+    def parse_tax_id(self, tax_id):
+        """Convert a tax ID (e.g. from the dashboard or the command line)
+        to the type of the tax_id column."""
+        if pd.api.types.is_integer_dtype(self.df["tax_id"]):
+            try:
+                return int(tax_id)
+            except ValueError:
+                # not a (LCA) tax ID, such that it matches nothing
+                pass
+        return str(tax_id)
+
+    def parse_tax_ids(self, tax_ids):
+        return [self.parse_tax_id(tax_id) for tax_id in tax_ids]
+
     def filter(self, filters, *, rank=None):
 
         query = ""
@@ -217,10 +237,10 @@ class VizResults:
                 query += f"(sample == '{filter}') & "
 
             elif column == "tax_id":
-                query += f"(tax_id == '{filter}') & "
+                query += f"(tax_id == {self.parse_tax_id(filter)!r}) & "
 
             elif column == "tax_ids":
-                query += f"(tax_id in {filter}) & "
+                query += f"(tax_id in {self.parse_tax_ids(filter)}) & "
 
             elif column == "tax_rank":
                 query += f"(tax_rank == {filter}) & "
@@ -429,7 +449,7 @@ class VizResults:
             raise e
 
     def get_single_count_group(self, sample, tax_id, forward_only=False):
-        query = f"sample == '{sample}' & tax_id == '{tax_id}'"
+        query = f"sample == '{sample}' & tax_id == {self.parse_tax_id(tax_id)!r}"
         group_wide = self.df.query(query)
         group = wide_to_long_df(group_wide).dropna(axis="rows")
 
@@ -439,7 +459,7 @@ class VizResults:
             return group
 
     def get_single_fit_prediction(self, sample, tax_id, forward_only=False):
-        query = f"sample == '{sample}' & tax_id == '{tax_id}'"
+        query = f"sample == '{sample}' & tax_id == {self.parse_tax_id(tax_id)!r}"
         ds = self.df.query(query)
         if len(ds) != 1:
             raise AssertionError(f"Something wrong here, got: {ds}")
@@ -486,7 +506,7 @@ class VizResults:
         return d_out
 
     def get_D(self, sample, tax_id):
-        query = f"sample == '{sample}' & tax_id == '{tax_id}'"
+        query = f"sample == '{sample}' & tax_id == {self.parse_tax_id(tax_id)!r}"
         ds = self.df.query(query)
 
         if len(ds) != 1:
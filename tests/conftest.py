@@ -0,0 +1,30 @@
+#%%
+import pytest
+
+from metaDMG import __version__, utils
+
+
+#%%
+
+
+@pytest.fixture
+def configs(tmp_path):
+    samples = "\n".join(f"  sample{i}: sample{i}.bam" for i in range(5))
+    config_file = tmp_path / "config.yaml"
+    config_file.write_text(
+        f"samples:\n{samples}\n"
+        f"output_dir: {tmp_path / 'data'}\n"
+        f"config_file: {config_file}\n"
+        "damage_mode: local\n"
+        "names: null\n"
+        "nodes: null\n"
+        "acc2tax: null\n"
+        "custom_database: false\n"
+        "parallel_samples: 1\n"
+        "cores_per_sample: 1\n"
+        "bayesian: false\n"
+        "max_position: 15\n"
+        "queue_max_attempts: 2\n"
+        f"version: {__version__}\n"
+    )
+    return utils.make_configs(config_file)
@@ -0,0 +1,126 @@
+#%%
+import subprocess
+import sys
+
+from metaDMG.fit import autotune
+
+
+#%%
+
+
+def make_estimates(times_fit: list[float]) -> list[dict]:
+    return [
+        {"sample": f"sample{i}", "time_serial": 0, "time_fit": time_fit, "memory": 1e9}
+        for i, time_fit in enumerate(times_fit)
+    ]
+
+
+def get_max_cores_in_use(sample_cores: dict, estimates, parallel_samples, C) -> int:
+    cores = sorted(
+        (sample_cores.get(e["sample"], C) for e in estimates),
+        reverse=True,
+    )
+    return sum(cores[:parallel_samples])
+
+
+#%%
+
+
+def test_sample_cores_of_large_sample():
+    estimates = make_estimates([1, 1, 1, 1, 100])
+    sample_cores = autotune.get_sample_cores(estimates, 16, 4, 4)
+
+    assert sample_cores["sample4"] == 8
+    assert get_max_cores_in_use(sample_cores, estimates, 4, 4) <= 16
+
+    # faster than without the extra cores
+    time_default = autotune.estimate_wall_time(estimates, 4, 4)
+    time_sample_cores = autotune.estimate_wall_time(estimates, 4, 4, sample_cores)
+    assert time_sample_cores < time_default
+
+
+def test_sample_cores_stay_within_the_cores():
+    estimates = make_estimates([1, 1, 1, 1, 100, 100, 100, 100])
+    for N_cores in [4, 8, 16, 64]:
+        for P in [2, 3, 4, 8]:
+            C = max(N_cores // P, 1)
+            sample_cores = autotune.get_sample_cores(estimates, N_cores, P, C)
+            if sample_cores:
+                assert get_max_cores_in_use(sample_cores, estimates, P, C) <= N_cores
+
+
+def test_sample_cores_of_similar_samples():
+    estimates = make_estimates([1, 2, 3, 2])
+    assert autotune.get_sample_cores(estimates, 16, 4, 4) == {}
+
+
+def test_memory_budget(configs, monkeypatch):
+    def estimate_sample(config):
+        return {"sample": config["sample"], "memory": 1e9}
+
+    monkeypatch.setattr(autotune, "estimate_sample", estimate_sample)
+    monkeypatch.setattr(autotune, "get_memory_of_children", lambda idle: 0)
+
+    config0, config1, config2, *_ = configs
+    budget = autotune.MemoryBudget(2.5)
+    assert budget.admit(config0)
+    assert budget.admit(config1)
+    assert not budget.admit(config2)
+
+    budget.release("sample0")
+    assert budget.admit(config2)
+
+
+def test_memory_budget_uses_the_measured_memory(configs, monkeypatch):
+    def estimate_sample(config):
+        return {"sample": config["sample"], "memory": 1e9}
+
+    monkeypatch.setattr(autotune, "estimate_sample", estimate_sample)
+    monkeypatch.setattr(autotune, "get_memory_of_children", lambda idle: 2e9)
+
+    config0, config1, *_ = configs
+    budget = autotune.MemoryBudget(2.5)
+    assert budget.admit(config0)
+    # the running sample uses more memory than estimated
+    assert not budget.admit(config1)
+
+
+def test_memory_budget_of_large_sample(configs, monkeypatch):
+    def estimate_sample(config):
+        return {"sample": config["sample"], "memory": 10e9}
+
+    monkeypatch.setattr(autotune, "estimate_sample", estimate_sample)
+    monkeypatch.setattr(autotune, "get_memory_of_children", lambda idle: 0)
+
+    config0, config1, *_ = configs
+    budget = autotune.MemoryBudget(2.5)
+    # larger than the budget, so it is run alone
+    assert budget.admit(config0)
+    assert not budget.admit(config1)
+    budget.release("sample0")
+    assert budget.admit(config1)
+
+    # without a budget, all samples are admitted
+    budget = autotune.MemoryBudget(None)
+    assert all(budget.admit(config) for config in configs)
+
+
+def test_memory_of_idle_workers_is_not_counted():
+    idle_worker_memory = autotune.get_idle_worker_memory()
+    assert idle_worker_memory > 0
+
+    # a Python worker and another program (like metaDMG-cpp)
+    worker = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(30)"])
+    try:
+        assert autotune.get_memory_of_children(0) > 0
+        assert autotune.get_memory_of_children(float("inf")) == 0
+    finally:
+        worker.kill()
+        worker.wait()
+
+    program = subprocess.Popen(["sleep", "30"])
+    try:
+        assert autotune.get_memory_of_children(float("inf")) > 0
+    finally:
+        program.kill()
+        program.wait()
@@ -0,0 +1,96 @@
+#%%
+import shutil
+import subprocess
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+from metaDMG.errors import MismatchFileError
+from metaDMG.fit import bdamage, mismatches, serial
+from metaDMG.utils import Config
+
+
+#%%
+
+path_testdata = Path(__file__).parent / "testdata"
+
+# the bdamage file of the two references of alignment.sorted.bam (printlength 5),
+# together with its print_ugly output. Both are written by hand in the metaDMG-cpp
+# formats, see `test_native_reader_equals_getdamage` for the real metaDMG-cpp output.
+path_bdamage = path_testdata / "alignment.sorted.bdamage.gz"
+path_print_ugly = (
+    path_testdata / "alignment.sorted.bdamage.gz.uglyprint.mismatch.txt.gz"
+)
+
+
+@pytest.fixture
+def config(configs):
+    config = Config(configs.get_first(), damage_mode="local", max_position=5)
+    config["bam"] = path_testdata / "alignment.sorted.bam"
+    config["path_bdamage"] = path_bdamage
+    config["path_mismatches_txt"] = path_print_ugly
+    return config
+
+
+#%%
+
+
+def test_reference_names():
+    names = bdamage.read_bam_reference_names(path_testdata / "alignment.sorted.bam")
+    assert names == ["GCA_000007325.1", "GCA_000344275.1"]
+
+
+def test_native_reader_equals_print_ugly(config):
+
+    df_print_ugly = mismatches.compute(Config(config, bdamage_reader="print_ugly"))
+    df_native = mismatches.compute(Config(config, bdamage_reader="native"))
+
+    assert set(df_native["tax_id"]) == {"GCA_000007325.1", "GCA_000344275.1"}
+    pd.testing.assert_frame_equal(df_native, df_print_ugly)
+
+
+@pytest.mark.skipif(
+    shutil.which("metaDMG-cpp") is None,
+    reason="metaDMG-cpp is not installed",
+)
+def test_native_reader_equals_getdamage(config, tmp_path):
+
+    config = Config(config, metaDMG_cpp="metaDMG-cpp", cpp_threads=1)
+    config["path_tmp"] = tmp_path
+    config["path_bdamage"] = tmp_path / f"{config['sample']}.bdamage.gz"
+    config["path_mismatches_txt"] = serial.get_ugly_mismatch_path(config)
+
+    for command in [
+        serial.get_damage_command(config),
+        serial.get_damage_ugly_command(config),
+    ]:
+        subprocess.run(command.split(), cwd=tmp_path, check=True)
+
+    df_print_ugly = mismatches.compute(Config(config, bdamage_reader="print_ugly"))
+    df_native = mismatches.compute(Config(config, bdamage_reader="native"))
+    assert set(df_native["tax_id"]) == {"GCA_000007325.1", "GCA_000344275.1"}
+    pd.testing.assert_frame_equal(df_native, df_print_ugly)
+
+
+def test_native_reader_chunks(config):
+
+    names = bdamage.read_bam_reference_names(config["bam"])
+    df = bdamage.read_bdamage(config)
+
+    # a single record per chunk
+    chunks = list(bdamage.iterate_bdamage(path_bdamage, names, chunk_size=1e-6))
+    assert len(chunks) == 2
+    assert all(chunk["tax_id"].nunique() == 1 for chunk in chunks)
+    pd.testing.assert_frame_equal(pd.concat(chunks, ignore_index=True), df)
+
+    df_kept = bdamage.read_bdamage(config, tax_ids={"GCA_000344275.1"})
+    assert set(df_kept["tax_id"]) == {"GCA_000344275.1"}
+    assert len(df_kept) == len(df) // 2
+
+
+def test_invalid_file(tmp_path):
+    path = tmp_path / "invalid.bdamage.gz"
+    path.write_bytes(b"")
+    with pytest.raises(MismatchFileError):
+        list(bdamage.iterate_bdamage(path, []))
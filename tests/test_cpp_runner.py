@@ -0,0 +1,97 @@
+#%%
+import asyncio
+import time
+
+from metaDMG.fit import cpp_runner, scheduler, serial
+from metaDMG.fit.cpp_runner import CppRunner, split_cores
+from metaDMG.utils import Config
+
+
+#%%
+
+
+def test_split_cores():
+    assert split_cores(8, 2) == 4
+    assert split_cores(8, 3) == 2
+    # at least one thread each
+    assert split_cores(2, 4) == 1
+    assert split_cores(8, 0) == 8
+
+
+def test_cpp_threads_of_the_static_scheduler(configs):
+    config = Config(configs.get_first(), max_cores=8)
+    assert serial.get_cpp_threads(config) == 8
+    assert serial.get_cpp_threads(Config(config, parallel_samples=2)) == 4
+    # not more samples in parallel than there are samples
+    assert serial.get_cpp_threads(Config(config, parallel_samples=100)) == 1
+    assert serial.get_cpp_threads(Config(config, cpp_threads=3)) == 3
+
+
+def test_cpp_runner_limits(configs, monkeypatch):
+    running = []
+    max_running = 0
+    threads = {}
+
+    async def run_cpp(config, force=False):
+        nonlocal max_running
+        running.append(config["sample"])
+        max_running = max(max_running, len(running))
+        threads[config["sample"]] = config["cpp_threads"]
+        await asyncio.sleep(0.05)
+        running.remove(config["sample"])
+
+    monkeypatch.setattr(cpp_runner, "run_cpp", run_cpp)
+
+    configs_list = list(configs)
+    with CppRunner(max_jobs=2, N_cores=8) as runner:
+        futures = [runner.submit(config) for config in configs_list[:4]]
+        assert [future.result() for future in futures] == [0] * 4
+        # a sample submitted on its own gets all the cores
+        assert runner.submit(configs_list[4]).result() == 0
+
+    assert max_running == 2
+    assert threads == {f"sample{i}": 4 for i in range(4)} | {"sample4": 8}
+
+
+def test_cpp_runner_errors(configs, monkeypatch):
+    async def run_cpp(config, force=False):
+        if config["sample"] == "sample1":
+            raise ValueError("metaDMG-cpp failed")
+
+    monkeypatch.setattr(cpp_runner, "run_cpp", run_cpp)
+
+    # a failed sample does not stop the others
+    with CppRunner(max_jobs=2, N_cores=8) as runner:
+        futures = [runner.submit(config) for config in configs]
+        assert [future.result() for future in futures] == [0, 1, 0, 0, 0]
+
+
+def test_run_cpp_does_not_block_the_event_loop(configs, monkeypatch):
+    def blocking(config, *args, **kwargs):
+        time.sleep(0.2)
+        return True
+
+    monkeypatch.setattr(serial, "do_run_cpp", blocking)
+    monkeypatch.setattr(serial, "check_cpp_inputs", lambda config: None)
+    monkeypatch.setattr(serial, "create_tmp_dir", lambda config: None)
+    monkeypatch.setattr(serial, "get_cpp_commands", lambda config: [])
+    monkeypatch.setattr(serial, "finish_cpp", blocking)
+
+    async def run_cpps():
+        await asyncio.gather(*[cpp_runner.run_cpp(config) for config in configs])
+
+    # the file system calls of the samples run at the same time
+    start = time.monotonic()
+    asyncio.run(run_cpps())
+    assert time.monotonic() - start < 5 * 0.4 / 2
+
+
+def test_cpp_threads_of_the_global_scheduler():
+    # the pending samples that do not get a core now are not counted
+    assert scheduler.get_N_preparing(8, {}, N_samples_pending=100) == 8
+    assert scheduler.get_N_preparing(8, {}, N_samples_pending=1) == 2
+    assert split_cores(8, scheduler.get_N_preparing(8, {}, 1)) == 4
+
+    tasks_running = {1: ("prepare", "a"), 2: ("fit", "b"), 3: ("fit", "b")}
+    assert scheduler.get_N_preparing(8, tasks_running, N_samples_pending=0) == 2
+    assert scheduler.get_N_preparing(4, tasks_running, N_samples_pending=5) == 2
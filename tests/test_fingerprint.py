@@ -0,0 +1,69 @@
+#%%
+import pytest
+
+from metaDMG.fit import fingerprint
+from metaDMG.utils import Config
+
+
+#%%
+
+
+@pytest.fixture
+def config(configs, tmp_path):
+    config = configs.get_first()
+    config["bam"] = tmp_path / "sample0.bam"
+    config["bam"].write_text("bam")
+    config["metaDMG_cpp"] = tmp_path / "metaDMG-cpp"
+    config["metaDMG_cpp"].write_text("binary")
+
+    for stage in fingerprint.STAGES:
+        fingerprint.save(config, stage)
+    return config
+
+
+def get_changed(config: Config) -> list[str]:
+    return [
+        stage
+        for stage in fingerprint.STAGES
+        if fingerprint.has_changed(config, stage, outputs=[])
+    ]
+
+
+#%%
+
+
+def test_unchanged(config):
+    assert get_changed(config) == []
+    assert get_changed(Config(config, parallel_samples=4)) == []
+
+
+def test_changes_propagate_to_the_later_stages(config):
+    assert get_changed(Config(config, max_position=10)) == fingerprint.STAGES
+    assert get_changed(Config(config, forward_only=True)) == fingerprint.STAGES[1:]
+    assert get_changed(Config(config, min_reads=100)) == fingerprint.STAGES[2:]
+    assert get_changed(Config(config, bayesian=True)) == fingerprint.STAGES[2:]
+
+
+def test_changed_files(config):
+    config["metaDMG_cpp"].write_text("new binary")
+    assert get_changed(config) == fingerprint.STAGES
+
+
+def test_stage_versions(config, monkeypatch):
+    versions = {**fingerprint.STAGE_VERSIONS, "fit_results": 2}
+    monkeypatch.setattr(fingerprint, "STAGE_VERSIONS", versions)
+    assert get_changed(config) == fingerprint.STAGES[2:]
+
+
+def test_only_saved_with_outputs(configs, tmp_path):
+    config = configs.get_first()
+    output = tmp_path / "results.parquet"
+
+    assert not fingerprint.has_changed(config, "results", [output])
+    assert fingerprint.load(config, "results") is None
+
+    output.write_text("results")
+    assert not fingerprint.has_changed(config, "results", [output])
+    assert fingerprint.load(config, "results") == fingerprint.get_fingerprint(
+        config, "results"
+    )
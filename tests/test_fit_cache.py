@@ -0,0 +1,89 @@
+#%%
+import os
+
+import numpy as np
+import pandas as pd
+
+from metaDMG.fit import fit_cache
+from metaDMG.fit.fit_cache import FitCache
+
+
+#%%
+
+config = {"max_position": 15, "forward_only": False, "bayesian": False}
+
+
+def make_group(tax_id: int, k: int) -> pd.DataFrame:
+    df = pd.DataFrame({"position": [1, 2, -1, -2]})
+    for base in fit_cache.fit_utils.ref_obs_bases:
+        df[base] = k
+    df["tax_id"] = tax_id
+    return df
+
+
+#%%
+
+
+def test_cache_hit_and_miss(tmp_path):
+    cache = FitCache(tmp_path / "cache")
+
+    df_mismatches = pd.concat([make_group(1, 10), make_group(2, 20)])
+    d_fit_results, d_keys = cache.lookup(config, df_mismatches)
+    assert d_fit_results == {}
+    assert set(d_keys) == {1, 2}
+
+    cache.store({1: {"D_max": 0.1}}, d_keys)
+
+    # the same counts (in another sample) hit the cache, other counts miss
+    df_mismatches = pd.concat([make_group(3, 10), make_group(4, 30)])
+    d_fit_results, d_keys = cache.lookup(config, df_mismatches)
+    assert d_fit_results == {3: {"D_max": 0.1}}
+
+    # other fit settings miss
+    d_fit_results, _ = cache.lookup({**config, "forward_only": True}, df_mismatches)
+    assert d_fit_results == {}
+
+
+def test_group_key_is_independent_of_dtype():
+    settings_hash = fit_cache.get_settings_hash(config)
+    group = make_group(1, 10)
+
+    keys = set()
+    for dtype in [np.uint32, np.int64, np.float32, np.float64]:
+        group_dtype = group.astype(
+            {base: dtype for base in fit_cache.fit_utils.ref_obs_bases}
+        )
+        group_dtype["position"] = group_dtype["position"].astype(np.int8)
+        keys.add(fit_cache.get_group_key(group_dtype, settings_hash))
+    assert len(keys) == 1
+
+    # other counts give another key
+    assert fit_cache.get_group_key(make_group(1, 11), settings_hash) not in keys
+
+
+def test_cache_eviction(tmp_path):
+    cache = FitCache(tmp_path / "cache", max_size=0.01)
+    entry = {"values": list(range(1000))}
+
+    for i in range(20):
+        cache.store({i: entry}, {i: f"{i:04d}"})
+        # the oldest entries are the least recently used
+        os.utime(cache._path(f"{i:04d}"), (i, i))
+
+    sizes = [size for _, size, _ in cache.get_entries()]
+    assert sum(sizes) <= cache.get_max_bytes()
+    assert cache.size == sum(sizes)
+    assert cache.get("0000") is None
+    assert cache.get("0019") == entry
+
+
+def test_cache_is_only_scanned_when_full(tmp_path, monkeypatch):
+    cache = FitCache(tmp_path / "cache", max_size=1)
+    cache.store({1: {"D_max": 0.1}}, {1: "0001"})
+
+    def get_entries():
+        raise AssertionError("The cache was scanned below its max size.")
+
+    monkeypatch.setattr(cache, "get_entries", get_entries)
+    cache.store({2: {"D_max": 0.2}}, {2: "0002"})
+    assert cache.get("0002") == {"D_max": 0.2}
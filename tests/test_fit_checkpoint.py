@@ -0,0 +1,56 @@
+#%%
+import pytest
+
+from metaDMG.fit import serial
+from metaDMG.fit.fit_checkpoint import FitCheckpoint, get_checkpoint_dir
+from metaDMG.utils import Config
+
+
+#%%
+
+
+@pytest.fixture
+def config(configs):
+    config = configs.get_first()
+    path = serial.get_mismatches_target(config)
+    path.parent.mkdir(parents=True)
+    path.write_bytes(b"mismatches")
+    return config
+
+
+def test_checkpoint_resume(config):
+    checkpoint = FitCheckpoint(config, N_taxa=2)
+    checkpoint.add({1: {"D_max": 0.1}})
+    checkpoint.add({2: {"D_max": 0.2}})
+    # killed before the next flush
+    checkpoint.add({3: {"D_max": 0.3}})
+
+    checkpoint = FitCheckpoint(config, N_taxa=2)
+    assert checkpoint.load() == {1: {"D_max": 0.1}, 2: {"D_max": 0.2}}
+
+    # the newer parts take precedence
+    checkpoint.add({2: {"D_max": 0.25}, 3: {"D_max": 0.3}})
+    assert FitCheckpoint(config).load() == {
+        1: {"D_max": 0.1},
+        2: {"D_max": 0.25},
+        3: {"D_max": 0.3},
+    }
+
+    checkpoint.remove()
+    assert not get_checkpoint_dir(config).parent.exists()
+
+
+def test_stale_checkpoint_is_discarded(config):
+    checkpoint = FitCheckpoint(config, N_taxa=1)
+    checkpoint.add({1: {"D_max": 0.1}})
+
+    # other fit settings
+    assert FitCheckpoint(Config(config, forward_only=True)).load() == {}
+    assert not get_checkpoint_dir(config).exists()
+
+    checkpoint = FitCheckpoint(config, N_taxa=1)
+    checkpoint.add({1: {"D_max": 0.1}})
+
+    # other mismatches
+    serial.get_mismatches_target(config).write_bytes(b"other mismatches")
+    assert FitCheckpoint(config).load() == {}
@@ -0,0 +1,41 @@
+#%%
+import numpy as np
+import pandas as pd
+import pytest
+
+from metaDMG.fit import fits
+
+
+#%%
+
+
+def make_df_mismatches(N_tax_ids: int) -> pd.DataFrame:
+    rng = np.random.default_rng(42)
+    tax_ids = rng.permutation(N_tax_ids) + 100
+    df = pd.DataFrame(
+        {
+            "tax_id": np.repeat(tax_ids, 4),
+            "position": np.tile([1, 2, -1, -2], N_tax_ids),
+        }
+    )
+    # interleave the rows of the tax IDs
+    return df.sample(frac=1, random_state=42)
+
+
+@pytest.mark.parametrize("N_splits", [1, 3, 7, 20])
+def test_split_by_tax_ids(N_splits):
+    df = make_df_mismatches(N_tax_ids=10)
+    tax_ids = df["tax_id"].unique()
+
+    chunks = fits.split_by_tax_ids(df, tax_ids, N_splits)
+    assert len(chunks) == N_splits
+
+    for chunk, tax_ids_chunk in zip(chunks, np.array_split(tax_ids, N_splits)):
+        expected = df.query("tax_id in @tax_ids_chunk")
+        expected = expected.iloc[
+            np.argsort(
+                pd.Categorical(expected["tax_id"], categories=tax_ids_chunk).codes,
+                kind="stable",
+            )
+        ]
+        pd.testing.assert_frame_equal(chunk, expected)
@@ -0,0 +1,158 @@
+#%%
+import json
+import os
+import threading
+import time
+from collections import Counter
+
+import pytest
+
+from metaDMG.errors import QueueError
+from metaDMG.fit import job_queue
+
+
+#%%
+
+
+def test_claim_is_exclusive(configs, tmp_path):
+    queue_dir = tmp_path / "queue"
+    assert job_queue.enqueue(configs, queue_dir) == 5
+
+    claimed = []
+    for worker in ["worker1", "worker2"] * 3:
+        path = job_queue.claim(queue_dir, worker)
+        if path is not None:
+            claimed.append(json.loads(path.read_text())["sample"])
+
+    assert sorted(claimed) == [f"sample{i}" for i in range(5)]
+    assert job_queue.get_jobs(queue_dir, "pending") == []
+
+    # the queue is still running
+    with pytest.raises(QueueError):
+        job_queue.enqueue(configs, queue_dir)
+
+
+def test_expired_lease_is_retried(configs, tmp_path):
+    queue_dir = tmp_path / "queue"
+    job_queue.enqueue(configs, queue_dir)
+
+    def claim_and_expire(worker):
+        path = job_queue.claim(queue_dir, worker)
+        old = time.time() - 100
+        os.utime(path, (old, old))
+        job_queue.recover_expired(queue_dir, lease_seconds=10, max_attempts=2)
+        return path
+
+    path = claim_and_expire("dead_worker1")
+    job = json.loads((job_queue.get_dir(queue_dir, "pending") / path.name).read_text())
+    assert job["attempts"] == 1
+
+    # claims the same job again (the first in order)
+    assert claim_and_expire("dead_worker2").name == path.name
+    assert job_queue.get_jobs(queue_dir, "failed") == [
+        job_queue.get_dir(queue_dir, "failed") / path.name
+    ]
+
+
+def test_interrupted_release_is_recovered(configs, tmp_path, monkeypatch):
+    queue_dir = tmp_path / "queue"
+    job_queue.enqueue(configs, queue_dir)
+    path = job_queue.claim(queue_dir, "dead_worker")
+
+    # the worker dies after moving the job out of running
+    def _load_json(path):
+        raise SystemExit()
+
+    with monkeypatch.context() as m:
+        m.setattr(job_queue, "_load_json", _load_json)
+        with pytest.raises(SystemExit):
+            job_queue.release(queue_dir, path, max_attempts=2, reason="failed")
+
+    (path_retry,) = job_queue.get_jobs(queue_dir, "retry")
+    assert job_queue.get_jobs(queue_dir, "running") == []
+    with pytest.raises(QueueError):
+        job_queue.enqueue(configs, queue_dir)
+
+    # not before the lease expired
+    job_queue.recover_expired(queue_dir, lease_seconds=10, max_attempts=2)
+    assert job_queue.get_jobs(queue_dir, "retry") == [path_retry]
+
+    old = time.time() - 100
+    os.utime(path_retry, (old, old))
+    job_queue.recover_expired(queue_dir, lease_seconds=10, max_attempts=2)
+    assert job_queue.get_jobs(queue_dir, "retry") == []
+    path_pending = job_queue.get_dir(queue_dir, "pending") / path.name
+    assert json.loads(path_pending.read_text())["attempts"] == 1
+    assert len(job_queue.get_jobs(queue_dir, "pending")) == len(configs["samples"])
+
+
+def test_workers_drain_queue(configs, tmp_path):
+    queue_dir = tmp_path / "queue"
+    job_queue.enqueue(configs, queue_dir)
+
+    counter = Counter()
+    lock = threading.Lock()
+
+    def run_job(config):
+        with lock:
+            counter[config["sample"]] += 1
+        time.sleep(0.05)
+        return 1 if config["sample"] == "sample3" else 0
+
+    N_errors = [0, 0, 0]
+
+    def run_worker(i):
+        N_errors[i] = job_queue.run_worker(queue_dir, poll_seconds=0.1, run_job=run_job)
+
+    threads = [threading.Thread(target=run_worker, args=(i,)) for i in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # every sample is run once, except the failing one, which is retried
+    assert counter == {
+        "sample0": 1,
+        "sample1": 1,
+        "sample2": 1,
+        "sample3": 2,
+        "sample4": 1,
+    }
+    assert sum(N_errors) == 2
+
+    summary = json.loads((queue_dir / "summary.json").read_text())
+    assert sorted(summary["done"]) == ["sample0", "sample1", "sample2", "sample4"]
+    assert list(summary["failed"]) == ["sample3"]
+
+
+def test_claim_is_not_recovered_before_it_is_written(configs, tmp_path, monkeypatch):
+    queue_dir = tmp_path / "queue"
+    job_queue.enqueue(configs, queue_dir)
+
+    # an old job file, e.g. enqueued long ago
+    path_pending = job_queue.get_dir(queue_dir, "pending") / "sample0.json"
+    old = time.time() - 100
+    os.utime(path_pending, (old, old))
+
+    load_json = job_queue._load_json
+    lease_seconds = {"value": 10}
+
+    def _load_json(path):
+        # another worker recovers the expired jobs between the rename and the write
+        if path.parent.parent.name == "running":
+            job_queue.recover_expired(queue_dir, lease_seconds["value"], 2)
+        return load_json(path)
+
+    monkeypatch.setattr(job_queue, "_load_json", _load_json)
+
+    # the lease started before the rename, so the job is not expired
+    path = job_queue.claim(queue_dir, "worker1")
+    assert path.name == "sample0.json"
+    job = load_json(path)
+    assert job["attempts"] == 1 and job["worker"] == "worker1"
+
+    # if they are released anyway, they are not written back to running
+    lease_seconds["value"] = -1
+    assert job_queue.claim(queue_dir, "worker2") is None
+    assert job_queue.get_jobs(queue_dir, "running") == []
+    assert len(job_queue.get_jobs(queue_dir, "pending")) == 5
@@ -0,0 +1,62 @@
+#%%
+import json
+
+import pytest
+
+from metaDMG.fit import manifest
+
+
+#%%
+
+
+def test_manifest(configs, tmp_path):
+    config = configs.get_first()
+    path_input = tmp_path / "input.txt"
+    path_input.write_text("x" * 100)
+    path_output = tmp_path / "output.txt"
+
+    manifest.start(configs)
+    with manifest.stage(config, "parse", inputs=[path_input], outputs=[path_output]):
+        path_output.write_text("x" * 10)
+    with manifest.stage(config, "print_ugly", measure_process=False):
+        pass
+
+    data = json.loads(manifest.get_path(config).read_text())
+    assert data["sample"] == "sample0"
+    assert [record["stage"] for record in data["stages"]] == ["parse", "print_ugly"]
+
+    parse, print_ugly = data["stages"]
+    assert set(parse) == {
+        "stage",
+        "wall_time",
+        "cpu_time",
+        "peak_rss",
+        "input_bytes",
+        "output_bytes",
+    }
+    assert parse["input_bytes"] == 100
+    assert parse["output_bytes"] == 10
+    assert parse["wall_time"] >= 0 and parse["cpu_time"] >= 0
+    assert parse["peak_rss"] > 0
+    # not measured next to other samples in the same process
+    assert print_ugly["cpu_time"] is None and print_ugly["peak_rss"] is None
+
+
+def test_manifest_summary(configs):
+    config0, config1, *_ = configs
+
+    manifest.start(configs)
+    for config in [config0, config1]:
+        with manifest.stage(config, "fit"):
+            pass
+
+    manifest.save_summary(configs, wall_time=1.5, N_errors=1)
+    summary = json.loads((manifest.get_dir(configs) / "workflow.json").read_text())
+
+    assert summary["N_samples"] == 5
+    assert summary["N_errors"] == 1
+    assert summary["wall_time"] == 1.5
+    assert list(summary["stages"]) == ["fit"]
+    assert summary["samples"]["sample2"] == {}
+    wall_times = [summary["samples"][f"sample{i}"]["wall_time"] for i in range(2)]
+    assert summary["stages"]["fit"]["wall_time"] == pytest.approx(sum(wall_times))
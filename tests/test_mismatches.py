@@ -0,0 +1,331 @@
+#%%
+import gzip
+import json
+import shutil
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from metaDMG.errors import MismatchFileError, metadamageError
+from metaDMG.fit import fit_utils, mismatches, serial
+from metaDMG.utils import Config
+
+
+#%%
+
+
+def write_mismatch_file(path, counts_by_tax_id: dict, max_position: int = 15) -> None:
+    header = ["#taxid", "direction", "position", *fit_utils.ref_obs_bases]
+    with gzip.open(path, "wt") as f:
+        f.write("\t".join(header) + "\n")
+        for tax_id, counts in counts_by_tax_id.items():
+            for direction in ["5'", "3'"]:
+                for position in range(max_position):
+                    values = [str(count) for count in counts(position)]
+                    f.write("\t".join([str(tax_id), direction, str(position)]))
+                    f.write("\t" + "\t".join(values) + "\n")
+
+
+def get_counts(tax_id: int):
+    rng = np.random.default_rng(tax_id)
+    return lambda position: rng.integers(1, 1000, size=16)
+
+
+@pytest.fixture
+def config(configs, tmp_path):
+    config = Config(configs.get_first(), damage_mode="lca")
+    config["path_mismatches_txt"] = tmp_path / "sample0.mismatches.txt.gz"
+    return config
+
+
+def compute_streaming(config: Config, target) -> pd.DataFrame:
+    mismatches.compute_streaming(config, target)
+    return mismatches.load(target)
+
+
+#%%
+
+
+def test_streaming_equals_non_streaming(config, tmp_path):
+    tax_ids = range(1000, 1200)
+    write_mismatch_file(
+        config["path_mismatches_txt"],
+        {tax_id: get_counts(tax_id) for tax_id in tax_ids},
+    )
+
+    df_mismatches = mismatches.compute(config)
+
+    config_streaming = Config(config, mismatches_chunk_size=0.01)
+    target = tmp_path / "mismatches.parquet"
+    df_streaming = compute_streaming(config_streaming, target)
+
+    # several chunks
+    assert mismatches.pq.ParquetFile(target).num_row_groups > 1
+    pd.testing.assert_frame_equal(df_mismatches, df_streaming, check_categorical=False)
+
+
+@pytest.mark.parametrize("with_floats", [False, True])
+def test_streaming_later_chunks_with_other_types(config, tmp_path, with_floats):
+    def get_counts_large(position):
+        return [2**33 + position] * 16
+
+    def get_counts_float(position):
+        # only some of the counts are not integers
+        return [10.5] * 8 + [10] * 8
+
+    counts_by_tax_id = {tax_id: get_counts(tax_id) for tax_id in range(1000, 1100)}
+    counts_by_tax_id[2000] = get_counts_large
+    if with_floats:
+        counts_by_tax_id[3000] = get_counts_float
+    write_mismatch_file(config["path_mismatches_txt"], counts_by_tax_id)
+
+    config_streaming = Config(config, mismatches_chunk_size=0.01)
+    target = tmp_path / "mismatches.parquet"
+    df_streaming = compute_streaming(config_streaming, target)
+
+    df_mismatches = mismatches.compute(config)
+    pd.testing.assert_frame_equal(
+        df_mismatches,
+        df_streaming,
+        check_categorical=False,
+    )
+
+    dtype = "float32" if with_floats else "uint64"
+    assert df_streaming["AA"].dtype == df_streaming["TT"].dtype == dtype
+    assert df_streaming["k_sum_total"].dtype == dtype
+    if with_floats:
+        assert df_streaming.query("tax_id == 3000")["CT"].eq(10.5).all()
+
+
+path_testdata = (
+    Path(__file__).parent
+    / "testdata"
+    / "alignment.sorted.bdamage.gz.uglyprint.mismatch.txt.gz"
+)
+
+
+def read_mismatches_pandas(filename) -> pd.DataFrame:
+    # the reader before the Arrow one
+    return mismatches.rename_columns(pd.read_csv(filename, sep="\t"))
+
+
+@pytest.fixture(params=[False, True], ids=["arrow", "pigz"])
+def use_pigz(request, monkeypatch):
+    if request.param and shutil.which("pigz") is None:
+        pytest.skip("pigz is not installed")
+    if not request.param:
+        monkeypatch.setattr(mismatches.shutil, "which", lambda name: None)
+    return request.param
+
+
+def test_read_mismatches_equals_pandas(use_pigz):
+    df = mismatches.rename_columns(mismatches.read_mismatches(path_testdata))
+    pd.testing.assert_frame_equal(df, read_mismatches_pandas(path_testdata))
+
+    tax_ids = {"GCA_000344275.1"}
+    df = mismatches.rename_columns(mismatches.read_mismatches(path_testdata, tax_ids))
+    df_pandas = read_mismatches_pandas(path_testdata).query("tax_id in @tax_ids")
+    pd.testing.assert_frame_equal(df, df_pandas.reset_index(drop=True))
+
+
+def test_iterate_mismatches_equals_pandas(use_pigz):
+    # small enough that the chunk boundaries split the rows of a tax ID
+    chunk_size = 500 / 1024**2
+    dfs = list(mismatches.iterate_mismatches(path_testdata, chunk_size))
+
+    df_pandas = read_mismatches_pandas(path_testdata)
+    assert len(dfs) == df_pandas["tax_id"].nunique()
+    for df in dfs:
+        assert df["tax_id"].nunique() == 1
+
+    df = pd.concat(dfs, ignore_index=True)
+    pd.testing.assert_frame_equal(df, df_pandas)
+
+
+@pytest.mark.parametrize("content", ["", "\t".join(mismatches.columns) + "\n"])
+def test_read_empty_mismatches(tmp_path, use_pigz, content):
+    filename = tmp_path / "mismatches.txt.gz"
+    with gzip.open(filename, "wt") as f:
+        f.write(content)
+
+    with pytest.raises(MismatchFileError):
+        mismatches.read_mismatches(filename)
+    with pytest.raises(MismatchFileError):
+        list(mismatches.iterate_mismatches(filename, chunk_size=1))
+
+
+def test_read_missing_mismatches(tmp_path, use_pigz):
+    filename = tmp_path / "mismatches.txt.gz"
+
+    with pytest.raises(FileNotFoundError):
+        read_mismatches_pandas(filename)
+    with pytest.raises(FileNotFoundError):
+        mismatches.read_mismatches(filename)
+    with pytest.raises(FileNotFoundError):
+        list(mismatches.iterate_mismatches(filename, chunk_size=1))
+
+
+def add_k_sum_counts_groupby(df):
+    # the implementation before the vectorized one
+    def compute_k_sum_total(group):
+        k_sum_total = 0
+        k_sum_total += group[group.position > 0]["CT"].sum()
+        k_sum_total += group[group.position < 0]["GA"].sum()
+        return k_sum_total
+
+    ds = df.groupby("tax_id").apply(compute_k_sum_total)
+    ds = ds.reset_index().rename(columns={0: "k_sum_total"})
+    return pd.merge(df, ds, on=["tax_id"])
+
+
+def add_min_max_N_in_group_groupby(df):
+    def compute_min_max_N_in_group(group):
+        min_N, max_N = group["N"].min(), group["N"].max()
+        return pd.Series({"min_N_in_group": min_N, "max_N_in_group": max_N})
+
+    ds = df.groupby("tax_id").apply(compute_min_max_N_in_group).reset_index()
+    return pd.merge(df, ds, on=["tax_id"])
+
+
+@pytest.mark.parametrize("forward_only", [False, True])
+def test_k_sum_and_min_max_N_equal_groupby(config, forward_only):
+    config = Config(config, forward_only=forward_only)
+
+    rng = np.random.default_rng(42)
+    df = read_mismatches_pandas(path_testdata)
+    # a tax ID with a single position and one with only zero counts
+    df_single = df.iloc[:1].assign(tax_id="single")
+    df_zeros = df.iloc[:4].assign(tax_id="zeros")
+    df_zeros[fit_utils.ref_obs_bases] = 0
+    df = pd.concat([df_single, df, df_zeros], ignore_index=True)
+    # interleave the tax IDs
+    df = df.iloc[rng.permutation(len(df))].reset_index(drop=True)
+
+    df = (
+        df.pipe(mismatches.select_read_directions, config)
+        .pipe(
+            mismatches.add_reference_counts,
+            config,
+            mismatches.bases_forward,
+            mismatches.bases_reverse,
+        )
+        .pipe(mismatches.make_position_1_indexed)
+        .pipe(mismatches.make_reverse_position_negative)
+        .pipe(mismatches.add_k_N_x_names, config)
+    )
+    df["row"] = np.arange(len(df))
+
+    df_vectorized = mismatches.add_k_sum_counts(df.copy())
+    df_vectorized = mismatches.add_min_max_N_in_group(df_vectorized, config)
+
+    df_groupby = add_min_max_N_in_group_groupby(add_k_sum_counts_groupby(df.copy()))
+    df_groupby = df_groupby.sort_values("row", ignore_index=True)
+
+    assert set(df_vectorized["tax_id"]) >= {"single", "zeros"}
+    for column in ["k_sum_total", "min_N_in_group", "max_N_in_group"]:
+        np.testing.assert_array_equal(df_vectorized[column], df_groupby[column])
+
+    is_zeros = df_vectorized["tax_id"] == "zeros"
+    assert (df_vectorized.loc[is_zeros, "k_sum_total"] == 0).all()
+
+
+def write_stat_file(path, N_reads_by_tax_id: dict) -> None:
+    with open(path, "w") as f:
+        f.write("header\n")
+        for tax_id, N_reads in N_reads_by_tax_id.items():
+            values = [tax_id, '"name"', '"species"', N_reads, N_reads]
+            values += [40.0, 10.0, 0.5, 0.01, "", "tax\tpath"]
+            f.write("\t".join(str(value) for value in values) + "\n")
+
+
+def test_min_reads_while_parsing(config, tmp_path):
+    tax_ids = range(1000, 1010)
+    write_mismatch_file(
+        config["path_mismatches_txt"],
+        {tax_id: get_counts(tax_id) for tax_id in tax_ids},
+    )
+    config["path_mismatches_stat"] = tmp_path / "sample0.stat.txt"
+    write_stat_file(config["path_mismatches_stat"], {i: 100 * i for i in tax_ids})
+
+    config_cut = Config(config, min_reads=100_500, mismatches_pipe=False)
+    df_mismatches = mismatches.compute(config_cut)
+    assert set(df_mismatches["tax_id"]) == set(range(1005, 1010))
+
+    target = tmp_path / "mismatches.parquet"
+    mismatches.save(config_cut, df_mismatches, target)
+    metadata = mismatches.pq.read_schema(target).metadata[mismatches.METADATA_KEY]
+    assert json.loads(metadata) == {"min_reads": 100_500}
+
+    # the cut tax IDs are needed with a lower min_reads, but not with a higher one
+    assert mismatches.is_valid(config_cut, target)
+    assert mismatches.is_valid(Config(config_cut, min_reads=200_000), target)
+    assert not mismatches.is_valid(Config(config_cut, min_reads=0), target)
+
+    # nothing is cut while parsing from the pipe, since the stat file is not done yet
+    config_pipe = Config(config_cut, mismatches_pipe=True)
+    assert mismatches.get_min_reads_filter(config_pipe) == 0
+    assert set(mismatches.compute(config_pipe)["tax_id"]) == set(tax_ids)
+
+
+@pytest.fixture
+def config_pipe(config, tmp_path):
+    config = Config(config, mismatches_pipe=True)
+    config["path_tmp"] = tmp_path / "tmp"
+    config["path_tmp"].mkdir()
+    return config
+
+
+def test_pipe(config_pipe, tmp_path, monkeypatch):
+    path_txt = tmp_path / "mismatches.txt.gz"
+    write_mismatch_file(path_txt, {tax_id: get_counts(tax_id) for tax_id in range(10)})
+
+    def run_command_helper(config, command):
+        with open(serial.get_ugly_mismatch_path(config), "wb") as f:
+            f.write(path_txt.read_bytes())
+
+    monkeypatch.setattr(serial, "run_command_helper", run_command_helper)
+    serial.run_command_into_pipe(config_pipe, "print_ugly")
+
+    df_pipe = mismatches.load(serial.get_mismatches_target(config_pipe))
+    df_mismatches = mismatches.compute(
+        Config(config_pipe, path_mismatches_txt=path_txt)
+    )
+    pd.testing.assert_frame_equal(df_pipe, df_mismatches, check_categorical=False)
+    assert not serial.get_ugly_mismatch_path(config_pipe).exists()
+
+
+def test_pipe_command_fails_before_opening_it(config_pipe, monkeypatch):
+    def run_command_helper(config, command):
+        raise metadamageError("print_ugly failed")
+
+    # the parser gets an EOF instead of waiting for the command forever
+    monkeypatch.setattr(serial, "run_command_helper", run_command_helper)
+    with pytest.raises(metadamageError):
+        serial.run_command_into_pipe(config_pipe, "print_ugly")
+
+
+def test_pipe_parser_fails_before_opening_it(config_pipe, monkeypatch):
+    errors = []
+
+    def run_command_helper(config, command):
+        try:
+            with open(serial.get_ugly_mismatch_path(config), "wb") as f:
+                time.sleep(0.1)
+                f.write(b"\0" * 2**20)
+        except BrokenPipeError as e:
+            errors.append(e)
+
+    def compute_mismatches_from_pipe(config, path_pipe):
+        raise ValueError("parsing failed")
+
+    # the command gets a broken pipe instead of waiting for the parser forever
+    monkeypatch.setattr(serial, "run_command_helper", run_command_helper)
+    monkeypatch.setattr(
+        serial, "compute_mismatches_from_pipe", compute_mismatches_from_pipe
+    )
+    with pytest.raises(ValueError):
+        serial.run_command_into_pipe(config_pipe, "print_ugly")
+    assert len(errors) == 1
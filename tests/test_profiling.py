@@ -0,0 +1,41 @@
+#%%
+from metaDMG.fit import profiling
+
+
+#%%
+
+
+def work() -> int:
+    return sum(i * i for i in range(10_000))
+
+
+def test_profiling(configs):
+    configs["profile"] = True
+    config = configs.get_first()
+    directory = profiling.get_dir(configs)
+
+    # the profiles of a previous run are removed
+    directory.mkdir(parents=True)
+    (directory / "old.1.prof").write_text("")
+
+    profiling.start(configs)
+    with profiling.profile(config, "fit"):
+        work()
+        # nested blocks are not profiled separately
+        with profiling.profile(config, "parse"):
+            work()
+    profiling.save_report(configs)
+
+    assert [path.name.split(".")[0] for path in directory.glob("*.prof")] == ["fit"]
+    report = (directory / "report.txt").read_text()
+    assert "# fit (1 process(es))" in report
+    assert "work" in report
+    assert "old" not in report
+
+
+def test_profiling_disabled(configs):
+    config = configs.get_first()
+    with profiling.profile(config, "fit"):
+        work()
+    profiling.save_report(configs)
+    assert not profiling.get_dir(configs).exists()
@@ -0,0 +1,42 @@
+#%%
+from types import SimpleNamespace
+
+import pandas as pd
+import pytest
+
+from metaDMG.fit import serial
+from metaDMG.utils import Config
+
+
+#%%
+
+
+def test_parse_tax_id():
+    # the dashboard dependencies are optional
+    VizResults = pytest.importorskip("metaDMG.viz.results").VizResults
+
+    viz_results = SimpleNamespace(df=pd.DataFrame({"tax_id": [1, 2]}))
+    assert VizResults.parse_tax_id(viz_results, "2") == 2
+    assert VizResults.parse_tax_id(viz_results, "Homo") == "Homo"
+
+    viz_results = SimpleNamespace(df=pd.DataFrame({"tax_id": ["NC_1", "NC_2"]}))
+    assert VizResults.parse_tax_id(viz_results, "NC_1") == "NC_1"
+
+
+def test_load_old_fit_results_with_string_tax_ids(configs):
+    config = Config(configs.get_first(), damage_mode="lca")
+    serial.save_df_fit_results(
+        config,
+        pd.DataFrame({"tax_id": ["1", "2"], "D_max": [0.1, 0.2]}),
+    )
+
+    df_fit_results = serial.load_df_fit_results(config)
+    assert df_fit_results["tax_id"].tolist() == [1, 2]
+    assert pd.api.types.is_integer_dtype(df_fit_results["tax_id"])
+
+    # fit results which are not of the LCA are refitted
+    serial.save_df_fit_results(
+        config,
+        pd.DataFrame({"tax_id": ["NC_1"], "D_max": [0.1]}),
+    )
+    assert serial.load_df_fit_results(config) is None
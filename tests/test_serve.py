@@ -0,0 +1,140 @@
+#%%
+import json
+import os
+import time
+
+from metaDMG import __version__
+from metaDMG.fit import serve
+from metaDMG.fit.serve import Spool
+
+
+#%%
+
+
+def run_sample(config):
+    """Run in the workers instead of `serve.run_sample`."""
+    if config["sample"] == "crash":
+        # e.g. killed when running out of memory
+        os._exit(1)
+    N_errors = 1 if config["sample"] == "bad" else 0
+    return {"started": time.time(), "finished": time.time(), "N_errors": N_errors}
+
+
+def warm_up():
+    pass
+
+
+def write_config_file(path, tmp_path, **settings):
+    lines = [
+        "samples:",
+        "  sample_a: sample_a.bam",
+        "  sample_b: sample_b.bam",
+        f"output_dir: {tmp_path / 'data'}",
+        f"config_file: {path}",
+        "damage_mode: local",
+        "names: null",
+        "nodes: null",
+        "acc2tax: null",
+        "custom_database: false",
+        "bayesian: false",
+        "parallel_samples: 1",
+        f"version: {__version__}",
+    ]
+    lines += [f"{key}: {value}" for key, value in settings.items()]
+    path.write_text("\n".join(lines) + "\n")
+
+
+#%%
+
+
+def test_spool_picks_up_settled_files(tmp_path, monkeypatch):
+    spool_dir = tmp_path / "spool"
+    spool = Spool(spool_dir, settle_seconds=0.2)
+
+    (spool_dir / "sample.bam").write_text("a")
+    (spool_dir / ".hidden.bam").write_text("a")
+    (spool_dir / "notes.txt").write_text("a")
+    assert spool.get_ready() == []
+    assert not spool.is_empty()
+
+    # still being copied
+    (spool_dir / "sample.bam").write_text("ab")
+    assert spool.get_ready() == []
+
+    time.sleep(0.25)
+    ((path, arrived),) = spool.get_ready()
+    assert path == spool_dir / "processed" / "sample.bam"
+    assert arrived < time.time() - 0.2
+    assert spool.is_empty()
+
+    spool.fail(path)
+    assert (spool_dir / "failed" / "sample.bam").exists()
+
+
+def test_spool_file_removed_while_checking(tmp_path, monkeypatch):
+    spool_dir = tmp_path / "spool"
+    spool = Spool(spool_dir, settle_seconds=0)
+    (spool_dir / "gone.bam").write_text("a")
+    (spool_dir / "sample.bam").write_text("a")
+
+    is_spool_file = serve.is_spool_file
+
+    def is_spool_file_then_remove(path):
+        # e.g. picked up by another daemon
+        result = is_spool_file(path)
+        if path.name == "gone.bam":
+            path.unlink()
+        return result
+
+    monkeypatch.setattr(serve, "is_spool_file", is_spool_file_then_remove)
+    assert spool.get_ready() == []
+    assert [path.name for path, _ in spool.get_ready()] == ["sample.bam"]
+
+
+def test_get_configs_resolves_auto(configs, tmp_path):
+    path = tmp_path / "new.yaml"
+    write_config_file(path, tmp_path, cores_per_sample="auto", max_cores=4)
+
+    configs_file = serve.get_configs(configs, path)
+    assert list(configs_file["samples"]) == ["sample_a", "sample_b"]
+    assert isinstance(configs_file["cores_per_sample"], int)
+
+    configs_bam = serve.get_configs(configs, tmp_path / "new.sam.gz")
+    assert configs_bam["samples"] == {"new": tmp_path / "new.sam.gz"}
+
+
+def test_serve_once(configs, tmp_path, monkeypatch):
+    monkeypatch.setattr(serve, "run_sample", run_sample)
+    monkeypatch.setattr(serve, "warm_up", warm_up)
+
+    spool_dir = tmp_path / "spool"
+    spool_dir.mkdir()
+    for name in ["bad.bam", "crash.bam", "good.bam"]:
+        (spool_dir / name).write_text("a")
+    write_config_file(spool_dir / "new.yaml", tmp_path)
+
+    # the worker running crash.bam dies, after which a new pool runs the rest
+    N_errors = serve.serve(
+        configs, spool_dir, once=True, poll_seconds=0.05, settle_seconds=0
+    )
+    assert N_errors == 2
+
+    assert sorted(path.name for path in (spool_dir / "failed").iterdir()) == [
+        "bad.bam",
+        "crash.bam",
+    ]
+    assert sorted(path.name for path in (spool_dir / "processed").iterdir()) == [
+        "good.bam",
+        "new.yaml",
+    ]
+
+    path_latency = tmp_path / "data" / "run_manifest" / "serve.jsonl"
+    latencies = [json.loads(line) for line in path_latency.read_text().splitlines()]
+    status = {latency["sample"]: latency["status"] for latency in latencies}
+    assert status == {
+        "bad": "failed",
+        "crash": "failed",
+        "good": "done",
+        "sample_a": "done",
+        "sample_b": "done",
+    }
@@ -0,0 +1,206 @@
+#%%
+import gzip
+from io import StringIO
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from metaDMG.fit import stats
+from metaDMG.utils import Config
+
+
+#%%
+
+path_testdata = Path(__file__).parent / "testdata"
+
+
+def read_stats_lca_pandas(config: Config) -> pd.DataFrame:
+    # the parser before the Arrow one
+
+    columns = [
+        "tax_id",
+        "tax_name",
+        "tax_rank",
+        "N_alignments",
+        "N_reads",
+        "mean_L",
+        "var_L",
+        "mean_GC",
+        "var_GC",
+        "tax_path",
+    ]
+
+    with gzip.open(config["path_mismatches_stat"], "rt") as f:
+        data = f.read()
+
+    data = data.replace("'", "")
+    data = data.replace("\t\t", "\t'")
+    data = data.replace('1:root:"no rank"', """1:root:"no rank"'""")
+
+    string_columns = ["tax_id", "tax_name", "tax_rank", "tax_path"]
+
+    df_stats = pd.read_csv(
+        StringIO(data),
+        sep="\t",
+        skiprows=1,
+        index_col=False,
+        quotechar="'",
+        names=columns,
+        dtype={column: "string" for column in string_columns},
+    )
+
+    for column in ("tax_name", "tax_rank"):
+        df_stats[column] = df_stats[column].str.replace('"', "")
+
+    df_stats["std_L"] = np.sqrt(df_stats["var_L"])
+    df_stats["std_GC"] = np.sqrt(df_stats["var_GC"])
+    return df_stats.astype({"tax_id": "int64"})
+
+
+def read_taxonomy() -> tuple[dict, dict]:
+    names = {}
+    with open(path_testdata / "names-mdmg.dmp") as f:
+        for line in f:
+            tax_id, name, _, kind = line.split("\t|\t")
+            if kind.startswith("scientific name"):
+                names[int(tax_id)] = name
+
+    nodes = {}
+    with open(path_testdata / "nodes-mdmg.dmp") as f:
+        for line in f:
+            tax_id, parent, rank = line.split("\t|\t")
+            nodes[int(tax_id)] = (int(parent), rank.rstrip("\t|\n"))
+
+    return names, nodes
+
+
+def get_tax_path(tax_id: int, names: dict, nodes: dict) -> str:
+    # the lineage up to the root, separated by tabs
+    tax_path = []
+    while tax_id != 1:
+        parent, rank = nodes[tax_id]
+        tax_path.append(f'{tax_id}:"{names[tax_id]}":"{rank}"')
+        tax_id = parent
+    tax_path.append('1:root:"no rank"')
+    return "\t".join(tax_path)
+
+
+def write_stat_file(path, rows: list[dict]) -> None:
+    with gzip.open(path, "wt") as f:
+        f.write("taxid\tname\trank\tnalign\tnreads\tmean_L\tvar_L\tmean_GC\tvar_GC\n")
+        for row in rows:
+            values = [
+                row["tax_id"],
+                f'"{row["tax_name"]}"',
+                f'"{row["tax_rank"]}"',
+                row["N_alignments"],
+                row["N_reads"],
+                row.get("mean_L", 40.5),
+                row.get("var_L", 12.25),
+                row.get("mean_GC", 0.45),
+                row.get("var_GC", 0.01),
+                "",
+                row["tax_path"],
+            ]
+            f.write("\t".join(str(value) for value in values) + "\n")
+
+
+def get_rows_testdata() -> list[dict]:
+    """The lineages of the references in the test data (see acc2taxid.map.gz)."""
+
+    names, nodes = read_taxonomy()
+    df_acc2tax = pd.read_csv(path_testdata / "acc2taxid.map.gz", sep="\t")
+    accessions = ["GCA_000007325.1", "GCA_000344275.1"]
+    tax_ids = df_acc2tax.query("accession in @accessions")["taxid"]
+
+    rows = []
+    for N_reads, tax_id in enumerate(tax_ids, start=10):
+        # the leaves and all their ancestors (except the root)
+        while tax_id != 1:
+            parent, rank = nodes[tax_id]
+            rows.append(
+                {
+                    "tax_id": tax_id,
+                    "tax_name": names[tax_id],
+                    "tax_rank": rank,
+                    "N_alignments": 2 * N_reads,
+                    "N_reads": N_reads,
+                    "tax_path": get_tax_path(tax_id, names, nodes),
+                }
+            )
+            tax_id = parent
+    return rows
+
+
+def get_rows_crafted() -> list[dict]:
+    """Tax names with the characters that the line parser has to keep: colons,
+    apostrophes (which are removed), commas, quotes and semicolons. The tax names
+    cannot contain tabs (the field separator of names.dmp), only the tax path can."""
+
+    rows = []
+    tax_names = [
+        "Escherichia coli O157:H7",
+        "Bacillus sp. 'strain 1'",
+        "uncultured bacterium, clone 2; isolate 3",
+        "Candidatus Nitrosopumilus",
+    ]
+    for tax_id, tax_name in enumerate(tax_names, start=100):
+        rows.append(
+            {
+                "tax_id": tax_id,
+                "tax_name": tax_name,
+                "tax_rank": "no rank" if tax_id % 2 else "species",
+                "N_alignments": 10**10 + tax_id,
+                "N_reads": tax_id,
+                "mean_L": 1e-3 * tax_id,
+                "tax_path": "\t".join(
+                    [f'{tax_id}:"{tax_name}":"species"', '2:"Bacteria":"superkingdom"']
+                    + ['1:root:"no rank"']
+                ),
+            }
+        )
+    return rows
+
+
+@pytest.fixture
+def config(configs, tmp_path):
+    config = Config(configs.get_first(), damage_mode="lca")
+    config["path_mismatches_stat"] = tmp_path / "sample0.mismatches.stat.txt.gz"
+    return config
+
+
+#%%
+
+
+@pytest.mark.parametrize("get_rows", [get_rows_testdata, get_rows_crafted])
+def test_read_stats_lca_equals_pandas(config, get_rows):
+    rows = get_rows()
+    write_stat_file(config["path_mismatches_stat"], rows)
+
+    df_stats = stats.read_stats_lca(config)
+    assert len(df_stats) == len(rows)
+    pd.testing.assert_frame_equal(df_stats, read_stats_lca_pandas(config))
+
+    # the tabs of the tax path are kept (max_splits), the apostrophes are removed
+    for column in ["tax_name", "tax_path"]:
+        values = [row[column].replace("'", "") for row in rows]
+        assert list(df_stats[column]) == values
+
+
+def test_iterate_lines(config):
+    rows = get_rows_crafted()
+    write_stat_file(config["path_mismatches_stat"], rows)
+
+    # whole lines (without the header), no matter the tabs, commas or quotes
+    lines = [
+        line
+        for block in stats.iterate_lines(config["path_mismatches_stat"])
+        for line in block.to_pylist()
+    ]
+    assert len(lines) == len(rows)
+    assert all(
+        line.count("\t") == 10 + row["tax_path"].count("\t")
+        for line, row in zip(lines, rows)
+    )
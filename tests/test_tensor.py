@@ -0,0 +1,88 @@
+#%%
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import sparse
+
+from metaDMG.fit import mismatches, tensor
+from metaDMG.utils import Config
+from tests.test_mismatches import get_counts, write_mismatch_file
+
+
+#%%
+
+
+@pytest.fixture
+def config(configs, tmp_path):
+    config = Config(configs.get_first(), damage_mode="lca", mismatch_store="sparse")
+    config["path_mismatches_txt"] = tmp_path / "sample0.mismatches.txt.gz"
+    write_mismatch_file(
+        config["path_mismatches_txt"],
+        {tax_id: get_counts(tax_id) for tax_id in range(1000, 1020)},
+    )
+    return config
+
+
+def assert_frame_equal(df_sparse: pd.DataFrame, df_mismatches: pd.DataFrame) -> None:
+    pd.testing.assert_frame_equal(
+        df_sparse.reset_index(drop=True),
+        df_mismatches.reset_index(drop=True),
+        check_categorical=False,
+    )
+
+
+#%%
+
+
+@pytest.mark.parametrize("chunk_size", [None, 0.001])
+def test_sparse_round_trip(config, chunk_size):
+    config = Config(config, mismatches_chunk_size=chunk_size)
+    df_mismatches = mismatches.compute(config)
+
+    tax_ids, counts = tensor.compute(config)
+    assert sparse.issparse(counts)
+    assert counts.shape == (20, 2 * 15 * 16)
+    tensor.save(config, tax_ids, counts)
+
+    assert tensor.is_valid(config)
+    assert_frame_equal(tensor.to_dataframe(config, *tensor.load(config)), df_mismatches)
+
+
+def test_sparse_load_tax_ids(config):
+    df_mismatches = mismatches.compute(config)
+    tensor.save(config, *tensor.compute(config))
+
+    tax_ids = [1003, 1011, 5000]
+    df_tax_ids = tensor.load_tax_ids(config, tax_ids)
+    assert_frame_equal(df_tax_ids, df_mismatches.query("tax_id in @tax_ids"))
+
+
+def test_sparse_row_blocks(config, monkeypatch):
+    config = Config(config, damage_mode="local")
+    df_mismatches = mismatches.compute(config)
+    tax_ids, counts = tensor.compute(config)
+
+    # tax IDs without any counts are skipped
+    tax_ids = np.concatenate([tax_ids, ["empty"]])
+    counts = sparse.vstack([counts, sparse.csr_matrix((1, counts.shape[1]))], "csr")
+
+    # only a single block of rows is made dense at a time
+    N_rows = []
+
+    def to_dense(counts_block):
+        N_rows.append(counts_block.shape[0])
+        return counts_block.toarray().reshape(-1, 2, 15, 4, 4)
+
+    monkeypatch.setattr(tensor, "to_dense", to_dense)
+
+    df_sparse = tensor.to_dataframe(config, tax_ids, counts, block_size=3)
+    assert N_rows == [3] * 6 + [2]
+    assert_frame_equal(df_sparse, df_mismatches)
+
+
+def test_load_dataframe(config, tmp_path):
+    df_mismatches = mismatches.compute(config)
+    tensor.save(config, *tensor.compute(config))
+
+    df_sparse = tensor.load_dataframe(tensor.get_paths(config)["counts"])
+    assert_frame_equal(df_sparse, df_mismatches)
@@ -0,0 +1,50 @@
+#%%
+import json
+import os
+import socket
+
+from metaDMG.fit import trace
+from metaDMG.utils import Config
+
+
+#%%
+
+
+def test_trace(configs):
+    configs["trace"] = True
+    config = configs.get_first()
+
+    trace.start(configs)
+    with trace.span(config, "parse"):
+        with trace.span(config, "fit", category="fit", chunk=0):
+            pass
+
+    # named by the host, such that the workers of a queue on other nodes never share it
+    (path,) = trace.get_dir(configs).iterdir()
+    assert path.name.startswith(f"{socket.gethostname()}.{os.getpid()}.")
+
+    trace.merge(configs)
+
+    data = json.loads(trace.get_path(configs).read_text())
+    assert data["displayTimeUnit"] == "ms"
+    spans = [event for event in data["traceEvents"] if event["ph"] == "X"]
+    metadata = [event for event in data["traceEvents"] if event["ph"] == "M"]
+
+    # the inner span ends first
+    assert [span["name"] for span in spans] == ["fit", "parse"]
+    fit, parse = spans
+    assert fit["cat"] == "fit" and parse["cat"] == "stage"
+    assert fit["args"] == {"sample": "sample0", "worker": "MainProcess", "chunk": 0}
+    assert parse["ts"] <= fit["ts"]
+    assert fit["ts"] + fit["dur"] <= parse["ts"] + parse["dur"]
+    assert metadata[0]["args"]["name"] == "metaDMG (main)"
+
+    # the trace events of the processes are removed after merging
+    assert not trace.get_dir(configs).exists()
+
+
+def test_trace_disabled(configs):
+    config = Config(configs.get_first(), trace=False)
+    with trace.span(config, "parse"):
+        pass
+    assert not trace.get_dir(config).exists()
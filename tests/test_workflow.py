@@ -0,0 +1,89 @@
+#%%
+from concurrent.futures import Future
+
+import pytest
+
+from metaDMG.fit import autotune, workflow
+
+
+#%%
+
+
+class FakeCppRunner:
+    """Runs the C++ stage right away, recording when each sample was run ahead."""
+
+    def __init__(self, events):
+        self.events = events
+
+    def __call__(self, max_jobs, N_cores):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def submit(self, config, force):
+        self.events.append(f"ahead {config['sample']}")
+        future = Future()
+        future.set_result(0)
+        return future
+
+
+@pytest.fixture
+def events(monkeypatch):
+    events = []
+
+    def run_single_config_count_errors(config, force_cpp=None):
+        events.append(f"run {config['sample']}")
+        return 0
+
+    def estimate_sample(config):
+        return {"sample": config["sample"], "memory": 1e9}
+
+    monkeypatch.setattr(workflow, "CppRunner", FakeCppRunner(events))
+    monkeypatch.setattr(
+        workflow, "run_single_config_count_errors", run_single_config_count_errors
+    )
+    monkeypatch.setattr(autotune, "estimate_sample", estimate_sample)
+    monkeypatch.setattr(autotune, "get_memory_of_children", lambda idle: 0)
+    monkeypatch.setattr(workflow, "get_available_memory", lambda: 1e12)
+    return events
+
+
+#%%
+
+
+def test_pipelined_runs_ahead(configs, events):
+    configs["max_cores"] = 4
+    configs["cpp_lookahead"] = 2
+
+    assert workflow.run_pipelined(configs) == 0
+    assert events[:5] == [
+        "ahead sample1",
+        "ahead sample2",
+        "run sample0",
+        "ahead sample3",
+        "run sample1",
+    ]
+
+
+def test_pipelined_with_memory_budget(configs, events):
+    configs["max_cores"] = 4
+    configs["cpp_lookahead"] = 2
+    # room for the current sample and a single sample running ahead
+    configs["memory_budget"] = 2.5
+
+    assert workflow.run_pipelined(configs) == 0
+    assert events == [
+        "ahead sample1",
+        "run sample0",
+        "ahead sample2",
+        "run sample1",
+        "ahead sample3",
+        "run sample2",
+        "ahead sample4",
+        "run sample3",
+        "run sample4",
+    ]